@@ -0,0 +1,98 @@
+'''
+Benchmark of src.preprocessing.preprocess_madrid_aq_data against its previous (melt/unstack) implementation
+on synthetic raw hourly data with the layout of the air quality files of the Ayuntamiento de Madrid.
+Both outputs are checked to be equal.
+
+Usage (from the root of the repository):
+    python benchmarks/benchmark_preprocess_aq.py --years 7 --stations 24
+'''
+import argparse, time
+import numpy as np
+import pandas as pd
+
+from src.preprocessing import preprocess_madrid_aq_data
+from src.constants import indicators_code_dict
+
+def preprocess_madrid_aq_data_legacy(df_raw,parameters_dict):
+    '''
+    Implementacion anterior de preprocess_madrid_aq_data (por filas, con melt y unstack)
+    '''
+    df = df_raw.copy()
+    df.dropna(how='any',subset=['PUNTO_MUESTREO'],inplace=True)
+    df['PARAMETRO'] = df.PUNTO_MUESTREO.apply(lambda x: parameters_dict[int(x.split('_')[1])]['parametro'])
+    df['UNIDAD'] = df.PUNTO_MUESTREO.apply(lambda x: parameters_dict[int(x.split('_')[1])]['unidad'])
+    df['FECHA'] = df.ANO.astype(int).astype(str) + '-' + df.MES.astype(int).astype(str).str.zfill(2) + '-' + df.DIA.astype(int).astype(str).str.zfill(2)
+    measurement_cols = df.columns[(df.columns.str.startswith('H'))]
+    validation_cols = df.columns[(df.columns.str.startswith('V'))]
+    df = (
+      df[['FECHA','PROVINCIA', 'MUNICIPIO', 'ESTACION', 'MAGNITUD','PARAMETRO','UNIDAD']+measurement_cols.tolist()+validation_cols.tolist()]
+      .melt(['FECHA','PROVINCIA', 'MUNICIPIO', 'ESTACION', 'MAGNITUD','PARAMETRO','UNIDAD'])
+    )
+    df = df[~((df.variable.str.startswith('V'))&(df.value!='V'))]
+    df = df[df.variable.str.startswith('H')].rename(columns={'variable':'TIME'})
+    df['value'] = df['value'].astype(float)
+    df['value'] = np.where(df['value']<0,0,df['value'])
+    df['TIME'] = ''+df['TIME'].str.replace('H','').str.replace('24','00')+':00:00'
+    df['FECHA'] = pd.to_datetime(df['FECHA'] + ' ' + df['TIME'])
+    df = df.drop(columns='TIME')
+    df.columns=df.columns.str.lower().tolist()
+    df['parametro'] = (df['parametro']+' ('+df['unidad']+')').str.lower()
+    df = (df
+        .drop_duplicates(subset=['fecha','provincia','municipio','estacion','parametro','unidad'])
+        .set_index(['fecha','provincia','municipio','estacion','parametro'])['value']
+        .unstack()
+        .reset_index().sort_values('fecha')
+    )
+    df.columns = df.columns.str.lower().tolist()
+    return df
+
+def make_raw_aq_data(years=1,stations=24,seed=0):
+    '''
+    Returns a pandas.DataFrame of random raw hourly air quality data (one row per station, magnitude and day)
+    with missing, negative and non-validated values and some duplicated rows.
+    '''
+    rng = np.random.default_rng(seed)
+    days = pd.date_range("2015-01-01",periods=365*years,freq="D")
+    magnitudes = list(indicators_code_dict)
+    n = len(days)*stations*len(magnitudes)
+    estaciones = np.repeat(np.arange(1,stations+1),len(days)*len(magnitudes))
+    magnitud = np.tile(np.repeat(magnitudes,len(days)),stations)
+    fechas = pd.DatetimeIndex(np.tile(days.values,stations*len(magnitudes)))
+    df = pd.DataFrame({
+        'PROVINCIA': 28,
+        'MUNICIPIO': 79,
+        'ESTACION': estaciones,
+        'MAGNITUD': magnitud,
+        'PUNTO_MUESTREO': [f"28079{e:03d}_{m}_38" for e,m in zip(estaciones,magnitud)],
+        'ANO': fechas.year,
+        'MES': fechas.month,
+        'DIA': fechas.day,
+    })
+    for h in range(1,25):
+        values = rng.gamma(2,10,n).round(1)
+        values[rng.random(n)<0.02] = -1
+        values[rng.random(n)<0.05] = np.nan
+        df[f"H{h:02d}"] = values
+        df[f"V{h:02d}"] = np.where(rng.random(n)<0.05,'N','V')
+    return pd.concat([df,df.sample(frac=0.001,random_state=seed)]).sample(frac=1,random_state=seed)
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--years",type=int,default=1)
+    parser.add_argument("--stations",type=int,default=24)
+    parser.add_argument("--skip-legacy",action="store_true",help="Only time the current implementation")
+    args = parser.parse_args()
+
+    df_raw = make_raw_aq_data(args.years,args.stations)
+    print(f"{len(df_raw)} filas de datos en bruto ({args.years} años, {args.stations} estaciones, {len(indicators_code_dict)} magnitudes)")
+    start = time.perf_counter()
+    df = preprocess_madrid_aq_data(df_raw,indicators_code_dict)
+    elapsed = time.perf_counter()-start
+    print(f"preprocess_madrid_aq_data: {elapsed:.2f}s -> {df.shape}")
+    if not args.skip_legacy:
+        start = time.perf_counter()
+        df_legacy = preprocess_madrid_aq_data_legacy(df_raw,indicators_code_dict)
+        elapsed_legacy = time.perf_counter()-start
+        print(f"implementacion anterior: {elapsed_legacy:.2f}s -> {df_legacy.shape} ({elapsed_legacy/elapsed:.1f}x)")
+        pd.testing.assert_frame_equal(df,df_legacy)
+        print("Los resultados son iguales")
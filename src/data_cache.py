@@ -0,0 +1,137 @@
+import pandas as pd
+import os, json, hashlib, pickle, logging
+
+logging.basicConfig()
+
+def file_hash(path:str,chunk_size:int=2**20) -> str:
+    '''
+    Returns the sha256 hex digest of the content of a file.
+    If path is a directory (e.g: a partitioned dataset) the digest covers the relative path and content of every file in it.
+    '''
+    sha = hashlib.sha256()
+    if os.path.isdir(path):
+        fpaths = sorted(
+            os.path.join(root,fname)
+            for root,_,files in os.walk(path)
+            for fname in files
+        )
+    else:
+        fpaths = [path]
+    for fpath in fpaths:
+        if fpath!=path:
+            sha.update(os.path.relpath(fpath,path).encode())
+        with open(fpath,"rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size),b""):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+def make_cache_key(*hashes,**params) -> str:
+    '''
+    Returns a key identifying a result derived from inputs with the given hashes (e.g: obtained with file_hash)
+    and computed with the given parameters. Same inputs and parameters always give the same key.
+    '''
+    content = json.dumps({"hashes":list(hashes),"params":params},sort_keys=True,default=str)
+    return hashlib.sha256(content.encode()).hexdigest()[:32]
+
+def load_cached_frame(cache_dir:str,stage:str,key:str) -> pd.DataFrame:
+    '''
+    Returns the pandas.DataFrame stored under cache_dir/stage/key.feather or None if there is none.
+    '''
+    fpath = os.path.join(cache_dir,stage,f"{key}.feather")
+    if not os.path.isfile(fpath):
+        return None
+    try:
+        return pd.read_feather(fpath)
+    except Exception as err:
+        logging.warning(f"Could not read cached data from {fpath}: {err}")
+        return None
+
+def save_cached_frame(df:pd.DataFrame,cache_dir:str,stage:str,key:str) -> str:
+    '''
+    Stores a pandas.DataFrame under cache_dir/stage/key.feather so that it can be loaded with load_cached_frame.
+    Returns the path of the cached file or None if it could not be written.
+    '''
+    fpath = os.path.join(cache_dir,stage,f"{key}.feather")
+    tmp_fpath = f"{fpath}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(fpath),exist_ok=True)
+        df.reset_index(drop=True).to_feather(tmp_fpath)
+        os.replace(tmp_fpath,fpath)
+    except OSError as err:
+        logging.warning(f"Could not cache data to {fpath}: {err}")
+        return None
+    return fpath
+
+def frame_hash(df:pd.DataFrame) -> str:
+    '''
+    Returns the sha256 hex digest of the content of a pandas.DataFrame (values, index, column names and dtypes),
+    e.g: to use the exact data a model is trained with in its cache key (see make_cache_key).
+    '''
+    sha = hashlib.sha256()
+    sha.update(json.dumps([[str(col),str(dtype)] for col,dtype in df.dtypes.items()]).encode())
+    sha.update(pd.util.hash_pandas_object(df,index=True).values.tobytes())
+    return sha.hexdigest()
+
+def load_cached_object(cache_dir:str,stage:str,key:str):
+    '''
+    Returns the python object pickled under cache_dir/stage/key.pkl or None if there is none.
+    The modification time of the file is updated so that it is the last one evicted by evict_cache.
+    '''
+    fpath = os.path.join(cache_dir,stage,f"{key}.pkl")
+    if not os.path.isfile(fpath):
+        return None
+    try:
+        with open(fpath,"rb") as f:
+            obj = pickle.load(f)
+        os.utime(fpath)
+    except Exception as err:
+        logging.warning(f"Could not read cached object from {fpath}: {err}")
+        return None
+    return obj
+
+def save_cached_object(obj,cache_dir:str,stage:str,key:str,max_bytes:int=None) -> str:
+    '''
+    Pickles a python object (e.g: a fitted model and its results) under cache_dir/stage/key.pkl
+    so that it can be loaded with load_cached_object. If max_bytes is given, the least recently used files
+    of cache_dir/stage are evicted afterwards so that they take at most max_bytes (see evict_cache).
+    Returns the path of the cached file or None if it could not be written.
+    '''
+    fpath = os.path.join(cache_dir,stage,f"{key}.pkl")
+    tmp_fpath = f"{fpath}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(fpath),exist_ok=True)
+        with open(tmp_fpath,"wb") as f:
+            pickle.dump(obj,f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fpath,fpath)
+    except Exception as err:
+        logging.warning(f"Could not cache object to {fpath}: {err}")
+        if os.path.isfile(tmp_fpath):
+            os.remove(tmp_fpath)
+        return None
+    if max_bytes is not None:
+        evict_cache(os.path.dirname(fpath),max_bytes)
+    return fpath
+
+def evict_cache(dir_path:str,max_bytes:int) -> list:
+    '''
+    Removes the least recently used files (by modification time) of a cache directory
+    until the files left take at most max_bytes. Returns the paths of the removed files.
+    '''
+    files = []
+    for entry in os.scandir(dir_path):
+        if entry.is_file() and not entry.name.endswith(".tmp"):
+            stat = entry.stat()
+            files.append((stat.st_mtime_ns,stat.st_size,entry.path))
+    total = sum(size for _,size,_ in files)
+    removed = []
+    for _,size,fpath in sorted(files):
+        if total<=max_bytes:
+            break
+        try:
+            os.remove(fpath)
+        except FileNotFoundError:
+            # Already removed by another process
+            pass
+        total -= size
+        removed.append(fpath)
+    return removed
@@ -0,0 +1,222 @@
+import pyarrow.dataset as ds
+import pandas as pd
+import os, json, hashlib, logging
+
+from .data_cache import file_hash
+
+logging.basicConfig()
+
+CACHE_DIRNAME = ".cache"
+CATALOG_FILENAME = "data_catalog.json"
+
+# Logical name of each dataset of the project and the file names it can be stored as (by order of preference)
+DATASET_FILENAMES = {
+    "air_quality": ["air_quality_data.parquet","air_quality_data.feather"],
+    "air_quality_normalized": ["aq-weather_normalized.parquet","aq-weather_normalized.feather"],
+    "weather": ["weather_data.parquet","weather_data.feather"],
+    "traffic": ["traffic_data.parquet","traffic_data.feather"],
+    "traffic_locations": ["traffic_locations_data.feather"],
+    "traffic_locations_raw": ["pmed_trafico_ubicaciones_raw.feather"],
+    "air_locations": ["informacion_estaciones_red_calidad_aire.csv"],
+    "madrid_data": ["madrid_data.parquet","madrid_data.feather"],
+    "madrid_normalized_data": ["madrid_normalized_data.parquet","madrid_normalized_data.feather"],
+}
+
+# Catalogs already loaded in this process by data_dir
+_catalogs = {}
+
+def find_dataset(data_dir:str,name:str) -> str:
+    '''
+    Returns the path to the dataset with the given logical name (one of DATASET_FILENAMES) in the
+    directory tree of data_dir or None if it does not exist.
+
+    The paths are looked up in a catalog persisted in data_dir/.cache/data_catalog.json, so that
+    the directory tree is only walked the first time instead of on every call.
+    An entry of the catalog is refreshed when the size or modification time of its file changes
+    or when a file is added to the directory that contains it, and a missing dataset is only looked up again
+    when one of the directories of the tree changes.
+
+    e.g: find_dataset('../01-data','air_quality')
+    '''
+    info = get_dataset_info(data_dir,name)
+    return None if info is None else info["path"]
+
+def get_dataset_info(data_dir:str,name:str) -> dict:
+    '''
+    Returns the entry of the catalog of data_dir for the dataset with the given logical name:
+    a dict with its path, size, mtime and schema (as a dict of column name to type),
+    or None if the dataset does not exist in the directory tree of data_dir.
+    '''
+    if name not in DATASET_FILENAMES:
+        raise ValueError(f"Unknown dataset {name}. Must be one of {list(DATASET_FILENAMES)}")
+    data_dir = os.path.realpath(data_dir)
+    catalog = load_catalog(data_dir)
+    entry = catalog["datasets"].get(name)
+    if entry is not None and _is_entry_valid(entry):
+        return entry
+    if entry is None and not _tree_changed(catalog):
+        # Missing when the tree was walked and no file was added since then
+        return None
+    if entry is not None and os.path.exists(entry["path"]) and not _dir_changed(entry):
+        # Same file but modified: refresh its entry only
+        catalog["datasets"][name] = _make_entry(entry["path"])
+    else:
+        catalog = build_catalog(data_dir)
+    _save_catalog(data_dir,catalog)
+    return catalog["datasets"].get(name)
+
+def get_dataset_hash(data_dir:str,name:str) -> str:
+    '''
+    Returns the sha256 hash of the content of the dataset with the given logical name or None if it does not exist.
+    The hash is stored in the catalog so that it is only computed again when the dataset changes.
+    '''
+    data_dir = os.path.realpath(data_dir)
+    info = get_dataset_info(data_dir,name)
+    if info is None:
+        return None
+    if info.get("sha256") is None:
+        info["sha256"] = file_hash(info["path"])
+        _save_catalog(data_dir,load_catalog(data_dir))
+    return info["sha256"]
+
+def load_catalog(data_dir:str) -> dict:
+    '''
+    Returns the catalog of datasets of data_dir. Reads it from data_dir/.cache/data_catalog.json
+    or builds it if it does not exist yet.
+    The paths of the catalog are stored relative to data_dir and loaded joined to its real path,
+    so they resolve from any working directory.
+    '''
+    data_dir = os.path.realpath(data_dir)
+    if data_dir in _catalogs:
+        return _catalogs[data_dir]
+    catalog_path = os.path.join(data_dir,CACHE_DIRNAME,CATALOG_FILENAME)
+    try:
+        with open(catalog_path) as f:
+            catalog = json.load(f)
+        for entry in catalog["datasets"].values():
+            entry["path"] = os.path.join(data_dir,entry["path"])
+        for field in ["dir_mtimes","dir_listings"]:
+            catalog[field] = {
+                os.path.normpath(os.path.join(data_dir,path)):value for path,value in catalog.get(field,{}).items()
+            }
+    except (OSError,ValueError,KeyError):
+        catalog = build_catalog(data_dir)
+        _save_catalog(data_dir,catalog)
+    _catalogs[data_dir] = catalog
+    return catalog
+
+def build_catalog(data_dir:str) -> dict:
+    '''
+    Walks the directory tree of data_dir once and builds the catalog of all the datasets of DATASET_FILENAMES found in it.
+    '''
+    data_dir = os.path.realpath(data_dir)
+    # Create the cache directory first so that it does not change the mtime of data_dir after the catalog is built
+    try:
+        os.makedirs(os.path.join(data_dir,CACHE_DIRNAME),exist_ok=True)
+    except OSError:
+        pass
+    filenames = {fname:name for name,fnames in DATASET_FILENAMES.items() for fname in fnames}
+    found = {}
+    dir_mtimes,dir_listings = {},{}
+    for root,dirs,files in os.walk(data_dir):
+        dir_mtimes[root] = os.stat(root).st_mtime_ns
+        dir_listings[root] = _listing_hash(root)
+        dirs.sort()
+        for fname in sorted(dirs+files):
+            if fname in filenames and fname not in found:
+                found[fname] = os.path.join(root,fname)
+        # Do not walk into partitioned datasets or hidden directories (e.g: caches)
+        dirs[:] = [d for d in dirs if not d.endswith(".parquet") and not d.startswith(".")]
+    datasets = {}
+    for name,fnames in DATASET_FILENAMES.items():
+        for fname in fnames:
+            if fname in found:
+                datasets[name] = _make_entry(found[fname])
+                break
+    # The mtimes of the walked directories tell if a missing dataset may have been added later
+    catalog = {"datasets":datasets,"dir_mtimes":dir_mtimes,"dir_listings":dir_listings}
+    _catalogs[data_dir] = catalog
+    return catalog
+
+def _make_entry(path):
+    stat = os.stat(path)
+    return {
+        "path": path,
+        "size": stat.st_size if not os.path.isdir(path) else 0,
+        "mtime": stat.st_mtime_ns,
+        "dir_mtime": os.stat(os.path.dirname(path) or ".").st_mtime_ns,
+        "dir_listing": _listing_hash(os.path.dirname(path) or "."),
+        "schema": _read_schema(path),
+    }
+
+def _is_entry_valid(entry):
+    try:
+        stat = os.stat(entry["path"])
+    except OSError:
+        return False
+    size = stat.st_size if not os.path.isdir(entry["path"]) else 0
+    return size==entry["size"] and stat.st_mtime_ns==entry["mtime"] and not _dir_changed(entry)
+
+def _dir_changed(entry):
+    # A new file in the directory of the dataset (e.g: a partitioned version of it) changes the mtime of the directory
+    dir_path = os.path.dirname(entry["path"]) or "."
+    mtime = os.stat(dir_path).st_mtime_ns
+    if mtime==entry["dir_mtime"]:
+        return False
+    # Hidden files and directories (e.g: the .cache of the memory-mapped copies) change the mtime but not the datasets
+    if _listing_hash(dir_path)!=entry.get("dir_listing"):
+        return True
+    entry["dir_mtime"] = mtime
+    return False
+
+def _tree_changed(catalog):
+    # A file or directory added anywhere in the tree changes the mtime of one of the walked directories
+    if not catalog.get("dir_mtimes"):
+        return True
+    listings = catalog.get("dir_listings",{})
+    for path,mtime in catalog["dir_mtimes"].items():
+        try:
+            new_mtime = os.stat(path).st_mtime_ns
+            if new_mtime!=mtime:
+                if _listing_hash(path)!=listings.get(path):
+                    return True
+                catalog["dir_mtimes"][path] = new_mtime
+        except OSError:
+            return True
+    return False
+
+def _listing_hash(path):
+    # Hash of the names of the files and directories in path that are not hidden
+    names = sorted(name for name in os.listdir(path) if not name.startswith("."))
+    return hashlib.sha1("\n".join(names).encode()).hexdigest()
+
+def _read_schema(path):
+    try:
+        if path.endswith(".csv"):
+            df = pd.read_csv(path,encoding='latin-1',sep=';',decimal=',',nrows=100)
+            return {col:str(dtype) for col,dtype in df.dtypes.items()}
+        elif os.path.isdir(path):
+            schema = ds.dataset(path,format="parquet",partitioning="hive").schema
+        else:
+            schema = ds.dataset(path,format="feather").schema
+        return {field.name:str(field.type) for field in schema}
+    except Exception as err:
+        logging.warning(f"Could not read the schema of {path}: {err}")
+        return None
+
+def _save_catalog(data_dir,catalog):
+    catalog_path = os.path.join(data_dir,CACHE_DIRNAME,CATALOG_FILENAME)
+    datasets = {
+        name:{**entry,"path":os.path.relpath(entry["path"],data_dir)}
+        for name,entry in catalog["datasets"].items()
+    }
+    dir_mtimes = {os.path.relpath(path,data_dir):mtime for path,mtime in catalog.get("dir_mtimes",{}).items()}
+    dir_listings = {os.path.relpath(path,data_dir):listing for path,listing in catalog.get("dir_listings",{}).items()}
+    tmp_path = f"{catalog_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(catalog_path),exist_ok=True)
+        with open(tmp_path,"w") as f:
+            json.dump({"datasets":datasets,"dir_mtimes":dir_mtimes,"dir_listings":dir_listings},f,indent=2)
+        os.replace(tmp_path,catalog_path)
+    except OSError as err:
+        logging.warning(f"Could not save the data catalog to {catalog_path}: {err}. It will only be kept in memory")
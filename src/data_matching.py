@@ -1,11 +1,18 @@
 import logging
+import numpy as np
 import pandas as pd
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-from .preprocessing import weight_nearby_traffic
+from .preprocessing.spatial_index import TrafficSensorIndex, nearby_traffic_matrices
+from .preprocessing.gap_filling import fill_frame_gaps
 from .constants import MADRID_AIR_QUALITY_ZONES
 
 logging.basicConfig()
 
+# Key of the missing times and locations in _time_keys and _location_time_keys, never matched by _match_keys
+MISSING_KEY = np.iinfo(np.int64).min
+
 def match_data(
     aq_df,
     weather_df=None,
@@ -13,113 +20,388 @@ def match_data(
     traffic_locations_df=None,
     air_locations_df=None,
     location_by="estacion",
+    km_dist=0.75,
+    traffic_features_df=None,
+    kernels="logistic",
     ) -> pd.DataFrame:
     '''
     Matches the data from air quality monitoring stations with meteorological data of cities in Madrid.
     Returns a pandas.Dataframe of the matched stations.
+
+    If weather_df has a location_by column (e.g: obtained with src.preprocessing.netcdf_to_stations),
+    each location is matched with its own weather data instead of with the city-wide data.
+
+    km_dist is the maximum distance (in km) of the traffic measurement points used for each location
+    and kernels the distance kernel used to weight their intensity. Both can be lists to add the traffic
+    features of several distances and kernels at once (see get_nearby_traffic_features).
+    traffic_features_df can be given to use traffic features already computed with get_nearby_traffic_features
+    instead of computing them from traffic_df.
     '''
     aq_df = aq_df.copy()
     aq_df.columns = aq_df.columns.str.replace("µ","u")
     if traffic_df is not None and (air_locations_df is None or traffic_locations_df is None):
         logging.warning("No traffic or air stations locations dataframe provided. Traffic data will not be used.")
         traffic_df = None
-    if traffic_df is None and weather_df is None:
+    if traffic_features_df is not None and air_locations_df is None:
+        logging.warning("No air stations locations dataframe provided. Traffic data will not be used.")
+        traffic_features_df = None
+    if traffic_df is None and traffic_features_df is None and weather_df is None:
         logging.warning("No weather or traffic dataframe provided. Nothing to match.")
         return aq_df
-    if weather_df is not None:
+    if weather_df is not None and location_by in weather_df.columns:
+        # Match each air quality monitoring station with its own meteorological data
+        # (e.g: extracted at its location with src.preprocessing.netcdf_to_stations)
+        aq_df = aq_df.dropna(subset=["time"])
+        all_locations = pd.Index(aq_df[location_by].unique()).append(pd.Index(weather_df[location_by].unique())).unique()
+        aq_keys,weather_keys = _location_time_keys(
+            (all_locations.get_indexer(aq_df[location_by]),aq_df.time),
+            (all_locations.get_indexer(weather_df[location_by]),weather_df.time),
+        )
+        aq_pos,weather_pos = _match_keys(aq_keys,weather_keys)
+        aq_df = aq_df.iloc[aq_pos]
+        weather_df = weather_df.iloc[weather_pos].drop(columns=["time",location_by])
+        weather_df.index = aq_df.index
+        aq_df = pd.concat([aq_df,weather_df],axis=1)
+    elif weather_df is not None:
         # Match the air quality monitoring stations with meteorological data
-        aq_df = aq_df[aq_df.time.isin(weather_df.time)]\
-            .join(
-                weather_df.set_index("time"),
-                on="time",
-                how="left",
-            ).dropna(subset=["time"])
-    if traffic_df is not None:
-        # Match the air quality monitoring stations with traffic data location by location    
-        matched_dfs = []
-        for location,lat,long in air_locations_df[[location_by,"latitud","longitud"]].values:
-            location_df = aq_df[aq_df[location_by]==location]
-            location_df = location_df[location_df.time.isin(traffic_df.time)]
-            # Compute distance between air stations and traffic stations in km
-            nearby_traffic_df = weight_nearby_traffic((lat,long),0.75,traffic_df,traffic_locations_df)
-            avg_weighted_intensity = nearby_traffic_df["traffic_intensity"]
-            avg_traffic_load = nearby_traffic_df["traffic_load"]
-            # Join traffic data to air quality data
-            location_df = location_df\
-                .loc[(location_df.time.isin(avg_weighted_intensity.index))]\
-                    .join(
-                        pd.concat([avg_weighted_intensity,avg_traffic_load],axis=1),
-                        on="time",
-                        how="left"
-                    ).dropna(subset=["time"])
-            matched_dfs.append(location_df)
-        madrid_air_quality_data = pd.concat(matched_dfs)
+        aq_df = _concat_on_time(aq_df.dropna(subset=["time"]),weather_df)
+    if traffic_features_df is None and traffic_df is not None:
+        traffic_features_df = get_nearby_traffic_features(
+            air_locations_df,
+            traffic_df,
+            traffic_locations_df,
+            km_dist=km_dist,
+            location_by=location_by,
+            kernels=kernels
+        )
+    if traffic_features_df is not None:
+        # Match the air quality monitoring stations with the traffic data of all locations at once
+        # on integer (location,time) keys
+        locations = air_locations_df[location_by].drop_duplicates()
+        traffic_features_df = traffic_features_df[[location_by,"time",*traffic_features_df.columns[traffic_features_df.columns.str.startswith("traffic_")]]]
+        all_locations = pd.Index(locations).append(pd.Index(traffic_features_df[location_by].unique())).unique()
+        aq_keys,traffic_keys = _location_time_keys(
+            (all_locations.get_indexer(aq_df[location_by]),aq_df.time),
+            (all_locations.get_indexer(traffic_features_df[location_by]),traffic_features_df.time),
+        )
+        aq_pos,traffic_pos = _match_keys(aq_keys,traffic_keys)
+        # Keep the rows grouped by location (in the order of air_locations_df) and in their original order within each location
+        location_order = pd.Categorical(aq_df[location_by].values[aq_pos],categories=locations).codes
+        order = np.argsort(location_order,kind="stable")
+        aq_pos,traffic_pos = aq_pos[order],traffic_pos[order]
+        madrid_air_quality_data = pd.concat([
+            aq_df.iloc[aq_pos].reset_index(drop=True),
+            traffic_features_df.iloc[traffic_pos].drop(columns=[location_by,"time"]).reset_index(drop=True),
+        ],axis=1)
     else:
         return aq_df
     return madrid_air_quality_data.reset_index(drop=True)
 
+def _time_keys(*times):
+    '''
+    Returns sorted-comparable int64 keys of datetime arrays (or of times encoded as integer hours, see src.utils.compact_dtypes)
+    in a shared resolution: hours since 1970-01-01 if all the times are whole hours or nanoseconds otherwise.
+    Missing times (NaT) get the key MISSING_KEY.
+    '''
+    hour = 3600*10**9
+    keys = []
+    for time in times:
+        time = np.asarray(time)
+        if np.issubdtype(time.dtype,np.integer):
+            keys.append(time.astype(np.int64)*hour)
+        else:
+            # NaT is stored as the smallest int64, the same value as MISSING_KEY
+            keys.append(time.astype("datetime64[ns]").astype(np.int64))
+    if all(((key%hour==0)|(key==MISSING_KEY)).all() for key in keys):
+        keys = [np.where(key==MISSING_KEY,MISSING_KEY,key//hour) for key in keys]
+    return keys
+
+def _location_time_keys(*codes_times):
+    '''
+    Returns int64 keys combining location codes (>=0) and times so that
+    (location,time) pairs can be matched with _match_keys. e.g: _location_time_keys((codes1,times1),(codes2,times2))
+    Pairs with a missing location (code<0) or time get the key MISSING_KEY.
+    '''
+    time_keys = _time_keys(*[times for _,times in codes_times])
+    known_keys = [keys[keys!=MISSING_KEY] for keys in time_keys]
+    min_key = min((keys.min() for keys in known_keys if len(keys)),default=0)
+    span = max((keys.max() for keys in known_keys if len(keys)),default=0) - min_key + 1
+    n_codes = max((int(codes.max())+1 for codes,_ in codes_times if len(codes)),default=1)
+    if int(span)*n_codes>=2**63:
+        # e.g: times at nanosecond resolution over years, the times are replaced by their rank among all the times
+        unique_keys = np.unique(np.concatenate(known_keys))
+        time_keys = [
+            np.where(keys!=MISSING_KEY,np.searchsorted(unique_keys,keys),MISSING_KEY)
+            for keys in time_keys
+        ]
+        min_key,span = 0,len(unique_keys)
+    return [
+        np.where((codes>=0)&(keys!=MISSING_KEY),codes.astype(np.int64)*span + (keys-min_key),MISSING_KEY)
+        for (codes,_),keys in zip(codes_times,time_keys)
+    ]
+
+def _match_keys(left_keys,right_keys):
+    '''
+    Matches two arrays of int64 keys (e.g: obtained with _time_keys) as an inner join with searchsorted on the sorted right keys.
+    Returns the positions (left_pos,right_pos) of every pair of equal keys in the order of left_keys
+    (and in the order of right_keys for repeated keys). Keys equal to MISSING_KEY are never matched.
+    '''
+    # The data is usually already sorted by time, sort it only if it is not
+    if len(right_keys)>1 and (right_keys[1:]<right_keys[:-1]).any():
+        order = np.argsort(right_keys,kind="stable")
+        sorted_keys = right_keys[order]
+    else:
+        order = None
+        sorted_keys = right_keys
+    first = np.searchsorted(sorted_keys,left_keys,side="left")
+    counts = np.searchsorted(sorted_keys,left_keys,side="right") - first
+    counts[left_keys==MISSING_KEY] = 0
+    left_pos = np.repeat(np.arange(len(left_keys)),counts)
+    right_pos = np.repeat(first-np.cumsum(counts)+counts,counts) + np.arange(counts.sum())
+    return left_pos,(right_pos if order is None else order[right_pos])
+
+def _concat_on_time(df,other_df,order_by_other=False):
+    '''
+    Concatenates the columns of other_df (except time) to the rows of df with the same time (as an inner join).
+    df and other_df can have the times as a "time" column or as their index.
+    The rows are in the order of df or, if order_by_other is True, in the order of other_df.
+    '''
+    times = df["time"] if "time" in df.columns else df.index
+    other_times = other_df["time"] if "time" in other_df.columns else other_df.index
+    keys,other_keys = _time_keys(times,other_times)
+    if order_by_other:
+        other_pos,pos = _match_keys(other_keys,keys)
+    else:
+        pos,other_pos = _match_keys(keys,other_keys)
+    df = df.iloc[pos]
+    other_df = other_df.iloc[other_pos].drop(columns="time",errors="ignore")
+    other_df.index = df.index
+    return pd.concat([df,other_df],axis=1)
+
+def get_nearby_traffic_features(
+    air_locations_df,
+    traffic_df,
+    traffic_locations_df,
+    km_dist=0.75,
+    location_by="estacion",
+    sensor_index=None,
+    kernels="logistic",
+    ) -> pd.DataFrame:
+    '''
+    Computes the distance-weighted traffic intensity and average traffic load nearby each location of air_locations_df.
+
+    The traffic measurement points nearby each location are found with a spatial index (see src.preprocessing.TrafficSensorIndex)
+    and the features of all locations and hours are computed as sparse products of the location x sensor weights
+    with the time x sensor traffic matrices. sensor_index can be given to reuse an index (and its cached weights) between calls.
+
+    km_dist and kernels can also be lists of distances (in km) and kernels (see src.preprocessing.spatial_index.DISTANCE_KERNELS)
+    to compute the features of all their combinations in one pass. e.g: km_dist=[0.5,0.75,1],kernels=["logistic","gaussian"]
+
+    Returns a pandas.DataFrame with the columns [location_by,"time","traffic_intensity","traffic_load"]
+    or, for several distances or kernels, [location_by,"time","traffic_intensity_{kernel}_{meters}m",...,"traffic_load_{meters}m",...]
+    (e.g: "traffic_intensity_logistic_750m" for km_dist=0.75) with a row for every location and time with traffic data within the largest distance.
+    '''
+    radii = [km_dist] if np.isscalar(km_dist) else list(km_dist)
+    kernels = [kernels] if isinstance(kernels,str) else list(kernels)
+    single = len(radii)==1 and len(kernels)==1
+    intensity_cols = {
+        (kernel,radius): "traffic_intensity" if single else f"traffic_intensity_{kernel}_{_meters(radius)}m"
+        for radius in radii for kernel in kernels
+    }
+    load_cols = {radius: "traffic_load" if single else f"traffic_load_{_meters(radius)}m" for radius in radii}
+    if sensor_index is None:
+        sensor_index = TrafficSensorIndex(traffic_locations_df)
+    locations_df = air_locations_df.dropna(subset=["latitud","longitud"])
+    if locations_df.empty:
+        return pd.DataFrame(columns=[location_by,"time",*intensity_cols.values(),*load_cols.values()])
+    times,traffic_intensity,traffic_load,has_data = nearby_traffic_matrices(
+        sensor_index,
+        locations_df[["latitud","longitud"]].values,
+        traffic_df,
+        km_dist=radii,
+        kernels=kernels
+    )
+    # One row per location and time with traffic data nearby, sorted by location and time
+    location_idx,time_idx = np.nonzero(has_data[max(radii)].T)
+    return pd.DataFrame({
+        location_by: locations_df[location_by].values[location_idx],
+        "time": times[time_idx],
+        **{col:traffic_intensity[key][time_idx,location_idx] for key,col in intensity_cols.items()},
+        **{col:traffic_load[radius][time_idx,location_idx] for radius,col in load_cols.items()},
+    }).sort_values([location_by,"time"],kind="stable",ignore_index=True)
+
 def match_data_by_station(
         aq_df,
         weather_df=None,
         traffic_df=None,
-    ) -> pd.DataFrame:
+        n_jobs=None,
+        executor="thread",
+    ) -> "MatchedGroups":
     '''
     Matches the data from air quality monitoring stations of the city of Madrid based on the air quality monitoring stations.
-    Returns a dictionary of pandas.Dataframes of the matched stations dataframes.
+    Returns a dictionary-like MatchedGroups of pandas.Dataframes of the matched stations dataframes.
     The keys of the dictionary are the names of the datasets of air quality monitoring stations.
+
+    aq_df is split by station and aligned with the times of weather_df in a single pass. The dataframe of each station
+    (interpolated and concatenated with its weather and traffic data) is only built when it is accessed.
+    The bitmask of the values interpolated in the data of each station is kept in df.attrs["imputed"] (indexed by time).
+    If n_jobs is given, all of them are built at once in a pool of n_jobs threads or processes (executor="thread" or "process").
     '''
-    aq_air_dfs = {}
-    # aq_station_datasets_names = {}
-    for estacion in aq_df.estacion.unique():
-        estacion_df = aq_df[aq_df.estacion==estacion].dropna(how="all",axis=1)\
-                        .set_index("time")\
-                            .interpolate(limit=6)
-        estacion_df.columns = estacion_df.columns.str.replace("µ","u")
-        if weather_df is not None:
-            weather_estacion_df = weather_df.set_index("time")
-            weather_estacion_df = weather_estacion_df.loc[weather_estacion_df.index.intersection(estacion_df.index)]
-            estacion_df = estacion_df.loc[weather_estacion_df.index]
-            weather_estacion_df = weather_estacion_df.loc[estacion_df.index]
-            # Create the dataset of integrated weather/air-quality data for the given station
-            estacion_df = pd.concat(
-                [estacion_df,weather_estacion_df],axis=1
-            ).rename_axis("time").reset_index().dropna(how='all',axis=1)
-        if traffic_df is not None:
-            traffic_estacion_df = traffic_df.set_index("time")
-            traffic_estacion_df = traffic_estacion_df.loc[traffic_estacion_df.index.intersection(estacion_df.index)]
-            estacion_df = estacion_df.loc[traffic_estacion_df.index]
-            traffic_estacion_df = traffic_estacion_df.loc[estacion_df.index]
-            # Create the dataset of integrated traffic/air-quality data for the given station
-            estacion_df = pd.concat([estacion_df,traffic_estacion_df],axis=1).rename_axis("time").reset_index()
-        aq_air_dfs[estacion] = estacion_df
-        # aq_station_datasets_names[estacion] = dataset_name
-    return aq_air_dfs
+    codes,stations = pd.factorize(aq_df.estacion)
+    groups = _group_positions(codes,len(stations))
+    weather_pairs = None
+    if weather_df is not None:
+        # Align all the rows with the weather data at once (pairs of rows in the order of weather_df)
+        weather_pos,aq_pos = _match_keys(*_time_keys(weather_df.time,aq_df.time))
+        weather_pairs = _split_pairs(codes[aq_pos],len(stations),weather_pos,aq_pos)
+        # Positions of each row within its station
+        local_pos = np.empty(len(aq_df),dtype=np.int64)
+        for positions in groups:
+            local_pos[positions] = np.arange(len(positions))
+    def get_args(i):
+        if weather_pairs is None:
+            return aq_df.iloc[groups[i]],None,None,traffic_df
+        weather_pos,aq_pos = weather_pairs[i]
+        return aq_df.iloc[groups[i]],weather_df.iloc[weather_pos],local_pos[aq_pos],traffic_df
+    matched = MatchedGroups(
+        dict(zip(stations,range(len(stations)))),
+        _match_station_frame,
+        get_args,
+    )
+    return matched.compute(n_jobs,executor) if n_jobs is not None else matched
 
 def match_data_by_zone(
         aq_df,
         weather_df=None,
         traffic_df=None,
-    ) -> pd.DataFrame:
+        n_jobs=None,
+        executor="thread",
+    ) -> "MatchedGroups":
     '''
     Matches the data from air quality monitoring stations with meteorological data of cities in Madrid 
     based on the zones of the city of Madrid where the air quality monitoring stations are located.
 
-    Returns a dictionary of pandas.Dataframes of the matched stations.
+    Returns a dictionary-like MatchedGroups of pandas.Dataframes of the matched stations.
     The keys of the dictionary are the names of the zones of the city of Madrid and the values are the
-    pandas.Dataframes of the matched stations.
+    pandas.Dataframes of the matched stations. As in match_data_by_station, the data is split and aligned
+    with weather_df in a single pass and the dataframe of each zone is only built when it is accessed.
     '''
-    weather_df = weather_df.set_index("time")
     aq_df.columns = aq_df.columns.str.replace("µ","u")
-    zones_dfs_dict = {}
-    for zone,zones in MADRID_AIR_QUALITY_ZONES.items():
-        zone_df = aq_df[aq_df.estacion.isin(zones)].set_index("time")
-        if weather_df is not None:
-            weather_zone_df = weather_df.loc[weather_df.index.intersection(zone_df.index)]
-            zone_df = zone_df.loc[weather_zone_df.index]
-            weather_zone_df = weather_zone_df.loc[zone_df.index]
-            # Create the dataset of integrated weather/air-quality data for the given zone
-            zone_df = pd.concat(
-                [zone_df,weather_zone_df],axis=1
-            ).rename_axis("time").reset_index().dropna(how='all',axis=1)
-        zones_dfs_dict[zone] = zone_df
-    return zones_dfs_dict
\ No newline at end of file
+    zones = list(MADRID_AIR_QUALITY_ZONES)
+    station_zones = {estacion:i for i,zone in enumerate(zones) for estacion in MADRID_AIR_QUALITY_ZONES[zone]}
+    codes = aq_df.estacion.map(station_zones).fillna(-1).values.astype(np.int64)
+    groups = _group_positions(codes,len(zones))
+    weather_pairs = None
+    if weather_df is not None:
+        weather_pos,aq_pos = _match_keys(*_time_keys(weather_df.time,aq_df.time))
+        weather_pairs = _split_pairs(codes[aq_pos],len(zones),weather_pos,aq_pos)
+    def get_args(i):
+        if weather_pairs is None:
+            return aq_df.iloc[groups[i]],None
+        weather_pos,aq_pos = weather_pairs[i]
+        return aq_df.iloc[aq_pos],weather_df.iloc[weather_pos]
+    matched = MatchedGroups(
+        dict(zip(zones,range(len(zones)))),
+        _match_zone_frame,
+        get_args,
+    )
+    return matched.compute(n_jobs,executor) if n_jobs is not None else matched
+
+class MatchedGroups(Mapping):
+    '''
+    Read-only dictionary of the matched dataframes of each group (station or zone) returned by
+    match_data_by_station and match_data_by_zone. The dataframe of a group is built with func(*get_args(i))
+    the first time it is accessed and kept afterwards, so only the groups used are ever copied.
+    '''
+    def __init__(self,groups:dict,func,get_args):
+        self._groups = groups
+        self._func = func
+        self._get_args = get_args
+        self._frames = {}
+
+    def __getitem__(self,key):
+        if key not in self._frames:
+            self._frames[key] = self._func(*self._get_args(self._groups[key]))
+        return self._frames[key]
+
+    def __iter__(self):
+        return iter(self._groups)
+
+    def __len__(self):
+        return len(self._groups)
+
+    def __repr__(self):
+        return f"MatchedGroups({list(self._groups)})"
+
+    def compute(self,n_jobs:int=None,executor:str="thread") -> "MatchedGroups":
+        '''
+        Builds the dataframes of all the groups not accessed yet in a pool of n_jobs
+        threads (executor="thread") or processes (executor="process"). Returns self.
+        '''
+        pending = [key for key in self._groups if key not in self._frames]
+        if not pending:
+            return self
+        if executor not in ("thread","process"):
+            raise ValueError(f"Unknown executor {executor}. Must be 'thread' or 'process'")
+        pool_class = ThreadPoolExecutor if executor=="thread" else ProcessPoolExecutor
+        with pool_class(max_workers=n_jobs) as pool:
+            futures = {key:pool.submit(self._func,*self._get_args(self._groups[key])) for key in pending}
+            for key,future in futures.items():
+                self._frames[key] = future.result()
+        return self
+
+def _group_positions(codes,n_groups):
+    # Positions of the rows of each group (in their original order) with a single stable sort
+    order = np.argsort(codes,kind="stable")
+    counts = np.bincount(codes[codes>=0],minlength=n_groups)
+    start = np.count_nonzero(codes<0)
+    return np.split(order[start:],np.cumsum(counts)[:-1])
+
+def _split_pairs(codes,n_groups,left_pos,right_pos):
+    # Splits matched pairs of positions by the group of each pair keeping their order
+    order = np.argsort(codes,kind="stable")
+    counts = np.bincount(codes[codes>=0],minlength=n_groups)
+    start = np.count_nonzero(codes<0)
+    splits = np.cumsum(counts)[:-1]
+    return list(zip(np.split(left_pos[order[start:]],splits),np.split(right_pos[order[start:]],splits)))
+
+def _match_station_frame(estacion_df,weather_df=None,local_pos=None,traffic_df=None):
+    estacion_df,imputed_df = fill_frame_gaps(
+        estacion_df.dropna(how="all",axis=1).set_index("time"),
+        limit=6
+    )
+    estacion_df.columns = estacion_df.columns.str.replace("µ","u")
+    imputed_df.columns = imputed_df.columns.str.replace("µ","u")
+    if weather_df is not None:
+        # Create the dataset of integrated weather/air-quality data for the given station
+        estacion_df = estacion_df.iloc[local_pos]
+        weather_df = weather_df.drop(columns="time")
+        weather_df.index = estacion_df.index
+        estacion_df = pd.concat(
+            [estacion_df,weather_df],axis=1
+        ).rename_axis("time").reset_index().dropna(how='all',axis=1)
+    if traffic_df is not None:
+        # Create the dataset of integrated traffic/air-quality data for the given station
+        estacion_df = _concat_on_time(estacion_df,traffic_df,order_by_other=True)
+        if "time" not in estacion_df.columns:
+            estacion_df = estacion_df.rename_axis("time").reset_index()
+        else:
+            estacion_df = estacion_df.reset_index(drop=True)
+    # Bitmask of the interpolated values of the station by time (see src.preprocessing.gap_filling)
+    estacion_df.attrs["imputed"] = imputed_df
+    return estacion_df
+
+def _match_zone_frame(zone_df,weather_df=None):
+    zone_df = zone_df.set_index("time")
+    if weather_df is not None:
+        # Create the dataset of integrated weather/air-quality data for the given zone
+        weather_df = weather_df.drop(columns="time")
+        weather_df.index = zone_df.index
+        zone_df = pd.concat(
+            [zone_df,weather_df],axis=1
+        ).rename_axis("time").reset_index().dropna(how='all',axis=1)
+    return zone_df
+
+def _meters(km_dist):
+    # Distance in whole meters for the column names (a "." would not allow attribute access to the columns)
+    return int(round(km_dist*1000))
@@ -0,0 +1,297 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import os, logging
+
+from .utils.memory import CATEGORICAL_COLUMNS, compact_dtypes
+
+logging.basicConfig()
+
+def write_partitioned_dataset(
+    df:pd.DataFrame,
+    root:str,
+    partition_by:tuple=("year","estacion"),
+    time_col:str="time",
+    basename_template:str=None,
+    ) -> str:
+    '''
+    Writes a pandas.DataFrame as a hive-partitioned parquet dataset (e.g: root/year=2019/estacion=Retiro/part-0.parquet)
+    so that it can be read back partially with read_dataset.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Dataframe to write.
+    root : str
+        Path to the root directory of the dataset (e.g: '../01-data/processed/air_quality_data.parquet').
+    partition_by : tuple, optional
+        Columns to partition the dataset by. The "year" column is derived from time_col
+        if it is not in the dataframe. Partition columns not present in the dataframe are ignored.
+    time_col : str, optional
+        Name of the column with the timestamps of the measurements.
+        Rows are sorted by it inside each partition so that parquet row-group statistics can be used to skip data.
+    basename_template : str, optional
+        Template of the names of the files written (must contain "{i}").
+        Use a different template to add new files to an existing dataset without overwriting it.
+
+    Returns
+    -------
+    str
+        Path to the root directory of the dataset.
+    '''
+    df = df.copy()
+    if "year" in partition_by and "year" not in df.columns:
+        df["year"] = df[time_col].dt.year
+    partition_by = [col for col in partition_by if col in df.columns]
+    df = df.sort_values([*partition_by,time_col] if time_col in df.columns else partition_by,kind="stable")
+    table = pa.Table.from_pandas(df,preserve_index=False)
+    partitioning = ds.partitioning(
+        pa.schema([table.schema.field(col) for col in partition_by]),
+        flavor="hive"
+    )
+    ds.write_dataset(
+        table,
+        root,
+        format="parquet",
+        partitioning=partitioning,
+        basename_template=basename_template or "part-{i}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+    # Files are written inside the partition directories, touch the root so that its mtime reflects the change
+    os.utime(root)
+    return root
+
+def append_partitioned_dataset(
+    df:pd.DataFrame,
+    root:str,
+    partition_by:tuple=("year","estacion"),
+    time_col:str="time",
+    ) -> str:
+    '''
+    Appends the rows of a pandas.DataFrame to a partitioned parquet dataset (as written by write_partitioned_dataset)
+    as new files with a unique name, so that the files already in the dataset are neither read nor rewritten.
+    The columns of df are aligned to the schema of the existing dataset (missing columns are filled with nulls).
+    If the dataset does not exist it is created.
+    '''
+    if os.path.isdir(root):
+        schema = ds.dataset(root,format="parquet",partitioning="hive").schema
+        columns = [col["name"] for col in schema.pandas_metadata["columns"]] if schema.pandas_metadata else schema.names
+        columns = [col for col in columns if col!="year" or "year" in df.columns]
+        extra_columns = [col for col in df.columns if col not in columns]
+        if extra_columns:
+            logging.warning(f"Columns {extra_columns} are not in the dataset {root}. They will not be appended")
+        df = df.reindex(columns=columns)
+    basename_template = "part-" + pd.Timestamp.now().strftime("%Y%m%d%H%M%S%f") + "-{i}.parquet"
+    return write_partitioned_dataset(df,root,partition_by=partition_by,time_col=time_col,basename_template=basename_template)
+
+def dataset_time_range(path:str,time_col:str="time") -> tuple:
+    '''
+    Returns the (min,max) timestamps of time_col in a feather file or partitioned parquet dataset reading only that column.
+    '''
+    try:
+        if os.path.isdir(path):
+            dataset = ds.dataset(path,format="parquet",partitioning="hive")
+        else:
+            dataset = ds.dataset(path,format="feather")
+        min_max = pc.min_max(dataset.to_table(columns=[time_col])[time_col]).as_py()
+        return pd.Timestamp(min_max["min"]),pd.Timestamp(min_max["max"])
+    except pa.ArrowInvalid:
+        times = pd.read_feather(path,columns=[time_col])[time_col]
+        return times.min(),times.max()
+
+def partition_feather_dataset(
+    fpath:str,
+    root:str=None,
+    partition_by:tuple=("year","estacion"),
+    time_col:str="time",
+    ) -> str:
+    '''
+    Converts a feather file of this project (e.g: air_quality_data.feather) into a partitioned parquet dataset
+    stored next to it with the same name and the .parquet extension (e.g: air_quality_data.parquet/).
+    The loaders in src.get_data use the partitioned dataset instead of the feather file when it is available.
+
+    e.g: partition_feather_dataset('../01-data/processed/traffic_data.feather',partition_by=("year",),time_col="fecha")
+    '''
+    if root is None:
+        root = os.path.splitext(fpath)[0] + ".parquet"
+    df = pd.read_feather(fpath)
+    return write_partitioned_dataset(df,root,partition_by=partition_by,time_col=time_col)
+
+def read_dataset(
+    path:str,
+    start=None,
+    end=None,
+    stations=None,
+    columns=None,
+    time_col:str="time",
+    station_col:str="estacion",
+    compact:bool=False,
+    int_time:bool=False,
+    row_filter:ds.Expression=None,
+    batch_size:int=None,
+    ) -> pd.DataFrame:
+    '''
+    Reads a feather file or a partitioned parquet dataset (as written by write_partitioned_dataset)
+    pushing the time, station and column selection down to the read so that only
+    the partitions, row groups and columns needed are loaded into memory.
+
+    Parameters
+    ----------
+    path : str
+        Path to a .feather file or to the root directory of a partitioned dataset.
+    start,end : str or datetime.datetime, optional
+        Only rows with start <= time_col <= end are read.
+    stations : str or list, optional
+        Only rows whose station_col is one of these values are read.
+    columns : list, optional
+        Columns to read. The time and station columns are always included.
+    time_col,station_col : str, optional
+        Names of the time and station columns of the dataset.
+    compact : bool, optional
+        If True, the data is converted batch by batch while it is read to float32 measurements
+        and categorical station, zone and sensor columns (see src.utils.compact_dtypes),
+        so that the full float64 data is never held in memory.
+    int_time : bool, optional
+        If True (and compact is True), time_col is encoded as int32 hours since 1970-01-01.
+    row_filter : pyarrow.dataset.Expression, optional
+        Extra condition that the rows must meet, evaluated batch by batch while reading.
+        It can use columns that are not read, e.g: (ds.field("intensidad")+ds.field("ocupacion"))>=0
+    batch_size : int, optional
+        Maximum number of rows of the record batches scanned at once (defaults to arrow's).
+
+    Returns
+    -------
+    pandas.DataFrame
+    '''
+    if os.path.isdir(path):
+        dataset = ds.dataset(path,format="parquet",partitioning=ds.HivePartitioning.discover(infer_dictionary=True))
+    else:
+        try:
+            dataset = ds.dataset(path,format="feather")
+        except pa.ArrowInvalid:
+            # Feather V1 files can not be scanned by arrow, filter them in memory instead
+            logging.warning(f"Could not scan {path} as an arrow dataset. Reading it fully into memory")
+            df = pd.read_feather(path)
+            if row_filter is not None:
+                df = ds.dataset(pa.Table.from_pandas(df,preserve_index=False)).to_table(filter=row_filter).to_pandas()
+            df = _filter_frame(df,start,end,stations,columns,time_col,station_col)
+            return compact_dtypes(df,int_time=int_time,time_col=time_col,copy=False) if compact else df
+    schema = dataset.schema
+    filter = row_filter
+    if time_col in schema.names:
+        time_type = schema.field(time_col).type
+        if start is not None:
+            filter = _and(filter,ds.field(time_col)>=pa.scalar(pd.Timestamp(start).to_datetime64(),type=time_type))
+        if end is not None:
+            filter = _and(filter,ds.field(time_col)<=pa.scalar(pd.Timestamp(end).to_datetime64(),type=time_type))
+        # The year partitions are pruned with their own expression since arrow can not infer them from time_col
+        if "year" in schema.names and "year" not in (columns or []) and (start is not None or end is not None):
+            if start is not None:
+                filter = _and(filter,ds.field("year")>=pd.Timestamp(start).year)
+            if end is not None:
+                filter = _and(filter,ds.field("year")<=pd.Timestamp(end).year)
+    if stations is not None and station_col in schema.names:
+        if isinstance(stations,(str,int)):
+            stations = [stations]
+        filter = _and(filter,ds.field(station_col).isin(list(stations)))
+    keep_order = columns is None
+    if columns is not None:
+        columns = [col for col in [time_col,station_col] if col in schema.names and col not in columns] + list(columns)
+    elif "year" in schema.names and os.path.isdir(path):
+        # Do not return the partition column derived from the time column
+        columns = [col for col in schema.names if col!="year"]
+    scan_kwargs = {} if batch_size is None else {"batch_size":batch_size}
+    if compact:
+        batches = [_compact_batch(batch) for batch in dataset.to_batches(columns=columns,filter=filter,**scan_kwargs)]
+        if batches:
+            table = pa.Table.from_batches(batches).unify_dictionaries()
+        else:
+            table = _compact_batch(dataset.to_table(columns=columns,filter=filter))
+    else:
+        table = dataset.to_table(columns=columns,filter=filter,**scan_kwargs)
+    df = table.to_pandas()
+    if compact:
+        # Dictionaries are in order of appearance, sort the categories so that rows are sorted as without compact
+        for col in df.columns[df.dtypes=="category"]:
+            df[col] = df[col].cat.set_categories(sorted(df[col].cat.categories))
+    if os.path.isdir(path):
+        # Partition columns are read as categoricals, restore them and the time order of the rows
+        if not compact:
+            for col in df.columns[df.dtypes=="category"]:
+                df[col] = df[col].astype(df[col].cat.categories.dtype)
+        # Partition columns are appended at the end by arrow, restore the original order of the columns
+        if keep_order and schema.pandas_metadata is not None:
+            original_order = [col["name"] for col in schema.pandas_metadata["columns"]]
+            df = df.loc[:,sorted(df.columns,key=lambda col: original_order.index(col) if col in original_order else len(original_order))]
+        sort_cols = [col for col in [time_col,station_col] if col in df.columns]
+        if sort_cols:
+            df = df.sort_values(sort_cols,kind="stable").reset_index(drop=True)
+    if compact:
+        # Integer downcasts and int_time are done column by column on the frame read (without copying it whole)
+        df = compact_dtypes(df,int_time=int_time,time_col=time_col,copy=False)
+    return df
+
+def write_ipc_file(df:pd.DataFrame,fpath:str) -> str:
+    '''
+    Writes a pandas.DataFrame as an uncompressed Arrow IPC file that can be memory-mapped with read_memory_mapped.
+    Missing values of float columns are stored as NaN instead of nulls so that they can be read without copies.
+    The file is written to a temporary path first so that concurrent readers never see a partial file.
+    '''
+    df = df.reset_index(drop=True)
+    table = pa.Table.from_pandas(df,preserve_index=False)
+    for i,col in enumerate(table.schema.names):
+        if pd.api.types.is_float_dtype(df[col].dtype):
+            table = table.set_column(i,col,pa.array(df[col].to_numpy(),from_pandas=False))
+    os.makedirs(os.path.dirname(fpath) or ".",exist_ok=True)
+    tmp_fpath = f"{fpath}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_fpath,"wb") as sink:
+        with pa.ipc.new_file(sink,table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_fpath,fpath)
+    return fpath
+
+def read_memory_mapped(fpath:str,columns:list=None) -> pd.DataFrame:
+    '''
+    Reads an Arrow IPC file written with write_ipc_file by memory-mapping it.
+    Numeric and datetime columns are not copied: the dataframe is built on top of the mapped pages, 
+    so processes that read the same file share a single copy of the data in the page cache.
+    String columns are copied (use categoricals to keep them small) and operations that modify the dataframe 
+    in place or consolidate its blocks will copy the data as usual.
+    '''
+    source = pa.memory_map(fpath,"r")
+    table = pa.ipc.open_file(source).read_all()
+    if columns is not None:
+        table = table.select(list(columns))
+    return table.to_pandas(split_blocks=True)
+
+def _compact_batch(batch):
+    arrays = []
+    for name,array in zip(batch.schema.names,batch.columns):
+        if name in CATEGORICAL_COLUMNS and (pa.types.is_string(array.type) or pa.types.is_large_string(array.type)):
+            array = pc.dictionary_encode(array)
+        elif pa.types.is_float64(array.type):
+            array = pc.cast(array,pa.float32())
+        arrays.append(array)
+    return type(batch).from_arrays(arrays,names=batch.schema.names)
+
+def _and(filter,expression):
+    return expression if filter is None else filter & expression
+
+def _filter_frame(df,start,end,stations,columns,time_col,station_col):
+    if start is not None:
+        df = df[df[time_col]>=_time_bound(df[time_col],start)]
+    if end is not None:
+        df = df[df[time_col]<=_time_bound(df[time_col],end)]
+    if stations is not None:
+        stations = [stations] if isinstance(stations,(str,int)) else list(stations)
+        df = df[df[station_col].isin(stations)]
+    if columns is not None:
+        df = df.loc[:,[col for col in [time_col,station_col] if col in df.columns and col not in columns] + list(columns)]
+    return df.reset_index(drop=True)
+
+def _time_bound(times,value):
+    # Times encoded as integer hours since 1970-01-01 (see src.utils.compact_dtypes)
+    if pd.api.types.is_integer_dtype(times.dtype):
+        return pd.Timestamp(value).value//(3600*10**9)
+    return pd.Timestamp(value)
@@ -1 +1,4 @@
-from .extract_traffic_locations_raw import extract_traffic_locations_raw
\ No newline at end of file
+from .extract_traffic_locations_raw import extract_traffic_locations_raw
+from .ingest_air_quality_zips import ingest_air_quality_zips
+from .aggregate_traffic_files import aggregate_traffic_files
+from .http_cache import download_cached
@@ -0,0 +1,148 @@
+import zipfile, glob, os, io
+
+import pandas as pd
+
+from fastprogress import progress_bar
+
+from ..data_store import write_partitioned_dataset
+
+TRAFFIC_MEASUREMENTS = ("intensidad","ocupacion","carga")
+
+def aggregate_traffic_files(
+    files_dir:str,
+    root:str,
+    pattern:str="*.csv",
+    columns:tuple=TRAFFIC_MEASUREMENTS,
+    freq:str="60min",
+    chunksize:int=500_000,
+    max_partial_rows:int=2_000_000,
+    locations_df:pd.DataFrame=None,
+    ) -> str:
+    '''
+    Aggregates the raw traffic data of the Ayuntamiento de Madrid (monthly csv files with one row per measurement point
+    every 15 minutes, as downloaded from datos.madrid.es, or zips of them) into the mean of each measurement point
+    every freq (hourly by default) and writes it to a parquet dataset partitioned by year (see src.data_store.read_dataset).
+    The raw files only identify each measurement point by its id, the nombre and cod_cent of each point (the columns
+    used by src.get_data.get_traffic_df) are joined from locations_df as in notebooks/04-traffic_postprocessing.ipynb.
+    If locations_df is not given, those columns are left empty and have to be joined to the dataset afterwards.
+
+    Only the rows with a valid date and intensidad+ocupacion>=0 are aggregated (as in src.get_data.get_traffic_df).
+    Each file is read in chunks of chunksize rows and every chunk is reduced to the sum and the number of non-null
+    values of each measurement by point and hour. These running sums are merged as the file is read
+    (whenever max_partial_rows new rows were added to them), and once the file is read the hourly means are written to the dataset,
+    so the memory used depends on chunksize and the points and hours of a single file, not on the number of files.
+    Aggregating the same files again overwrites the files written before.
+
+    Parameters
+    ----------
+    files_dir : str
+        Directory with the raw files (e.g: '../00-rawdata/Ayto Madrid/Trafico').
+    root : str
+        Path to the root directory of the dataset (e.g: '../01-data/interim/traffic_hourly.parquet').
+    pattern : str, optional
+        Glob pattern of the names of the files in files_dir (.csv files or .zip files with csv files inside).
+    columns : tuple, optional
+        Measurements to aggregate.
+    freq : str, optional
+        Frequency of the aggregated data (any pandas frequency).
+    chunksize : int, optional
+        Number of raw rows read at once.
+    max_partial_rows : int, optional
+        Maximum number of rows of running sums added before merging them.
+    locations_df : pandas.DataFrame, optional
+        Traffic measurement points with the columns id, cod_cent and nombre
+        (e.g: the data of '../01-data/raw/ubicaciones.xlsx' or of src.extraction.extract_traffic_locations_raw).
+
+    Returns
+    -------
+    str
+        Path to the root directory of the dataset.
+    '''
+    columns = list(columns)
+    point_names = _point_names(locations_df)
+    fpaths = sorted(glob.glob(os.path.join(files_dir,pattern)))
+    print(f"{len(fpaths)} ficheros contienen datos de trafico")
+    num_rows = 0
+    num_hourly_rows = 0
+    for fpath in progress_bar(fpaths):
+        name = os.path.splitext(os.path.basename(fpath))[0].replace(' ','_')
+        for member_idx,(open_file,chunks) in enumerate(_raw_traffic_chunks(fpath,chunksize)):
+            partials,partial_rows,merge_rows = [],0,max_partial_rows
+            with open_file:
+                for df in chunks:
+                    num_rows += len(df)
+                    partials.append(_traffic_sums(df,columns,freq))
+                    partial_rows += len(partials[-1])
+                    # The merged sums keep growing with the file, so they are merged again only after max_partial_rows new rows
+                    if partial_rows>merge_rows:
+                        partials = [_merge_sums(partials)]
+                        partial_rows = len(partials[0])
+                        merge_rows = partial_rows + max_partial_rows
+            if not partials:
+                continue
+            sums = _merge_sums(partials)
+            counts = sums[[f"{col}_count" for col in columns]].values
+            hourly_df = (sums[columns]/counts).where(counts>0).reset_index()
+            hourly_df = hourly_df.join(point_names,on="id")[["fecha","nombre","cod_cent","id"]+columns]
+            write_partitioned_dataset(
+                hourly_df,
+                root,
+                partition_by=("year",),
+                time_col="fecha",
+                basename_template=f"{name}-{member_idx}-{{i}}.parquet",
+            )
+            num_hourly_rows += len(hourly_df)
+    print(f"{num_rows} observaciones agregadas en {num_hourly_rows} en total en {root}")
+    return root
+
+def _point_names(locations_df):
+    # nombre and cod_cent of each point id (a missing nombre is its cod_cent and viceversa, as in notebook 04)
+    if locations_df is None:
+        return pd.DataFrame({"nombre":pd.Series(dtype=object),"cod_cent":pd.Series(dtype=object)},index=pd.Index([],dtype="int64",name="id"))
+    locations_df = locations_df[["id","cod_cent","nombre"]].copy()
+    locations_df["id"] = pd.to_numeric(locations_df["id"],errors="coerce")
+    locations_df = locations_df.dropna(subset=["id"]).astype({"id":"int64"}).drop_duplicates(subset="id")
+    nombre = locations_df["nombre"].fillna(locations_df["cod_cent"])
+    cod_cent = locations_df["cod_cent"].fillna(locations_df["nombre"])
+    return pd.DataFrame({
+        "nombre":nombre.where(nombre.isna(),nombre.astype(str)),
+        "cod_cent":cod_cent.where(cod_cent.isna(),cod_cent.astype(str)),
+    }).set_index(locations_df["id"])
+
+def _raw_traffic_chunks(fpath,chunksize):
+    # Yields the (open file,chunks) of each csv in fpath (a csv or a zip of csv files)
+    if fpath.endswith(".zip"):
+        with zipfile.ZipFile(fpath) as z:
+            for filename in z.namelist():
+                if filename.endswith('.csv'):
+                    f = io.TextIOWrapper(z.open(filename),encoding="latin-1")
+                    yield f,_read_csv_chunks(f,chunksize)
+    else:
+        f = open(fpath,encoding="latin-1")
+        yield f,_read_csv_chunks(f,chunksize)
+
+def _read_csv_chunks(f,chunksize):
+    # Some monthly files are separated by commas instead of semicolons
+    header = f.readline()
+    sep = ';' if ';' in header else ','
+    names = [col.strip().strip('"') for col in header.strip().split(sep)]
+    return pd.read_csv(f,sep=sep,decimal=',' if sep==';' else '.',names=names,header=None,chunksize=chunksize)
+
+def _traffic_sums(df,columns,freq):
+    # Sum and number of non-null values of the measurements of each point by period of time
+    df = df.rename(columns={"idelem":"id"})
+    fecha = pd.to_datetime(df["fecha"],errors="coerce").dt.floor(freq)
+    point = pd.to_numeric(df["id"],errors="coerce")
+    values = df.reindex(columns=columns).apply(pd.to_numeric,errors="coerce")
+    # Same validity filter as src.get_data.get_traffic_df (negative values are errors of the sensors)
+    measures = df.reindex(columns=["intensidad","ocupacion"]).apply(pd.to_numeric,errors="coerce")
+    valid = fecha.notna() & point.notna() & ((measures["intensidad"]+measures["ocupacion"])>=0)
+    keys = [fecha[valid].rename("fecha"),point[valid].astype("int64").rename("id")]
+    values = values[valid]
+    return pd.concat([
+        values.groupby(keys).sum(),
+        values.notna().groupby(keys).sum().add_suffix("_count"),
+    ],axis=1)
+
+def _merge_sums(partials):
+    return pd.concat(partials).groupby(level=["fecha","id"]).sum()
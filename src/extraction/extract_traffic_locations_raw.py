@@ -1,28 +1,31 @@
-import requests, zipfile, io
-import os
+import zipfile, io, struct
 
+import numpy as np
 import pandas as pd
 
 from fastprogress import progress_bar
-from simpledbf import Dbf5
 
 from ..constants import pmed_ubicaciones_source_str
 from ..utils import get_year_from_str
+from .http_cache import download_all
 
-def extract_traffic_locations_raw():
+def extract_traffic_locations_raw(urls:list=None,cache_dir:str=None,n_jobs:int=8):
     '''
     Retrieves the raw data containing the locations of the traffic measurement stations in the city of Madrid directly from datos.madrid.es webpage and returns it as a pandas.DataFrame.
+
+    The zips are downloaded concurrently in a pool of n_jobs threads. If cache_dir is given, they are
+    cached in it and only downloaded again if they changed in the server (see src.extraction.http_cache.download_cached).
+    urls defaults to the zips listed in src.constants.pmed_ubicaciones_source_str.
     '''
-    url_ficheros = [w for w in pmed_ubicaciones_source_str.split(' ') if w.startswith('https://') and w.endswith('.zip')]
+    url_ficheros = [w for w in pmed_ubicaciones_source_str.split(' ') if w.startswith('https://') and w.endswith('.zip')] if urls is None else list(urls)
     trafico_locations_dfs = []
     print(f"Intentando obtener datos de puntos de medida de trafico desde sus ficheros en https://datos.madrid.es. Esto podria demorarse un rato...")
     filecount = 0
-    for url in progress_bar(url_ficheros):
-        resp = requests.get(url)
-        if not resp.ok:
+    for url,content in progress_bar(download_all(url_ficheros,cache_dir=cache_dir,n_jobs=n_jobs),total=len(url_ficheros)):
+        if content is None:
             print(f"Request failed for url {url}")
             continue
-        z = zipfile.ZipFile(io.BytesIO(resp.content))
+        z = zipfile.ZipFile(io.BytesIO(content))
         files = [f.filename for f in z.filelist]
         ffound = 0
         for filename in files:
@@ -31,9 +34,7 @@ def extract_traffic_locations_raw():
             elif filename.endswith('.xlsx'):
                 df = pd.read_excel(z.open(filename))
             elif filename.endswith('.dbf'):
-                extracted_path = z.extract(filename)
-                df = Dbf5(filename,codec='latin-1').to_dataframe()
-                os.remove(filename)
+                df = read_dbf(z.read(filename),codec='latin-1')
             else:
                 continue
             df.columns = df.columns.str.lower()
@@ -54,4 +55,38 @@ def extract_traffic_locations_raw():
     pmed_ubicaciones_raw = pmed_ubicaciones_raw.astype(dict(x=float,y=float,st_x=float,st_y=float,year=int,tipo_elem=str))
     
     return pmed_ubicaciones_raw 
-    # pmed_ubicaciones_raw.to_feather('../01-data/interim/pmed_ubicaciones_raw.feather')
\ No newline at end of file
+    # pmed_ubicaciones_raw.to_feather('../01-data/interim/pmed_ubicaciones_raw.feather')
+
+def read_dbf(content:bytes,codec:str='latin-1') -> pd.DataFrame:
+    '''
+    Parses the content of a dBase (.dbf) file in memory and returns its records (except the deleted ones) as a pandas.DataFrame.
+    Numeric fields are returned as numbers (NaN if empty), dates as datetimes, logical fields as booleans, and the rest as stripped strings.
+    '''
+    num_records,header_len,record_len = struct.unpack('<IHH',content[4:12])
+    fields = []
+    pos = 32
+    while content[pos:pos+1] not in (b'\r',b''):
+        name = content[pos:pos+11].split(b'\x00')[0].decode(codec)
+        fields.append((name,content[pos+11:pos+12].decode('ascii'),content[pos+16]))
+        pos += 32
+    # Each record is a deletion flag followed by the fixed-width fields
+    lengths = [1]+[length for _,_,length in fields]
+    dtype = np.dtype({
+        'names': ['deleted']+[f'f{i}' for i in range(len(fields))],
+        'formats': [f'S{length}' for length in lengths],
+        'offsets': np.cumsum([0]+lengths[:-1]).tolist(),
+        'itemsize': record_len,
+    })
+    records = np.frombuffer(content,dtype=dtype,count=num_records,offset=header_len)
+    records = records[records['deleted']!=b'*']
+    data = {}
+    for i,(name,field_type,_) in enumerate(fields):
+        values = pd.Series(records[f'f{i}']).str.decode(codec).str.strip()
+        if field_type in ('N','F'):
+            values = pd.to_numeric(values.replace('',np.nan),errors='coerce')
+        elif field_type=='D':
+            values = pd.to_datetime(values,format='%Y%m%d',errors='coerce')
+        elif field_type=='L':
+            values = values.str.upper().map({'T':True,'Y':True,'F':False,'N':False})
+        data[name] = values.values
+    return pd.DataFrame(data,columns=[name for name,_,_ in fields])
@@ -0,0 +1,79 @@
+import requests
+import os, json, hashlib, logging, time
+
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig()
+
+def download_cached(url:str,cache_dir:str=None,timeout:float=60,max_age:float=24*3600) -> bytes:
+    '''
+    Downloads the content of url and returns it as bytes (or None if the request failed).
+
+    If cache_dir is given, the content is stored in it together with the ETag and Last-Modified headers of the response.
+    Later downloads of the same url send them back (If-None-Match/If-Modified-Since) so that the content
+    is read from the cache when the server answers that it has not changed (304) instead of fetching it again.
+    If the server sends neither header, the cached content is used without any request for max_age seconds
+    and downloaded again after that (the cached file is only rewritten if its content changed).
+    The cached content is also used if the server can not be reached.
+    '''
+    cache_path = None
+    cached_headers = {}
+    headers = {}
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir,hashlib.sha256(url.encode()).hexdigest()[:32])
+        if os.path.isfile(cache_path) and os.path.isfile(cache_path+".json"):
+            with open(cache_path+".json") as f:
+                cached_headers = json.load(f)
+            if cached_headers.get("etag"):
+                headers["If-None-Match"] = cached_headers["etag"]
+            if cached_headers.get("last_modified"):
+                headers["If-Modified-Since"] = cached_headers["last_modified"]
+            if not headers and time.time()-cached_headers.get("fetched_at",0)<max_age:
+                # The server can not tell if it changed, so it is trusted until it is max_age seconds old
+                with open(cache_path,"rb") as f:
+                    return f.read()
+    try:
+        resp = requests.get(url,headers=headers,timeout=timeout)
+    except requests.RequestException as err:
+        logging.warning(f"Request failed for url {url}: {err}")
+        resp = None
+    if resp is not None and resp.status_code==304:
+        with open(cache_path,"rb") as f:
+            return f.read()
+    if resp is None or not resp.ok:
+        if resp is not None:
+            logging.warning(f"Request failed for url {url} with status {resp.status_code}")
+        if cache_path is not None and os.path.isfile(cache_path):
+            logging.warning(f"Using the cached content of {url}")
+            with open(cache_path,"rb") as f:
+                return f.read()
+        return None
+    if cache_path is not None:
+        sha256 = hashlib.sha256(resp.content).hexdigest()
+        # Written to temporary files first so that a concurrent reader never sees a partial file
+        os.makedirs(cache_dir,exist_ok=True)
+        tmp_suffix = f".{os.getpid()}.tmp"
+        if sha256!=cached_headers.get("sha256") or not os.path.isfile(cache_path):
+            with open(cache_path+tmp_suffix,"wb") as f:
+                f.write(resp.content)
+            os.replace(cache_path+tmp_suffix,cache_path)
+        with open(cache_path+".json"+tmp_suffix,"w") as f:
+            json.dump({
+                "url":url,
+                "etag":resp.headers.get("ETag"),
+                "last_modified":resp.headers.get("Last-Modified"),
+                "sha256":sha256,
+                "fetched_at":time.time(),
+            },f)
+        os.replace(cache_path+".json"+tmp_suffix,cache_path+".json")
+    return resp.content
+
+def download_all(urls:list,cache_dir:str=None,n_jobs:int=8,timeout:float=60,max_age:float=24*3600):
+    '''
+    Downloads the urls with download_cached in a pool of n_jobs threads.
+    Yields the (url,content) of each url in the same order as urls as soon as it is available.
+    '''
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [pool.submit(download_cached,url,cache_dir,timeout,max_age) for url in urls]
+        for url,future in zip(urls,futures):
+            yield url,future.result()
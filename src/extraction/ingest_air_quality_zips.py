@@ -0,0 +1,93 @@
+import zipfile, glob, os
+
+import pandas as pd
+
+from fastprogress import progress_bar
+
+from ..constants import indicators_code_dict
+from ..preprocessing.preprocess_utils import preprocess_madrid_aq_data
+from ..data_store import write_partitioned_dataset
+
+ID_COLS = ['PROVINCIA','MUNICIPIO','ESTACION']
+
+def ingest_air_quality_zips(
+    zips_dir:str,
+    root:str,
+    parameters_dict:dict=None,
+    pattern:str="Anio*.zip",
+    chunksize:int=100_000,
+    ) -> str:
+    '''
+    Ingests the yearly zips of raw hourly air quality data of the Ayuntamiento de Madrid (as downloaded from datos.madrid.es)
+    from a local directory into a partitioned parquet dataset (partitioned by year and station, see src.data_store.read_dataset).
+
+    Each csv of each zip is read in chunks of chunksize rows, every chunk is preprocessed with
+    src.preprocessing.preprocess_madrid_aq_data and written straight to the dataset, so the memory used
+    depends on chunksize and not on the number of years ingested. The rows of the last station of a chunk
+    are carried over to the next one so that every (fecha,estacion) row is complete
+    (the csv files list the data station by station).
+    Ingesting the same zips again overwrites the files written before.
+
+    Parameters
+    ----------
+    zips_dir : str
+        Directory with the zips (e.g: '../00-rawdata/Ayto Madrid').
+    root : str
+        Path to the root directory of the dataset (e.g: '../01-data/interim/aq_ayto_madrid.parquet').
+    parameters_dict : dict, optional
+        Table of indicators by code of magnitude. Defaults to src.constants.indicators_code_dict.
+    pattern : str, optional
+        Glob pattern of the names of the zips in zips_dir.
+    chunksize : int, optional
+        Number of raw rows (one per station, magnitude and day) read at once.
+
+    Returns
+    -------
+    str
+        Path to the root directory of the dataset.
+    '''
+    parameters_dict = indicators_code_dict if parameters_dict is None else parameters_dict
+    # All the chunks are written with the same columns, whatever parameters they contain
+    parametros = sorted({
+        (indicator['parametro']+' ('+indicator['unidad']+')').lower()
+        for indicator in parameters_dict.values()
+    })
+    zips = sorted(glob.glob(os.path.join(zips_dir,pattern)))
+    print(f"{len(zips)} carpetas comprimidas contienen datos de calidad de aire")
+    num_rows = 0
+    num_files = 0
+    for zip_path in progress_bar(zips):
+        zip_name = os.path.splitext(os.path.basename(zip_path))[0].replace(' ','_')
+        with zipfile.ZipFile(zip_path) as z:
+            members = [f for f in z.namelist() if f.endswith('.csv')]
+            for member_idx,filename in enumerate(members):
+                chunk_idx = 0
+                for df in _read_station_chunks(z,filename,chunksize):
+                    df = preprocess_madrid_aq_data(df,parameters_dict)
+                    df = df.reindex(columns=['fecha','provincia','municipio','estacion']+parametros)
+                    write_partitioned_dataset(
+                        df,
+                        root,
+                        partition_by=("year","estacion"),
+                        time_col="fecha",
+                        basename_template=f"{zip_name}-{member_idx}-{chunk_idx}-{{i}}.parquet",
+                    )
+                    num_rows += len(df)
+                    chunk_idx += 1
+                num_files += 1
+    print(f"{num_files} csv ingeridos con {num_rows} observaciones en total en {root}")
+    return root
+
+def _read_station_chunks(z,filename,chunksize):
+    # Yields chunks of the csv that contain all the rows of each of their stations
+    carry = None
+    for df in pd.read_csv(z.open(filename),sep=';',decimal=',',chunksize=chunksize):
+        if carry is not None:
+            df = pd.concat([carry,df],ignore_index=True)
+        last_station = (df[ID_COLS]==df[ID_COLS].iloc[-1]).all(axis=1)
+        carry = df[last_station]
+        df = df[~last_station]
+        if len(df):
+            yield df
+    if carry is not None and len(carry):
+        yield carry
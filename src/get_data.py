@@ -1,13 +1,66 @@
 import pandas as pd
-from functools import lru_cache
-import glob, os, logging, difflib
+import pyarrow.dataset as ds
+from functools import lru_cache, wraps
+import os, logging, difflib
 
-from .preprocessing import clean_traffic_locations_raw
-from .data_matching import match_data
+from .preprocessing import clean_traffic_locations_raw, TrafficSensorIndex
+from .data_matching import match_data, get_nearby_traffic_features
+from .data_store import read_dataset, write_ipc_file, read_memory_mapped, append_partitioned_dataset, partition_feather_dataset, dataset_time_range, _filter_frame
+from .data_catalog import find_dataset, get_dataset_hash, CACHE_DIRNAME
+from .data_cache import make_cache_key, load_cached_frame, save_cached_frame, frame_hash
 from .extraction import extract_traffic_locations_raw
 from .constants import MADRID_AIR_QUALITY_ZONES
+from .utils import compact_dtypes
 logging.basicConfig()
 
+def lru_cache_lists(func):
+    '''
+    Same as functools.lru_cache but list arguments (e.g: stations=["Retiro","Moratalaz"]) are
+    converted to tuples so that they can be used as part of the key of the cache.
+    '''
+    cached_func = lru_cache(func)
+    @wraps(func)
+    def wrapper(*args,**kwargs):
+        args = tuple(tuple(arg) if isinstance(arg,list) else arg for arg in args)
+        kwargs = {key:tuple(arg) if isinstance(arg,list) else arg for key,arg in kwargs.items()}
+        return cached_func(*args,**kwargs)
+    wrapper.cache_clear = cached_func.cache_clear
+    wrapper.cache_info = cached_func.cache_info
+    return wrapper
+
+def _read_memory_mapped_dataset(data_dir,name,fpath,start,end,stations,columns,compact,int_time):
+    '''
+    Memory-maps the version of the dataset kept in the .cache/mmap directory that matches the current content of fpath,
+    writing it first if no process has done so yet. The filters are applied after mapping the data (copying only the rows selected).
+    '''
+    if _is_dataset_path(data_dir):
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(fpath)),CACHE_DIRNAME)
+        stat = os.stat(fpath)
+        key = make_cache_key(os.path.abspath(fpath),stat.st_size,stat.st_mtime_ns)
+    else:
+        cache_dir = os.path.join(data_dir,CACHE_DIRNAME)
+        key = get_dataset_hash(data_dir,name)
+    flags = ("-compact" if compact else "") + ("-int_time" if compact and int_time else "")
+    mmap_fpath = os.path.join(cache_dir,"mmap",f"{name}{flags}-{key[:16]}.arrow")
+    if not os.path.isfile(mmap_fpath):
+        write_ipc_file(read_dataset(fpath,compact=compact,int_time=int_time),mmap_fpath)
+    df = read_memory_mapped(mmap_fpath)
+    if any(arg is not None for arg in [start,end,stations,columns]):
+        df = _filter_frame(df,start,end,stations,columns,"time","estacion")
+    return df
+
+def _memory_map_frame(df,cache_dir,name):
+    '''
+    Memory-maps a copy of df kept in cache_dir/mmap under the hash of its content, writing it first if it does not exist yet.
+    '''
+    mmap_fpath = os.path.join(cache_dir,"mmap",f"{name}-{frame_hash(df)[:16]}.arrow")
+    if not os.path.isfile(mmap_fpath):
+        write_ipc_file(df,mmap_fpath)
+    return read_memory_mapped(mmap_fpath)
+
+def _is_dataset_path(path):
+    return os.path.isfile(path) or (os.path.isdir(path) and path.rstrip("/").endswith(".parquet"))
+
 @lru_cache
 def get_air_locations_df(data_dir=".."):
     '''
@@ -18,10 +71,9 @@ def get_air_locations_df(data_dir=".."):
     '''
     #Path to location data
     if not os.path.isfile(data_dir):
-        fpaths = glob.glob(f"{data_dir}/**/informacion_estaciones_red_calidad_aire.csv",recursive=True)
-        if not fpaths:
+        csv_path = find_dataset(data_dir,"air_locations")
+        if csv_path is None:
             raise AttributeError("Could not find the file pmed_trafico_ubicaciones.feather in the directory tree of the data_dir specified")
-        csv_path = fpaths[0]
     else:
         csv_path = data_dir
     estaciones_calidad_aire_loc = pd.read_csv(csv_path,encoding='latin-1',sep=';',decimal=',')
@@ -46,27 +98,35 @@ def get_traffic_locations_df(data_dir=".."):
     e.g: get_traffic_locations_df(data_dir='../01-data')
     '''
     if not os.path.isfile(data_dir):
-        fpaths = glob.glob(f'{data_dir}/**/traffic_locations_data.feather', recursive=True) 
-        if not fpaths:
+        fpath = find_dataset(data_dir,"traffic_locations")
+        if fpath is None:
             logging.warning("Could not find the file traffic_locations_data.feather "\
                 "in the directory tree of the data_dir specified. Using the raw data instead")
-            fpaths = glob.glob(f'{data_dir}/**/pmed_trafico_ubicaciones_raw.feather', recursive=True)
-            if not fpaths:
+            raw_fpath = find_dataset(data_dir,"traffic_locations_raw")
+            if raw_fpath is None:
                 logging.warning("Could not find the file pmed_trafico_ubicaciones_raw.feather "\
                     "in the directory tree of the data_dir specified. Extracting the raw data from source")
-                traffic_locations_raw = extract_traffic_locations_raw()
+                traffic_locations_raw = extract_traffic_locations_raw(cache_dir=os.path.join(data_dir,CACHE_DIRNAME,"http"))
             else:
-                traffic_locations_raw = pd.read_feather(fpaths[0])
+                traffic_locations_raw = pd.read_feather(raw_fpath)
             traffic_locations_df = clean_traffic_locations_raw(traffic_locations_raw)
             return traffic_locations_df
-        fpath = fpaths[0]
     else:
         fpath = data_dir
     
     return pd.read_feather(fpath)
 
 @lru_cache
-def get_air_quality_df(data_dir="..",meteo_normalized=False) -> pd.DataFrame:
+def get_traffic_sensor_index(data_dir="..") -> TrafficSensorIndex:
+    '''
+    Returns the spatial index over the traffic measurement points of get_traffic_locations_df(data_dir).
+    The index (and the sparse weight matrices computed with it) is kept in memory to be reused between calls.
+    e.g: get_traffic_sensor_index(data_dir='../01-data').query_radius([(40.41,-3.68)],km_dist=0.5)
+    '''
+    return TrafficSensorIndex(get_traffic_locations_df(data_dir))
+
+@lru_cache_lists
+def get_air_quality_df(data_dir="..",meteo_normalized=False,start=None,end=None,stations=None,columns=None,compact=False,int_time=False,memory_map=False) -> pd.DataFrame:
     '''
     Returns a pandas.Dataframe of the air quality data of each air quality monitoring station in the city of Madrid
     data_dir should be the path to the root data directory containing the raw and processed data of this project.
@@ -74,102 +134,265 @@ def get_air_quality_df(data_dir="..",meteo_normalized=False) -> pd.DataFrame:
 
     meteo_normalized : bool, optional
         If True, the meteorological-normalized data will be returned if it is available.
+    start,end : str or datetime.datetime, optional
+        Only the data between start and end (inclusive) is read.
+    stations : str or list, optional
+        Only the data of these stations is read. e.g: stations=MADRID_AIR_QUALITY_ZONES[1]
+    columns : list, optional
+        Only these columns (plus time and estacion) are read.
+    compact : bool, optional
+        If True, the data is returned with memory-compact dtypes (see src.utils.compact_dtypes).
+    int_time : bool, optional
+        If True (and compact is True), the time column is encoded as int32 hours since 1970-01-01.
+    memory_map : bool, optional
+        If True, the data is memory-mapped from an uncompressed Arrow file kept in data_dir/.cache/mmap
+        (written the first time) instead of being read into memory, so that all the processes
+        that load it share one copy of the data (see src.data_store.read_memory_mapped).
+
+    If the data has been partitioned with src.data_store.partition_feather_dataset only the 
+    partitions and row groups needed are read from disk.
     '''
-    if not os.path.isfile(data_dir):
-        if not meteo_normalized:
-            fpaths = glob.glob(f'{data_dir}/**/air_quality_data.feather', recursive=True) 
-        else:
-            fpaths = glob.glob(f'{data_dir}/**/aq-weather_normalized.feather', recursive=True)
-        if not fpaths:
+    if not _is_dataset_path(data_dir):
+        fpath = find_dataset(data_dir,"air_quality_normalized" if meteo_normalized else "air_quality")
+        if fpath is None:
             raise AttributeError("Could not find the file air_quality_data.feather in the directory tree of the data_dir specified")
-        fpath = fpaths[0]
     else:
         fpath = data_dir
     
-    return pd.read_feather(fpath)
+    if memory_map:
+        name = "air_quality_normalized" if meteo_normalized else "air_quality"
+        return _read_memory_mapped_dataset(data_dir,name,fpath,start,end,stations,columns,compact,int_time)
+    return read_dataset(fpath,start=start,end=end,stations=stations,columns=columns,compact=compact,int_time=int_time)
 
-@lru_cache
-def get_weather_df(data_dir="..") -> pd.DataFrame:
+@lru_cache_lists
+def get_weather_df(data_dir="..",start=None,end=None,columns=None) -> pd.DataFrame:
     '''
     Returns a pandas.Dataframe of the meteorological data in the city of Madrid
     data_dir should be the path to the root data directory containing the raw and processed data of this project.
     e.g: get_weather_df(data_dir='../01-data')
+
+    start,end : str or datetime.datetime, optional
+        Only the data between start and end (inclusive) is read.
+    columns : list, optional
+        Only these columns (plus time) are read.
     '''
-    if not os.path.isfile(data_dir):
-        fpaths = glob.glob(f'{data_dir}/**/weather_data.feather', recursive=True) 
-        if not fpaths:
+    if not _is_dataset_path(data_dir):
+        fpath = find_dataset(data_dir,"weather")
+        if fpath is None:
             raise AttributeError("Could not find the file weather_data.feather in the directory tree of the data_dir specified")
-        fpath = fpaths[0]
     else:
         fpath = data_dir
     
-    weather_df = pd.read_feather(fpath)    
+    weather_df = read_dataset(fpath,start=start,end=end,columns=columns)
     return weather_df
 
-@lru_cache
-def get_traffic_df(data_dir=".."):
+@lru_cache_lists
+def get_traffic_df(data_dir="..",start=None,end=None,stations=None,columns=None,compact=False,int_time=False,batch_size=None):
     '''
     Returns a pandas.Dataframe of the traffic data in the city of Madrid
     data_dir should be the path to the root data directory containing the raw and processed data of this project.
     e.g: get_traffic_data_df(data_dir='../01-data')
+
+    start,end : str or datetime.datetime, optional
+        Only the data between start and end (inclusive) is read.
+    stations : str or list, optional
+        Only the data of the traffic measurement points with these cod_cent is read.
+    columns : list, optional
+        Only these columns (plus time and cod_cent) are returned.
+    compact : bool, optional
+        If True, the data is returned with memory-compact dtypes (see src.utils.compact_dtypes).
+        The conversion is done while reading so the full float64 table is never held in memory.
+    int_time : bool, optional
+        If True (and compact is True), the time column is encoded as int32 hours since 1970-01-01.
+    batch_size : int, optional
+        Maximum number of rows scanned at once (see src.data_store.read_dataset).
     '''
-    if not os.path.isfile(data_dir):
-        fpaths = glob.glob(f'{data_dir}/**/traffic_data.feather', recursive=True) 
-        if not fpaths:
+    if not _is_dataset_path(data_dir):
+        fpath = find_dataset(data_dir,"traffic")
+        if fpath is None:
             raise AttributeError("Could not find the file traffic_data.feather in the directory tree of the data_dir specified")
-        fpath = fpaths[0]
     else:
         fpath = data_dir
     
-    traffic_df = pd.read_feather(fpath).rename(
+    traffic_cols = ["time","nombre","cod_cent","id","intensidad","carga","ocupacion"]
+    if columns is not None:
+        traffic_cols = ["time","cod_cent"] + [col for col in columns if col not in ["time","cod_cent"]]
+    # Only the valid measurements with a time are read (the filter is evaluated batch by batch by arrow,
+    # so intensidad and ocupacion are not loaded unless they are in columns)
+    valid_rows = ((ds.field("intensidad")+ds.field("ocupacion"))>=0) & ds.field("fecha").is_valid()
+    traffic_df = read_dataset(
+        fpath,
+        start=start,
+        end=end,
+        stations=stations,
+        columns=["fecha" if col=="time" else col for col in traffic_cols],
+        time_col="fecha",
+        station_col="cod_cent",
+        compact=compact,
+        int_time=int_time,
+        row_filter=valid_rows,
+        batch_size=batch_size,
+    ).rename(
         columns={"fecha":"time"}
-    ).loc[:,["time","nombre","cod_cent","id","intensidad","carga","ocupacion"]]
-    traffic_df = traffic_df.loc[traffic_df.intensidad+traffic_df.ocupacion>=0,:]
-    return traffic_df.dropna(subset=["time"])
+    )
+    return traffic_df
 
-@lru_cache
-def get_madrid_data(data_dir="..",normalized=False):
+@lru_cache_lists
+def get_madrid_data(data_dir="..",normalized=False,start=None,end=None,stations=None,columns=None,km_dist=0.75,location_by="estacion",kernels="logistic",compact=False,int_time=False,memory_map=False):
     '''
     Returns a pandas.Dataframe of all weather, traffic, and meteorological data of the city of Madrid
     data_dir should be the path to the root data directory containing the raw and processed data of this project.
     e.g: get_madrid_data(data_dir='../01-data')
+
+    start,end : str or datetime.datetime, optional
+        Only the data between start and end (inclusive) is read.
+    stations : str or list, optional
+        Only the data of these air quality monitoring stations is read.
+    columns : list, optional
+        Only these columns (plus time and estacion) are read.
+    compact : bool, optional
+        If True, the data is returned with memory-compact dtypes (see src.utils.compact_dtypes).
+    int_time : bool, optional
+        If True (and compact is True), the time column is encoded as int32 hours since 1970-01-01.
+    memory_map : bool, optional
+        If True, the data is memory-mapped from an uncompressed Arrow file kept in data_dir/.cache/mmap
+        (written the first time) instead of being read into memory, so that all the processes
+        that load it share one copy of the data (see src.data_store.read_memory_mapped).
+        If the data has to be made instead, the data made is written there and memory-mapped too.
+    km_dist,location_by,kernels : optional
+        Parameters used to match the traffic data with src.data_matching.match_data
+        (km_dist and kernels can be lists to make the traffic features of several distances and kernels at once)
+        when madrid_data.feather does not exist and the data has to be made instead.
+        The data made is cached in data_dir/.cache under a key derived from the contents of the
+        input files and these parameters, so it is only made again when one of them changes.
     '''
-    if not os.path.isfile(data_dir):
-        if not normalized:
-            fpaths = glob.glob(f'{data_dir}/**/madrid_data.feather', recursive=True)
-        else:
-            fpaths = glob.glob(f'{data_dir}/**/madrid_normalized_data.feather', recursive=True)
-            if not fpaths:
-                raise AttributeError("Could not find the file madrid_normalized_data.feather in the directory tree of the data_dir specified")
-        if not fpaths:
+    if not _is_dataset_path(data_dir):
+        fpath = find_dataset(data_dir,"madrid_normalized_data" if normalized else "madrid_data")
+        if fpath is None and normalized:
+            raise AttributeError("Could not find the file madrid_normalized_data.feather in the directory tree of the data_dir specified")
+        if fpath is None:
             logging.warning("Could not find the file madrid_air_quality_data.feather "\
                 "in the directory tree of the data_dir specified. Attempting to make it instead")
-            ### Air Quality Data
-            aq_df = get_air_quality_df(data_dir)
-            ### Weather data
-            weather_df = get_weather_df(data_dir)
-            ### Traffic data
-            traffic_df = get_traffic_df(data_dir)
-            ### Traffic locations
-            traffic_locations_df = get_traffic_locations_df(data_dir)
-            ### Air locations
-            air_locations_df = get_air_locations_df(data_dir)
-            # Match air quality stations with their locations
-            close_matches = { est : difflib.get_close_matches(est,air_locations_df.estacion_aire.unique().tolist()) for est in aq_df.estacion.unique()}
-            est_replacements = {old_est:matches[0] for old_est,matches in close_matches.items() if matches and old_est!=matches[0]}
-            if est_replacements.get("Retiro") is None:
-                est_replacements["Retiro"] = 'Parque del Retiro'
-            aq_df["estacion"] = aq_df.estacion.replace(est_replacements)
-            # Match and Merge the data
-            return match_data(
-                aq_df,
-                weather_df,
-                traffic_df,
-                traffic_locations_df,
-                air_locations_df
-            )
-        fpath = fpaths[0]
+            madrid_df = _make_madrid_data(data_dir,start,end,stations,km_dist,location_by,kernels)
+            if columns is not None:
+                madrid_df = madrid_df.loc[:,["time","estacion"]+[col for col in columns if col not in ["time","estacion"]]]
+            if compact:
+                madrid_df = compact_dtypes(madrid_df,int_time=int_time)
+            if memory_map:
+                return _memory_map_frame(madrid_df,os.path.join(data_dir,CACHE_DIRNAME),"madrid_data")
+            return madrid_df
     else:
         fpath = data_dir
     
-    return pd.read_feather(fpath)
\ No newline at end of file
+    if memory_map:
+        name = "madrid_normalized_data" if normalized else "madrid_data"
+        return _read_memory_mapped_dataset(data_dir,name,fpath,start,end,stations,columns,compact,int_time)
+    return read_dataset(fpath,start=start,end=end,stations=stations,columns=columns,compact=compact,int_time=int_time)
+
+def update_madrid_data(data_dir="..",end=None,km_dist=0.75,location_by="estacion",kernels="logistic") -> pd.DataFrame:
+    '''
+    Incrementally updates the madrid_data dataset of data_dir with the new air quality, weather, and traffic data
+    (e.g: the data of a new month). Only the data after the last time already in the dataset is read and matched
+    (including the aggregation of the nearby traffic) and it is appended as new files of the partitioned dataset,
+    so the cost of the update depends on the new data and not on the whole history.
+
+    If madrid_data is a feather file, it is converted into a partitioned dataset (madrid_data.parquet) first.
+    If it does not exist, it is made with all the data and stored next to the air quality data.
+    km_dist,location_by, and kernels should be the same used to make the existing data.
+
+    Returns the pandas.DataFrame of the rows appended.
+    e.g: update_madrid_data(data_dir='../01-data')
+    '''
+    fpath = find_dataset(data_dir,"madrid_data")
+    start = None
+    if fpath is None:
+        aq_fpath = find_dataset(data_dir,"air_quality")
+        if aq_fpath is None:
+            raise AttributeError("Could not find the air quality data in the directory tree of the data_dir specified")
+        root = os.path.join(os.path.dirname(aq_fpath),"madrid_data.parquet")
+    else:
+        if not os.path.isdir(fpath):
+            logging.warning(f"Converting {fpath} into a partitioned dataset to append the new data to it")
+            fpath = partition_feather_dataset(fpath)
+        root = fpath
+        _,last_time = dataset_time_range(root)
+        start = last_time + pd.Timedelta(hours=1)
+    new_df = _make_madrid_data(data_dir,start,end,None,km_dist,location_by,kernels,use_cache=False)
+    if new_df.empty:
+        logging.info("There is no new data to append to madrid_data")
+        return new_df
+    append_partitioned_dataset(new_df,root)
+    get_madrid_data.cache_clear()
+    return new_df
+
+def _make_madrid_data(data_dir,start,end,stations,km_dist,location_by,kernels,use_cache=True):
+    '''
+    Makes the data of get_madrid_data from the air quality, weather, and traffic data in data_dir
+    reusing the results cached from previous calls with the same inputs and parameters.
+    With use_cache=False the inputs are not hashed and nothing is cached (e.g: to make only a new time range).
+    '''
+    cache_dir = os.path.join(data_dir,CACHE_DIRNAME)
+    if use_cache:
+        hashes = {
+            name:get_dataset_hash(data_dir,name)
+            for name in ["air_quality","weather","traffic","traffic_locations","air_locations"]
+        }
+        if hashes["traffic_locations"] is None:
+            hashes["traffic_locations"] = get_dataset_hash(data_dir,"traffic_locations_raw")
+        params = dict(start=start,end=end,stations=stations,km_dist=km_dist,location_by=location_by,kernels=kernels)
+        madrid_key = make_cache_key(*hashes.values(),**params)
+        madrid_df = load_cached_frame(cache_dir,"madrid_data",madrid_key)
+        if madrid_df is not None:
+            logging.info(f"Loaded madrid data from cache {madrid_key}")
+            return madrid_df
+    ### Air Quality Data
+    aq_df = get_air_quality_df(data_dir,start=start,end=end)
+    ### Weather data
+    weather_df = get_weather_df(data_dir,start=start,end=end)
+    ### Air locations
+    air_locations_df = get_air_locations_df(data_dir)
+    # Match air quality stations with their locations
+    close_matches = { est : difflib.get_close_matches(est,air_locations_df.estacion.unique().tolist()) for est in aq_df.estacion.unique()}
+    est_replacements = {old_est:matches[0] for old_est,matches in close_matches.items() if matches and old_est!=matches[0]}
+    if est_replacements.get("Retiro") is None:
+        est_replacements["Retiro"] = 'Parque del Retiro'
+    aq_df = aq_df.assign(estacion=aq_df.estacion.replace(est_replacements))
+    if stations is not None:
+        stations = [stations] if isinstance(stations,str) else list(stations)
+        aq_df = aq_df[aq_df.estacion.isin(stations)]
+        air_locations_df = air_locations_df[air_locations_df.estacion.isin(stations)]
+    # The traffic features only depend on the traffic and locations data, so they are cached separately
+    # and reused when only the air quality or weather data change
+    traffic_features_df = None
+    if use_cache:
+        traffic_key = make_cache_key(
+            hashes["traffic"],hashes["traffic_locations"],hashes["air_locations"],**params
+        )
+        traffic_features_df = load_cached_frame(cache_dir,"traffic_features",traffic_key)
+    if traffic_features_df is None:
+        ### Traffic data
+        traffic_df = get_traffic_df(data_dir,start=start,end=end)
+        ### Traffic locations
+        traffic_locations_df = get_traffic_locations_df(data_dir)
+        traffic_features_df = get_nearby_traffic_features(
+            air_locations_df,
+            traffic_df,
+            traffic_locations_df,
+            km_dist=km_dist,
+            location_by=location_by,
+            sensor_index=get_traffic_sensor_index(data_dir),
+            kernels=kernels,
+        )
+        if use_cache:
+            save_cached_frame(traffic_features_df,cache_dir,"traffic_features",traffic_key)
+    # Match and Merge the data
+    madrid_df = match_data(
+        aq_df,
+        weather_df,
+        air_locations_df=air_locations_df,
+        location_by=location_by,
+        traffic_features_df=traffic_features_df,
+    )
+    if use_cache:
+        save_cached_frame(madrid_df,cache_dir,"madrid_data",madrid_key)
+    return madrid_df
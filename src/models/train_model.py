@@ -1,4 +1,5 @@
 from prophet import Prophet
+from prophet.serialize import model_to_json, model_from_json
 from sktime.annotation.clasp import ClaSPSegmentation, find_dominant_window_sizes
 
 from collections import namedtuple
@@ -10,7 +11,11 @@ import matplotlib.pyplot as plt
 import time,logging
 import statsmodels.api as sm
 
-import contextlib, os
+import contextlib, os, itertools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from ..preprocessing.gap_filling import fill_frame_gaps, to_dense_panel
+from ..data_cache import make_cache_key, frame_hash, load_cached_object, save_cached_object
 
 logging.basicConfig(level=logging.INFO)
 
@@ -25,6 +30,11 @@ def train_prophet_model(
     eval_end:str=None,
     regressors:list = None,
     verbose:bool=True,
+    cache_dir:str=None,
+    max_cache_bytes:int=2**30,
+    fast:bool=False,
+    uncertainty:bool=True,
+    init:dict=None,
     **kwargs
     ):
     '''
@@ -49,6 +59,21 @@ def train_prophet_model(
         List of regressors to be used in the model.
     verbose : bool, optional
         If True, prints info about the training process.
+    cache_dir : str, optional
+        Directory where the fitted model and its results are cached (e.g: '../01-data/.cache/models').
+        They are loaded from it instead of fitting the model again if the train and evaluation data,
+        the regressors, the train/eval period, and kwargs are the same.
+        init is not part of the key: a model warm-started from other parameters is loaded for the same data and parameters.
+    max_cache_bytes : int, optional
+        Maximum size of the cached Prophet models. The least recently used are removed when it is exceeded.
+    fast : bool, optional
+        If True, only the evaluation period is predicted (forecast_df is the same as y_hat_df) and the trends
+        used for trend_diff are 7-day centered moving averages instead of seasonal decompositions of the whole series
+        (the same trend for daily data, but trend_diff is then only computed over the evaluation period).
+    uncertainty : bool, optional
+        If False, the uncertainty intervals are not simulated (uncertainty_samples=0) and only point forecasts are returned.
+    init : dict, optional
+        Initial values of the parameters of the model to warm-start the fit (e.g: stan_init(previous_results.model)).
     **kwargs : dict
         Keyword arguments to be passed to the instance of the Prophet model.
     
@@ -72,13 +97,19 @@ def train_prophet_model(
             on the evaluation period.
         - model_params : dict
             Dictionary with the parameters used to train the model (kwargs).
+        - timings : dict
+            Seconds spent preparing the data ("prep"), fitting ("fit"), predicting ("predict"),
+            and evaluating ("evaluate") the model (and loading it, "cache", if it was cached).
     '''
+    start_time = time.time()
     if not verbose:
         logger.setLevel(logging.ERROR)
     # Make the namedtuple
     ProphetResults = namedtuple(
-        "ProphetResults",["model","train_df","eval_df","forecast_df","y_hat_df","eval_metrics_df","model_params"]
+        "ProphetResults",["model","train_df","eval_df","forecast_df","y_hat_df","eval_metrics_df","model_params","timings"]
     )
+    if not uncertainty:
+        kwargs = {"uncertainty_samples":0,**kwargs}
 
     madrid_df = madrid_df.copy()
 
@@ -104,12 +135,29 @@ def train_prophet_model(
         columns=madrid_df.columns.intersection(["zone","zona","estacion","location"])
     ).copy()
     X = X[["ds","y"] + ([r for r in regressors] if regressors is not None else [])]
-    X = X.set_index("ds").interpolate(limit=6).dropna().reset_index()
+    X = fill_frame_gaps(X.set_index("ds"),limit=6)[0].dropna().reset_index()
     # X = X.dropna(subset=["y"])
     
     # Train and evaluation split
     X_train = X[(X.ds<eval_start)&(X.ds>=train_start)].copy()
     X_test = X[(X.ds>=eval_start)&(X.ds<=eval_end)].copy()
+    timings = {"prep":time.time()-start_time}
+
+    # Load the model and its results if it was already fit with the same data and parameters
+    cache_key = None
+    if cache_dir is not None:
+        cache_key = make_cache_key(
+            frame_hash(X_train),
+            frame_hash(X_test),
+            model="prophet",y=y,regressors=regressors,train_start=train_start,
+            eval_start=eval_start,eval_end=eval_end,params=kwargs,fast=fast,
+        )
+        cached = load_cached_object(cache_dir,"prophet",cache_key)
+        if cached is not None:
+            logger.info("Model and results loaded from the cache")
+            cached["model"] = model_from_json(cached["model"])
+            cached["timings"] = {**timings,"fit":0.0,"predict":0.0,"evaluate":0.0,"cache":time.time()-start_time-timings["prep"]}
+            return ProphetResults(**cached)
 
     # Instantiate Prophet, fit model, and predict
     m = Prophet(**kwargs)
@@ -120,15 +168,22 @@ def train_prophet_model(
     
     train_start = time.time()
     with suppress_stdout_stderr():
-        m.fit(X_train)
+        if init is not None:
+            m.fit(X_train,init=init)
+        else:
+            m.fit(X_train)
     fit_time = time.time()-train_start
+    timings["fit"] = fit_time
     logger.info(f"Model was fit in {fit_time:.2f} seconds. Making predictions...")
     
     # Make predictions
-    forecast = m.predict(X_train.append(X_test))
+    predict_start = time.time()
+    forecast = m.predict(X_test if fast else pd.concat([X_train,X_test]))
     Y_hat = forecast.loc[forecast.ds.between(eval_start,eval_end),:]
+    timings["predict"] = time.time()-predict_start
 
     # Evaluate the model
+    evaluate_start = time.time()
     mse = mean_squared_error(X_test.y,Y_hat.yhat)
     mae = mean_absolute_error(X_test.y,Y_hat.yhat)
     r2 = r2_score(X_test.y,Y_hat.yhat)
@@ -136,12 +191,17 @@ def train_prophet_model(
 
     # Evaluate the trend
     try:
-        real_trend = sm.tsa.seasonal_decompose(X.set_index("ds")['y'], model='additive').trend
-        predicted_trend = sm.tsa.seasonal_decompose(forecast.set_index("ds")['yhat'], model='additive').trend
+        if fast:
+            real_trend = _moving_average_trend(X.set_index("ds")['y'])
+            predicted_trend = _moving_average_trend(forecast.set_index("ds")['yhat'])
+        else:
+            real_trend = sm.tsa.seasonal_decompose(X.set_index("ds")['y'], model='additive').trend
+            predicted_trend = sm.tsa.seasonal_decompose(forecast.set_index("ds")['yhat'], model='additive').trend
         trend_diff = np.mean((predicted_trend - real_trend)/predicted_trend)
     except Exception as err:
         logger.warning(f"Could not evaluate the trend: {err}")
         trend_diff = np.nan
+    timings["evaluate"] = time.time()-evaluate_start
 
     logger.info(f"Evaluation complete. MSE={mse:.2f}, MAE={mae:.2f}, R2={r2:.2f}")
     logger.info(f"Mean difference between forecast and actual: {diff:+.2f}")
@@ -152,7 +212,585 @@ def train_prophet_model(
         columns=["score"]
     ).T
     
-    return ProphetResults(m, X_train, X_test, forecast, Y_hat, metrics_df, kwargs)
+    results = ProphetResults(m, X_train, X_test, forecast, Y_hat, metrics_df, kwargs, timings)
+    if cache_key is not None:
+        save_cached_object(
+            {**results._asdict(),"model":model_to_json(m)},
+            cache_dir,"prophet",cache_key,max_bytes=max_cache_bytes
+        )
+    return results
+
+def train_prophet_models(
+    madrid_df:pd.DataFrame,
+    tasks,
+    location_by:str="zone",
+    n_jobs:int=None,
+    return_results:bool=False,
+    cache_dir:str=None,
+    **kwargs
+    ):
+    '''
+    Trains a Prophet model (with train_prophet_model) for each task of a grid of locations, variables,
+    evaluation periods, regressors, and model parameters in a pool of n_jobs processes
+    and returns the evaluation metrics of all of them in a single dataframe.
+
+    The daily means of each location are computed once for all the tasks (instead of resampling madrid_df in every fit)
+    and each process only receives the columns of the location that its task uses.
+    A task that fails does not stop the rest: its error is reported in the "error" column of the metrics.
+
+    e.g:
+    tasks = [
+        dict(location=zone,y=y,eval_start=cp,eval_end=pd.Timedelta(days=90))
+        for zone,y,cp in itertools.product([1,2,3],["no2_ug_m3","pm10_ug_m3"],["2020-03-15"])
+    ]
+    metrics_df = train_prophet_models(madrid_df,tasks,location_by="zone",n_jobs=4,changepoint_prior_scale=0.4)
+
+    Parameters
+    ----------
+    madrid_df : pandas.DataFrame
+        Dataframe with the air quality monitoring stations data.
+    tasks : list of dict or pandas.DataFrame
+        Models to train. Each task has the keys (or columns) "location", "y" and "eval_start" and optionally
+        "eval_end", "train_start", "regressors" (list) and "params" (dict of parameters of the Prophet model).
+    location_by : str, optional
+        Name of the column in the dataframe that contains the locations of the tasks.
+    n_jobs : int, optional
+        Number of processes. If 1, the models are trained sequentially in the current process.
+    return_results : bool, optional
+        If True, the ProphetResults of each task (None if it failed) are returned too.
+    cache_dir : str, optional
+        Directory where the fitted models are cached (see train_prophet_model).
+    **kwargs : dict
+        Parameters of the Prophet model common to all the tasks (the "params" of each task take precedence).
+
+    Returns
+    -------
+    pandas.DataFrame
+        Dataframe with a row per task with its location, y, evaluation period, regressors, and parameters,
+        the metrics of train_prophet_model (mse, mae, r2, mean_diff, trend_diff), the seconds spent in each stage
+        of train_prophet_model (prep_time, fit_time, predict_time, evaluate_time) and in the whole task (task_time),
+        and the error of the tasks that failed.
+    list, optional
+        ProphetResults of each task (if return_results is True).
+    '''
+    if isinstance(tasks,pd.DataFrame):
+        tasks = tasks.to_dict("records")
+    # Empty cells of a dataframe of tasks (NaN/NaT) are the same as missing keys
+    tasks = [
+        {key:value for key,value in dict(task).items() if not (pd.api.types.is_scalar(value) and pd.isna(value))}
+        for task in tasks
+    ]
+    if madrid_df.index.name=="time":
+        madrid_df = madrid_df.reset_index()
+    # Columns used by each task (a task with invalid keys fails alone, without stopping the rest)
+    outputs = [None]*len(tasks)
+    task_columns = {}
+    for i,task in enumerate(tasks):
+        try:
+            task_columns[i] = (task["location"],[task["y"]]+list(task.get("regressors") or []))
+        except Exception as err:
+            outputs[i] = (_task_metrics(task,error=repr(err)),None)
+    # Daily means of the columns used by the tasks of each location, computed once
+    columns_by_location = {}
+    for location,task_cols in task_columns.values():
+        columns = columns_by_location.setdefault(location,[])
+        for col in task_cols:
+            if col not in columns:
+                columns.append(col)
+    daily_dfs = {}
+    for location,columns in columns_by_location.items():
+        location_df = madrid_df.loc[madrid_df[location_by]==location,["time"]+[col for col in columns if col in madrid_df.columns]]
+        daily_dfs[location] = location_df.set_index("time").resample("1D").mean().reset_index()
+    def task_args(i):
+        location,task_cols = task_columns[i]
+        daily_df = daily_dfs[location]
+        # Missing columns are left out so that the task fails with the error of train_prophet_model
+        columns = [col for col in ["time"]+task_cols if col in daily_df.columns]
+        return daily_df[columns],tasks[i],kwargs,return_results,cache_dir
+    if n_jobs==1:
+        for i in task_columns:
+            outputs[i] = _train_prophet_task(*task_args(i))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = {i:pool.submit(_train_prophet_task,*task_args(i)) for i in task_columns}
+            for i,future in futures.items():
+                try:
+                    outputs[i] = future.result()
+                except Exception as err:
+                    # e.g: the process died or the results could not be sent back
+                    outputs[i] = (_task_metrics(tasks[i],error=repr(err)),None)
+    metrics_df = pd.DataFrame([metrics for metrics,_ in outputs])
+    n_failed = metrics_df.error.notna().sum()
+    if n_failed:
+        logger.warning(f"{n_failed} of {len(tasks)} models could not be trained. See the error column of the metrics")
+    if return_results:
+        return metrics_df,[results for _,results in outputs]
+    return metrics_df
+
+def backtest_prophet_model(
+    madrid_df:pd.DataFrame,
+    y:str,
+    origins:list=None,
+    n_folds:int=10,
+    period:pd.Timedelta=pd.Timedelta(days=30),
+    horizons:list=(pd.Timedelta(days=90),),
+    window:str="expanding",
+    train_window:pd.Timedelta=None,
+    location=None,
+    location_by:str="zone",
+    regressors:list=None,
+    warm_start:bool=True,
+    n_jobs:int=None,
+    fast:bool=True,
+    uncertainty:bool=False,
+    cache_dir:str=None,
+    **kwargs
+    ):
+    '''
+    Backtests Prophet forecasts of a variable with rolling-origin evaluation: a model is trained
+    (with train_prophet_model) with the data before each origin and evaluated on the following horizons.
+
+    The folds are split into n_jobs chains of consecutive origins fitted in parallel processes.
+    If warm_start is True, the fit of each fold of a chain starts from the parameters of the previous fold (see stan_init),
+    which converges much faster than fitting from scratch.
+
+    e.g: backtest_prophet_model(madrid_df,"no2_ug_m3",location=1,n_folds=50,horizons=[7,30,90],n_jobs=8,changepoint_prior_scale=0.4)
+
+    Parameters
+    ----------
+    madrid_df : pandas.DataFrame
+        Dataframe with the air quality monitoring stations data.
+    y : str
+        Name of the variable to be predicted.
+    origins : list, optional
+        Start dates of the evaluation period of each fold. If None, n_folds origins every period
+        are used, the last one max(horizons) before the end of the data.
+    n_folds : int, optional
+        Number of origins if origins is None.
+    period : pandas.Timedelta, optional
+        Time between origins if origins is None.
+    horizons : list, optional
+        Lengths of the evaluation periods after each origin (Timedeltas or number of days).
+    window : str, optional
+        "expanding" to train each fold with all the data before its origin or
+        "rolling" to train it with the data of the train_window before its origin.
+    train_window : pandas.Timedelta, optional
+        Length of the train period of each fold if window="rolling".
+    location : optional
+        If given, only the data of this location (in the column location_by) is used.
+    regressors : list, optional
+        List of regressors to be used in the model.
+    warm_start : bool, optional
+        If True, the fit of each fold starts from the parameters of the previous fold of its chain.
+    n_jobs : int, optional
+        Number of processes. If 1, all the folds are fitted sequentially in the current process (as a single chain).
+    fast, uncertainty, cache_dir : optional
+        See train_prophet_model. By default only the evaluation periods are predicted, without uncertainty intervals.
+    **kwargs : dict
+        Keyword arguments to be passed to the instance of the Prophet model.
+
+    Returns
+    -------
+    BacktestResults
+        NamedTuple with the following fields:
+        - metrics_df : pandas.DataFrame
+            Mean and standard deviation across folds of the metrics (mse, mae, r2, mean_diff, trend_diff) of each horizon
+            and the number of folds evaluated.
+        - folds_df : pandas.DataFrame
+            Metrics of each fold and horizon, the time spent fitting each fold, and the errors of the folds that failed.
+        - forecasts_df : pandas.DataFrame
+            Actual and predicted values of the evaluation period of each fold.
+    '''
+    BacktestResults = namedtuple("BacktestResults",["metrics_df","folds_df","forecasts_df"])
+    if window not in ("expanding","rolling"):
+        raise ValueError(f"Unknown window {window}. Must be 'expanding' or 'rolling'")
+    if window=="rolling" and train_window is None:
+        raise ValueError("train_window must be given if window='rolling'")
+    horizons = sorted(h if isinstance(h,pd.Timedelta) else pd.Timedelta(days=h) for h in horizons)
+    if madrid_df.index.name=="time":
+        madrid_df = madrid_df.reset_index()
+    if location is not None:
+        madrid_df = madrid_df[madrid_df[location_by]==location]
+    # Daily means computed once for all the folds
+    columns = ["time",y]+list(regressors or [])
+    daily_df = madrid_df[columns].set_index("time").resample("1D").mean().reset_index()
+    if origins is None:
+        last_origin = daily_df.time.max().normalize()-horizons[-1]
+        origins = [last_origin-i*period for i in reversed(range(n_folds))]
+    origins = sorted(pd.to_datetime(list(origins)))
+    folds = [
+        dict(
+            fold=i,
+            eval_start=origin,
+            eval_end=origin+horizons[-1]-pd.Timedelta(days=1),
+            train_start=origin-train_window if window=="rolling" else None,
+        )
+        for i,origin in enumerate(origins)
+    ]
+    params = dict(regressors=regressors,fast=fast,uncertainty=uncertainty,cache_dir=cache_dir,**kwargs)
+    # Chains of consecutive folds (each fold is its own chain without warm start)
+    n_chains = 1 if n_jobs==1 else (min(len(folds),n_jobs or os.cpu_count() or 1) if warm_start else len(folds))
+    chains = [list(chain) for chain in np.array_split(np.arange(len(folds)),n_chains) if len(chain)]
+    if n_jobs==1:
+        outputs = [_backtest_chain(daily_df,y,[folds[i] for i in chain],horizons,warm_start,params) for chain in chains]
+    else:
+        outputs = []
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(_backtest_chain,daily_df,y,[folds[i] for i in chain],horizons,warm_start,params) for chain in chains]
+            for chain,future in zip(chains,futures):
+                try:
+                    outputs.append(future.result())
+                except Exception as err:
+                    outputs.append(([
+                        dict(fold=i,origin=folds[i]["eval_start"],horizon=h,error=repr(err))
+                        for i in chain for h in horizons
+                    ],[]))
+    folds_df = pd.DataFrame([row for rows,_ in outputs for row in rows])
+    forecasts = [forecast for _,forecasts in outputs for forecast in forecasts]
+    forecasts_df = pd.concat(forecasts,ignore_index=True) if forecasts else pd.DataFrame(columns=["fold","ds","y","yhat"])
+    metric_names = ["mse","mae","r2","mean_diff","trend_diff"]
+    folds_df = folds_df.reindex(columns=["fold","origin","horizon"]+metric_names+["fit_time","error"])
+    n_failed = folds_df.drop_duplicates("fold").error.notna().sum()
+    if n_failed:
+        logger.warning(f"{n_failed} of {len(folds)} folds could not be evaluated. See the error column of folds_df")
+    metrics_df = folds_df[folds_df.error.isna()].groupby("horizon")[metric_names].agg(["mean","std"])
+    metrics_df.columns = [f"{name}_{stat}" for name,stat in metrics_df.columns]
+    metrics_df["n_folds"] = folds_df[folds_df.error.isna()].groupby("horizon").size()
+    return BacktestResults(metrics_df.reset_index(),folds_df,forecasts_df)
+
+def search_prophet_params(
+    madrid_df:pd.DataFrame,
+    y:str,
+    param_grid:dict,
+    eval_start:str,
+    eval_end:str=None,
+    train_start:str=None,
+    location=None,
+    location_by:str="zone",
+    regressors:list=None,
+    search:str="grid",
+    n_trials:int=10,
+    halving:bool=True,
+    eta:int=3,
+    min_train:pd.Timedelta=pd.Timedelta(days=180),
+    metric:str="mse",
+    warm_start:bool=True,
+    n_jobs:int=None,
+    random_state:int=None,
+    fast:bool=True,
+    uncertainty:bool=False,
+    cache_dir:str=None,
+    **kwargs
+    ):
+    '''
+    Searches the parameters of Prophet (e.g: changepoint_prior_scale, seasonality_prior_scale, seasonality_mode)
+    that give the best metric when forecasting a variable over the evaluation period with train_prophet_model.
+
+    The daily series is prepared once for all the trials, which are run in a pool of n_jobs processes.
+    If warm_start is True, the fit of each trial starts from the parameters (see stan_init) of the completed trial
+    with the nearest configuration (the distance of numeric parameters is measured in log scale).
+    If halving is True, the configurations are evaluated with successive halving: all of them are trained first
+    with the last min_train of data before eval_start, and only the best 1/eta of them are trained again
+    with eta times more data until the whole train period is used, so the losing configurations are stopped early.
+
+    e.g: search_prophet_params(madrid_df,"no2_ug_m3",{"changepoint_prior_scale":[0.01,0.1,0.5],"seasonality_mode":["additive","multiplicative"]},
+                               eval_start="2020-01-01",eval_end=pd.Timedelta(days=90),location=1,n_jobs=8)
+
+    Parameters
+    ----------
+    madrid_df : pandas.DataFrame
+        Dataframe with the air quality monitoring stations data.
+    y : str
+        Name of the variable to be predicted.
+    param_grid : dict
+        Parameters of Prophet to search with the list of their values or, if search="random",
+        a distribution to sample them from (any object with a rvs method, e.g: scipy.stats.loguniform(0.001,0.5)).
+    eval_start, eval_end, train_start : optional
+        Evaluation and train periods (see train_prophet_model).
+    location : optional
+        If given, only the data of this location (in the column location_by) is used.
+    regressors : list, optional
+        List of regressors to be used in the model.
+    search : str, optional
+        "grid" to try all the combinations of param_grid or "random" to sample n_trials configurations of it.
+    n_trials : int, optional
+        Number of configurations sampled if search="random".
+    halving : bool, optional
+        If True, the configurations are evaluated with successive halving of the train data.
+    eta : int, optional
+        Proportion of configurations discarded and increase of the train data at each round of halving.
+    min_train : pandas.Timedelta, optional
+        Train period of the first round of halving.
+    metric : str, optional
+        Metric used to rank the configurations ("mse", "mae" or "r2"). Lower is better except for "r2".
+    warm_start : bool, optional
+        If True, each fit starts from the parameters of the nearest completed configuration.
+    n_jobs : int, optional
+        Number of processes. If 1, the trials are run sequentially in the current process.
+    fast, uncertainty, cache_dir : optional
+        See train_prophet_model. By default only the evaluation period is predicted, without uncertainty intervals.
+    **kwargs : dict
+        Keyword arguments passed to all the instances of Prophet.
+
+    Returns
+    -------
+    SearchResults
+        NamedTuple with the following fields:
+        - best_params : dict
+            Best configuration trained with the whole train period.
+        - trials_df : pandas.DataFrame
+            Parameters, metrics, train days, fit time and errors of every trial (one row per configuration and round).
+    '''
+    SearchResults = namedtuple("SearchResults",["best_params","trials_df"])
+    if search not in ("grid","random"):
+        raise ValueError(f"Unknown search {search}. Must be 'grid' or 'random'")
+    if metric not in ("mse","mae","r2"):
+        raise ValueError(f"Unknown metric {metric}. Must be 'mse', 'mae' or 'r2'")
+    configs = _search_configs(param_grid,search,n_trials,random_state)
+    if madrid_df.index.name=="time":
+        madrid_df = madrid_df.reset_index()
+    if location is not None:
+        madrid_df = madrid_df[madrid_df[location_by]==location]
+    # Daily means computed once for all the trials
+    columns = ["time",y]+list(regressors or [])
+    daily_df = madrid_df[columns].set_index("time").resample("1D").mean().reset_index()
+    eval_start = pd.to_datetime(eval_start)
+    first_day = daily_df.time.min() if train_start is None else pd.to_datetime(train_start)
+    # Train periods of each round (only the whole period without halving)
+    train_days = [(eval_start-first_day).days]
+    while halving and len(configs)>1 and train_days[0]/eta>=min_train.days:
+        train_days.insert(0,int(train_days[0]/eta))
+    common = dict(eval_end=eval_end,regressors=regressors,fast=fast,uncertainty=uncertainty,cache_dir=cache_dir,verbose=False,**kwargs)
+    rows,inits = [],{}
+    def nearest_init(config_idx,round_idx):
+        # Parameters of the nearest completed configuration (the same one in a previous round is the nearest)
+        completed = [key for key in inits if inits[key] is not None]
+        if not warm_start or not completed:
+            return None
+        key = min(completed,key=lambda key: (_config_distance(configs[key[0]],configs[config_idx]),round_idx-key[1]))
+        return inits[key]
+    def trial_args(config_idx,round_idx):
+        trial_start = eval_start-pd.Timedelta(days=train_days[round_idx])
+        return (daily_df,y,configs[config_idx],trial_start,eval_start,nearest_init(config_idx,round_idx),common)
+    def record(config_idx,round_idx,output):
+        row,init = output
+        rows.append(dict(trial=config_idx,round=round_idx,train_days=train_days[round_idx],**row))
+        inits[(config_idx,round_idx)] = init
+    pool = ProcessPoolExecutor(max_workers=n_jobs) if n_jobs!=1 else None
+    candidates = list(range(len(configs)))
+    try:
+        for round_idx in range(len(train_days)):
+            if pool is None:
+                for config_idx in candidates:
+                    record(config_idx,round_idx,_search_trial(*trial_args(config_idx,round_idx)))
+            else:
+                # Trials are submitted as workers become free so that they can warm-start from the ones completed before
+                pending,running = list(candidates),{}
+                max_running = n_jobs or os.cpu_count() or 1
+                while pending or running:
+                    while pending and len(running)<max_running:
+                        config_idx = pending.pop(0)
+                        running[pool.submit(_search_trial,*trial_args(config_idx,round_idx))] = config_idx
+                    done,_ = wait(running,return_when=FIRST_COMPLETED)
+                    for future in done:
+                        config_idx = running.pop(future)
+                        try:
+                            output = future.result()
+                        except Exception as err:
+                            output = (_search_metrics(configs[config_idx],error=repr(err)),None)
+                        record(config_idx,round_idx,output)
+            if round_idx<len(train_days)-1:
+                round_df = pd.DataFrame([row for row in rows if row["round"]==round_idx])
+                ranked = round_df.sort_values(metric,ascending=metric!="r2",na_position="last")
+                candidates = sorted(ranked.trial.iloc[:max(1,int(np.ceil(len(candidates)/eta)))])
+                logger.info(f"Round {round_idx} ({train_days[round_idx]} days of train data): {len(candidates)} configurations continue")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    trials_df = pd.DataFrame(rows)
+    n_failed = trials_df.error.notna().sum()
+    if n_failed:
+        logger.warning(f"{n_failed} of {len(trials_df)} trials could not be trained. See the error column of trials_df")
+    final_df = trials_df[(trials_df["round"]==len(train_days)-1) & trials_df.error.isna()]
+    if final_df.empty:
+        return SearchResults(None,trials_df)
+    best = final_df.sort_values(metric,ascending=metric!="r2").trial.iloc[0]
+    return SearchResults(configs[best],trials_df)
+
+def _search_configs(param_grid,search,n_trials,random_state):
+    # Configurations (dicts of parameters of Prophet) tried by search_prophet_params
+    names = list(param_grid)
+    if search=="grid":
+        return [dict(zip(names,values)) for values in itertools.product(*(param_grid[name] for name in names))]
+    rng = np.random.default_rng(random_state)
+    configs = []
+    for _ in range(n_trials):
+        config = {}
+        for name in names:
+            values = param_grid[name]
+            if hasattr(values,"rvs"):
+                config[name] = values.rvs(random_state=rng)
+            else:
+                config[name] = values[rng.integers(len(values))]
+        configs.append(config)
+    return configs
+
+def _config_distance(a,b):
+    # Distance between two configurations: log scale for positive numbers, 0 or 1 for the rest of values
+    distance = 0
+    for name in a:
+        x,z = a[name],b.get(name)
+        if isinstance(x,(int,float)) and isinstance(z,(int,float)) and not isinstance(x,bool):
+            distance += abs(np.log(x)-np.log(z)) if x>0 and z>0 else abs(x-z)
+        else:
+            distance += x!=z
+    return distance
+
+def _search_trial(daily_df,y,config,train_start,eval_start,init,common):
+    # Trains and evaluates a configuration of search_prophet_params, returns its metrics and fitted parameters
+    try:
+        try:
+            results = train_prophet_model(daily_df,y,eval_start=eval_start,train_start=train_start,init=init,**{**common,**config})
+        except Exception:
+            if init is None:
+                raise
+            # e.g: the configuration has a different number of parameters than the one it warm-starts from
+            init = None
+            results = train_prophet_model(daily_df,y,eval_start=eval_start,train_start=train_start,**{**common,**config})
+    except Exception as err:
+        return _search_metrics(config,error=repr(err)),None
+    try:
+        fitted = stan_init(results.model)
+    except (AttributeError,KeyError,IndexError,TypeError):
+        fitted = None
+    metrics = results.eval_metrics_df.iloc[0].to_dict()
+    return _search_metrics(config,fit_time=results.timings.get("fit"),warm_start=init is not None,**metrics),fitted
+
+def _search_metrics(config,error=None,**metrics):
+    row = {f"param_{name}": value for name,value in config.items()}
+    row.update({name: metrics.get(name,np.nan) for name in ["mse","mae","r2","mean_diff","trend_diff","fit_time"]})
+    row["warm_start"] = metrics.get("warm_start",False)
+    row["error"] = error
+    return row
+
+def stan_init(m) -> dict:
+    '''
+    Returns the fitted parameters of a Prophet model as initial values to warm-start the fit of another
+    model with the same structure (e.g: Prophet(...).fit(df,init=stan_init(m)) or train_prophet_model(...,init=stan_init(m))).
+    '''
+    res = {}
+    for pname in ["k","m","sigma_obs"]:
+        res[pname] = m.params[pname][0][0]
+    for pname in ["delta","beta"]:
+        res[pname] = m.params[pname][0]
+    return res
+
+def _backtest_chain(daily_df,y,folds,horizons,warm_start,params):
+    # Fits the folds of a chain of backtest_prophet_model in order, warm-starting each one from the previous
+    rows,forecasts = [],[]
+    init = None
+    for fold in folds:
+        fold_args = dict(eval_start=fold["eval_start"],eval_end=fold["eval_end"],train_start=fold["train_start"],verbose=False)
+        try:
+            try:
+                results = train_prophet_model(daily_df,y,init=init,**fold_args,**params)
+            except Exception:
+                if init is None:
+                    raise
+                # A bad initialization must not lose the fold: fit it from scratch
+                results = train_prophet_model(daily_df,y,**fold_args,**params)
+        except Exception as err:
+            rows.extend(dict(fold=fold["fold"],origin=fold["eval_start"],horizon=h,error=repr(err)) for h in horizons)
+            init = None
+            continue
+        fit_time = results.timings.get("fit")
+        if warm_start:
+            try:
+                init = stan_init(results.model)
+            except (AttributeError,KeyError,IndexError,TypeError) as err:
+                logger.warning(f"Could not warm-start from the model of fold {fold['fold']}: {err}")
+                init = None
+        forecast = pd.DataFrame({
+            "fold": fold["fold"],
+            "ds": results.eval_df.ds.values,
+            "y": results.eval_df.y.values,
+            "yhat": results.y_hat_df.yhat.values,
+        })
+        forecasts.append(forecast)
+        # Trends of the whole series and of the forecast to evaluate the trend_diff of each horizon
+        real_trend = _moving_average_trend(daily_df.set_index("time")[y])
+        predicted_trend = _moving_average_trend(results.forecast_df.set_index("ds")["yhat"])
+        for horizon in horizons:
+            in_horizon = forecast.ds<fold["eval_start"]+horizon
+            metrics = _forecast_metrics(
+                forecast.y[in_horizon].values,
+                forecast.yhat[in_horizon].values,
+                real_trend,
+                predicted_trend[predicted_trend.index<fold["eval_start"]+horizon],
+            )
+            rows.append(dict(fold=fold["fold"],origin=fold["eval_start"],horizon=horizon,fit_time=fit_time,error=None,**metrics))
+    return rows,forecasts
+
+def _forecast_metrics(actual,predicted,real_trend,predicted_trend):
+    # Same metrics as the eval_metrics_df of train_prophet_model
+    if len(actual)==0:
+        return dict(mse=np.nan,mae=np.nan,r2=np.nan,mean_diff=np.nan,trend_diff=np.nan)
+    with np.errstate(invalid="ignore",divide="ignore"):
+        return dict(
+            mse=mean_squared_error(actual,predicted),
+            mae=mean_absolute_error(actual,predicted),
+            r2=r2_score(actual,predicted) if len(actual)>1 else np.nan,
+            mean_diff=np.mean((predicted-actual)/predicted),
+            trend_diff=np.mean((predicted_trend-real_trend.reindex(predicted_trend.index))/predicted_trend),
+        )
+
+def _moving_average_trend(series,period=7):
+    # Centered moving average of a daily series (the trend of seasonal_decompose with a weekly period)
+    # Missing days are left as gaps so that the averages are only computed over complete windows
+    return series.asfreq("D").rolling(period,center=True).mean()
+
+def _train_prophet_task(daily_df,task,kwargs,return_results=False,cache_dir=None):
+    # Trains the model of a task of train_prophet_models isolating its errors
+    start = time.time()
+    try:
+        params = {**kwargs,**(task.get("params") or {})}
+        results = train_prophet_model(
+            daily_df,
+            task["y"],
+            eval_start=task["eval_start"],
+            train_start=task.get("train_start"),
+            eval_end=task.get("eval_end"),
+            regressors=task.get("regressors"),
+            verbose=False,
+            cache_dir=cache_dir,
+            **params
+        )
+    except Exception as err:
+        return _task_metrics(task,error=repr(err),task_time=time.time()-start),None
+    metrics = results.eval_metrics_df.iloc[0].to_dict()
+    metrics.update({f"{stage}_time":seconds for stage,seconds in results.timings.items()})
+    return _task_metrics(task,task_time=time.time()-start,**metrics),(results if return_results else None)
+
+def _task_metrics(task,error=None,task_time=np.nan,**metrics):
+    # Row of the metrics table of train_prophet_models for a task
+    regressors = task.get("regressors")
+    params = task.get("params")
+    row = {
+        "location": task.get("location"),
+        "y": task.get("y"),
+        "eval_start": task.get("eval_start"),
+        "eval_end": task.get("eval_end"),
+        "regressors": ",".join(regressors) if isinstance(regressors,(list,tuple)) else ("" if regressors is None else str(regressors)),
+    }
+    if isinstance(params,dict):
+        row.update({f"param_{name}":value for name,value in params.items()})
+    for name in ["mse","mae","r2","mean_diff","trend_diff"]:
+        row[name] = metrics.get(name,np.nan)
+    for stage in ["prep","fit","predict","evaluate"]:
+        row[f"{stage}_time"] = metrics.get(f"{stage}_time",np.nan)
+    row["task_time"] = task_time
+    row["error"] = error
+    return row
 
 def train_clasp_model(
     madrid_df,
@@ -164,6 +802,8 @@ def train_clasp_model(
     train_start:str=None,
     train_end:str=None,
     verbose:bool=True,
+    cache_dir:str=None,
+    max_cache_bytes:int=2**30,
     **kwargs
     ):
     '''
@@ -194,6 +834,11 @@ def train_clasp_model(
         If a timedelta is given, the train period is the period from train_start to train_start + train_end.
     verbose : bool, optional
         If True, prints info about the training process.
+    cache_dir : str, optional
+        Directory where the fitted model, its profile and changepoints are cached (e.g: '../01-data/.cache/models').
+        They are loaded from it instead of fitting the model again if the time series and the parameters are the same.
+    max_cache_bytes : int, optional
+        Maximum size of the cached ClaSP models. The least recently used are removed when it is exceeded.
     **kwargs : dict
         Keyword arguments to be passed to the CLaSP model.
     
@@ -210,15 +855,14 @@ def train_clasp_model(
             containing the time of each changepoint and its 
             associated score.
     '''
-    ClaSPResults = namedtuple('ClaSPResults',['model','ts_df','changepoints_df'])
     if not verbose:
         logger.setLevel(logging.ERROR)
     if train_start is None:
         train_start = madrid_df.time.min()
     if train_end is None:
         train_end = madrid_df.time.max()
-    # Make time series dataframe for ClaSPSegmentation
-    df = madrid_df.copy().set_index(
+    # Make time series dataframe for ClaSPSegmentation (only with the data of the location)
+    df = madrid_df.loc[madrid_df[location_by]==location,[location_by,"time",y]].set_index(
         [location_by,"time"]
     ).groupby([pd.Grouper(level=location_by), 
                 pd.Grouper(level='time', freq='1D')]
@@ -229,8 +873,159 @@ def train_clasp_model(
                     .loc[:,y]\
                         .dropna()\
                             .sort_index().reset_index()
+    return _segment_clasp(ts_df,y,location,location_by,n_changepoints,period_length,cache_dir,max_cache_bytes,**kwargs)
+
+def train_clasp_models(
+    madrid_df:pd.DataFrame,
+    variables:list,
+    locations:list=None,
+    location_by:str="zone",
+    n_changepoints:int=10,
+    period_length:int=None,
+    train_start:str=None,
+    train_end:str=None,
+    n_jobs:int=None,
+    return_results:bool=False,
+    cache_dir:str=None,
+    max_cache_bytes:int=2**30,
+    **kwargs
+    ):
+    '''
+    Segments the daily time series of every variable at every location with ClaSP (as train_clasp_model does for one of them)
+    in a pool of n_jobs processes and returns the changepoints of all of them in a single dataframe.
+
+    The daily means of all the locations and variables are computed once as a location x day x variable array
+    (see src.preprocessing.gap_filling.to_dense_panel) instead of aggregating the whole dataframe for every series,
+    and each process only receives the series it segments.
+    A series that fails does not stop the rest: its error is reported in the "error" column of the changepoints.
+
+    e.g: train_clasp_models(traffic_df,["intensidad","carga"],location_by="cod_cent",n_changepoints=5,n_jobs=8)
+
+    Parameters
+    ----------
+    madrid_df : pandas.DataFrame
+        Dataframe with the air quality monitoring stations (or traffic) data.
+    variables : list
+        Names of the variables to segment.
+    locations : list, optional
+        Locations (values of the column location_by) to segment. If None, all of them.
+    location_by : str, optional
+        Name of the column in the dataframe that contains the location names.
+    n_changepoints, period_length, train_start, train_end, cache_dir, max_cache_bytes : optional
+        See train_clasp_model. They are the same for all the series.
+    n_jobs : int, optional
+        Number of processes. If 1, the series are segmented sequentially in the current process.
+    return_results : bool, optional
+        If True, a dict with the ClaSPResults of each (location,variable) (None if it failed) is returned too.
+    **kwargs : dict
+        Keyword arguments to be passed to the CLaSP models.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Dataframe with a row per changepoint with its location, variable, time, daily mean (value),
+        segment and score, and a row with the error of each series that failed.
+    dict, optional
+        ClaSPResults of each (location,variable) (if return_results is True).
+    '''
+    ClaSPResults = namedtuple('ClaSPResults',['model','ts_df','changepoints_df'])
+    variables = list(variables)
+    if madrid_df.index.name=="time":
+        madrid_df = madrid_df.reset_index()
+    if locations is not None:
+        madrid_df = madrid_df[madrid_df[location_by].isin(locations)]
+    # Location x day x variable array of daily means computed once for all the series
+    daily_df = madrid_df.groupby(
+        [location_by,pd.Grouper(key="time",freq="1D")]
+    )[variables].mean().reset_index()
+    # The train period is applied to the days (as in train_clasp_model)
+    if train_start is not None:
+        daily_df = daily_df[daily_df.time>=train_start]
+    if train_end is not None:
+        daily_df = daily_df[daily_df.time<=train_end]
+    cube,cube_locations,days = to_dense_panel(daily_df,variables,location_by=location_by,freq="1D")
+    series = [(i,j) for i in range(len(cube_locations)) for j in range(len(variables))]
+    params = dict(
+        n_changepoints=n_changepoints,period_length=period_length,
+        cache_dir=cache_dir,max_cache_bytes=max_cache_bytes,**kwargs
+    )
+    def task_args(i,j):
+        observed = ~np.isnan(cube[i,:,j])
+        ts_df = pd.DataFrame({"time":days[observed],variables[j]:cube[i,observed,j]})
+        return ts_df,variables[j],cube_locations[i],location_by,params,return_results
+    if n_jobs==1:
+        outputs = [_train_clasp_task(*task_args(i,j)) for i,j in series]
+    else:
+        outputs = []
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(_train_clasp_task,*task_args(i,j)) for i,j in series]
+            for (i,j),future in zip(series,futures):
+                try:
+                    outputs.append(future.result())
+                except Exception as err:
+                    outputs.append((_clasp_error_row(cube_locations[i],variables[j],location_by,err),None))
+    changepoints_df = pd.concat([rows for rows,_ in outputs],ignore_index=True) if outputs else pd.DataFrame()
+    changepoints_df = changepoints_df.reindex(columns=[location_by,"variable","time","value","segment","score","error"])
+    n_failed = changepoints_df.error.notna().sum()
+    if n_failed:
+        logger.warning(f"{n_failed} of {len(series)} series could not be segmented. See the error column of the changepoints")
+    if return_results:
+        results = {
+            (cube_locations[i],variables[j]): (ClaSPResults(**result) if result is not None else None)
+            for (i,j),(_,result) in zip(series,outputs)
+        }
+        return changepoints_df,results
+    return changepoints_df
+
+def _train_clasp_task(ts_df,y,location,location_by,params,return_results=False):
+    # Segments a series of train_clasp_models isolating its errors
+    try:
+        results = _segment_clasp(ts_df,y,location,location_by,**params)
+    except Exception as err:
+        return _clasp_error_row(location,y,location_by,err),None
+    # A series without changepoints has the first row of the series as changepoints_df (without scores)
+    changepoints_df = results.changepoints_df if "scores" in results.changepoints_df else results.changepoints_df.iloc[:0]
+    rows = pd.DataFrame({
+        location_by: location,
+        "variable": y,
+        "time": changepoints_df.time.values,
+        "value": changepoints_df[y].values,
+        "segment": changepoints_df.segment.values,
+        "score": changepoints_df.scores.values if "scores" in changepoints_df else np.nan,
+        "error": None,
+    })
+    # The namedtuple can not be pickled, so its fields are sent back
+    return rows,(results._asdict() if return_results else None)
+
+def _clasp_error_row(location,y,location_by,err):
+    return pd.DataFrame([{location_by:location,"variable":y,"error":repr(err)}])
+
+def _segment_clasp(
+    ts_df,
+    y,
+    location,
+    location_by,
+    n_changepoints=10,
+    period_length=None,
+    cache_dir=None,
+    max_cache_bytes=2**30,
+    **kwargs
+    ):
+    # Fits ClaSPSegmentation to the daily series ts_df (columns "time" and y) of train_clasp_model and train_clasp_models
+    ClaSPResults = namedtuple('ClaSPResults',['model','ts_df','changepoints_df'])
     if len(ts_df)==0:
         raise ValueError(f"No data for {y} at {location_by} {location} in the train period")
+    # Load the model and its results if it was already fit with the same time series and parameters
+    cache_key = None
+    if cache_dir is not None:
+        cache_key = make_cache_key(
+            frame_hash(ts_df),
+            model="clasp",n_changepoints=n_changepoints,period_length=period_length,params=kwargs,
+        )
+        cached = load_cached_object(cache_dir,"clasp",cache_key)
+        if cached is not None:
+            logger.info("Model and results loaded from the cache")
+            return ClaSPResults(**cached)
     # Extract the time series
     ts = ts_df[y]
     if period_length is None:
@@ -272,14 +1067,18 @@ def train_clasp_model(
     if len(found_changepoints) == 0:
         logger.warning(f"No changepoints found for {y} at {location_by} {location} in the train period")
         logger.warning(f"Try with a different value for period_length")
-        return ClaSPResults(clasp, ts_df, ts_df.iloc[[0],:])
-
-    logger.info(f"{len(found_changepoints)} CHANGEPOINT(S) DETECTED")
-    cps = list(set(found_changepoints.to_list()))
-    change_points_df = ts_df.iloc[cps].copy()
-    change_points_df["scores"] = scores
+        results = ClaSPResults(clasp, ts_df, ts_df.iloc[[0],:])
+    else:
+        logger.info(f"{len(found_changepoints)} CHANGEPOINT(S) DETECTED")
+        cps = list(set(found_changepoints.to_list()))
+        change_points_df = ts_df.iloc[cps].copy()
+        change_points_df["scores"] = scores
+        results = ClaSPResults(clasp, ts_df, change_points_df)
 
-    return ClaSPResults(clasp, ts_df, change_points_df)
+    if cache_key is not None:
+        # The namedtuple is defined in this function so its fields are pickled instead
+        save_cached_object(results._asdict(),cache_dir,"clasp",cache_key,max_bytes=max_cache_bytes)
+    return results
 
 class suppress_stdout_stderr(object):
     '''
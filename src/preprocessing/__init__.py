@@ -1,4 +1,6 @@
 from .preprocess_utils import *
-from .netcdf_to_pandas import netcdf_to_pandas
+from .netcdf_to_pandas import netcdf_to_pandas, netcdf_dir_to_pandas, netcdf_to_stations, grid_point_weights, MADRID_BBOX
 from .clean_traffic_locations_raw import clean_traffic_locations_raw
-from ._weight_nearby_traffic import weight_nearby_traffic
\ No newline at end of file
+from ._weight_nearby_traffic import weight_nearby_traffic
+from .spatial_index import TrafficSensorIndex
+from .gap_filling import fill_gaps, fill_frame_gaps, fill_panel_gaps, to_dense_panel
@@ -2,7 +2,7 @@ import pandas as pd
 import numpy as np
 
 
-def weight_nearby_traffic(coord: tuple,km_dist: float,traffic_df: pd.DataFrame,traffic_locations_df: pd.DataFrame):
+def weight_nearby_traffic(coord: tuple,km_dist: float,traffic_df: pd.DataFrame,traffic_locations_df: pd.DataFrame,sensor_index=None):
     '''
     Computes the weighted traffic intensity and average load of traffic stations nearby a given coordinate.
 
@@ -16,18 +16,35 @@ def weight_nearby_traffic(coord: tuple,km_dist: float,traffic_df: pd.DataFrame,t
         Traffic data. E.g: Obtained from src.get_data.get_traffic_data().
     traffic_locations_df: pandas.DataFrame
         Traffic stations locations. E.g: Obtained from src.get_data.get_traffic_locations().
+    sensor_index: src.preprocessing.TrafficSensorIndex, optional
+        Spatial index over traffic_locations_df. If given, it is used to find the traffic stations
+        nearby instead of computing the distances to all of them (the results are the same).
     
     Returns
     -------
     pandas.DataFrame
         Dataframe with the weighted traffic intensity and average load of traffic stations nearby a given coordinate.
     '''
-    # Compute distance between traffic stations and point of interest
-    km_distances = haversine_dist(coord[0],coord[1],traffic_locations_df.latitud,traffic_locations_df.longitud)
-    # Filter those stations that are within km_dist of the point of interest
-    traffic_stations_nearby = traffic_locations_df.loc[km_distances<=km_dist,["cod_cent"]]\
-                                .assign(km_dist=km_distances[km_distances<=km_dist])\
-                                    .set_index("cod_cent")
+    if sensor_index is not None:
+        # The distances of this function are computed with the latitude and longitude swapped (see below), which are
+        # at most 1/cos(longitude) times shorter than the great-circle distances of the index, so the stations
+        # within km_dist are among the ones the index finds within that (slightly larger) radius
+        candidates_dist = km_dist/np.cos(np.radians(abs(coord[1])+1))
+        (positions,_), = sensor_index.query_radius([coord],candidates_dist)
+        km_distances = haversine_dist(coord[0],coord[1],sensor_index.latitud[positions],sensor_index.longitud[positions])
+        nearby = km_distances<=km_dist
+        traffic_stations_nearby = pd.DataFrame(
+            {"km_dist":km_distances[nearby]},
+            index=pd.Index(sensor_index.cod_cent[positions[nearby]],name="cod_cent")
+        )
+    else:
+        # Compute distance between traffic stations and point of interest
+        # (coord is (lat,long) but haversine_dist takes (long,lat): kept as in the original code so that the results do not change)
+        km_distances = haversine_dist(coord[0],coord[1],traffic_locations_df.latitud,traffic_locations_df.longitud)
+        # Filter those stations that are within km_dist of the point of interest
+        traffic_stations_nearby = traffic_locations_df.loc[km_distances<=km_dist,["cod_cent"]]\
+                                    .assign(km_dist=km_distances[km_distances<=km_dist])\
+                                        .set_index("cod_cent")
     # Weight the traffic intensity by the distance to the point of interest
     traffic_nearby_df = traffic_df\
         .loc[traffic_df.cod_cent.isin(traffic_stations_nearby.index)]\
@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+
+# Flags of the bitmask returned by fill_gaps with the step that imputed each cell
+INTERPOLATED = 1
+SEASONAL = 2
+FORWARD_FILLED = 4
+
+def fill_gaps(values,limit:int=6,season:int=None,ffill_limit:int=0):
+    '''
+    Fills the missing values of a dense array of shape (locations,times,variables) (or (times,variables))
+    for all the locations and variables at once, applying in this order:
+
+    1. Linear interpolation of at most limit consecutive missing values (the same as pandas.DataFrame.interpolate(limit=limit),
+       so the values after the last observation are filled with it and the ones before the first are left missing).
+    2. If season is given, the mean of the observed values at the same position of the period of season time steps
+       (e.g: season=24 with hourly data fills with the mean of the same hour of the day) of each location and variable.
+    3. Forward fill of at most ffill_limit consecutive missing values (0 to skip this step, None for no limit).
+
+    Parameters
+    ----------
+    values : numpy.array
+        Array of floats with the time steps in the second to last axis.
+    limit : int, optional
+        Maximum number of consecutive missing values interpolated (0 to skip this step).
+    season : int, optional
+        Length of the seasonal period in time steps.
+    ffill_limit : int, optional
+        Maximum number of consecutive missing values forward filled.
+
+    Returns
+    -------
+    filled : numpy.array
+        Array with the same shape as values with the missing values filled.
+    imputed : numpy.array
+        Bitmask of dtype uint8 with the same shape as values with the flag of the step that filled each cell
+        (INTERPOLATED, SEASONAL or FORWARD_FILLED) and 0 for the observed cells and the ones still missing.
+    '''
+    values = np.asarray(values,dtype=float)
+    squeeze = values.ndim==2
+    filled = values[None].copy() if squeeze else values.copy()
+    imputed = np.zeros(filled.shape,dtype=np.uint8)
+    n_times = filled.shape[1]
+    steps = np.arange(n_times).reshape(1,-1,1)
+    observed = ~np.isnan(filled)
+    # The seasonal profile is computed only with the observed values
+    profile = _seasonal_profile(filled,season) if season and n_times else None
+    if limit and n_times:
+        prev_idx = _prev_valid_index(observed)
+        next_idx = _next_valid_index(observed)
+        fill = ~observed & (prev_idx>=0) & (steps-prev_idx<=limit)
+        prev_values = np.take_along_axis(filled,np.maximum(prev_idx,0),axis=1)
+        next_values = np.take_along_axis(filled,np.minimum(next_idx,n_times-1),axis=1)
+        with np.errstate(invalid="ignore",divide="ignore"):
+            slope = (next_values-prev_values)/(next_idx-prev_idx)
+            interpolated = np.where(next_idx<n_times,slope*(steps-prev_idx)+prev_values,prev_values)
+        filled[fill] = interpolated[fill]
+        imputed[fill] = INTERPOLATED
+    if profile is not None:
+        seasonal = np.take(profile,np.arange(n_times)%season,axis=1)
+        fill = np.isnan(filled) & ~np.isnan(seasonal)
+        filled[fill] = seasonal[fill]
+        imputed[fill] = SEASONAL
+    if ffill_limit!=0 and n_times:
+        valid = ~np.isnan(filled)
+        prev_idx = _prev_valid_index(valid)
+        fill = ~valid & (prev_idx>=0)
+        if ffill_limit is not None:
+            fill &= steps-prev_idx<=ffill_limit
+        ffilled = np.take_along_axis(filled,np.maximum(prev_idx,0),axis=1)
+        filled[fill] = ffilled[fill]
+        imputed[fill] = FORWARD_FILLED
+    if squeeze:
+        return filled[0],imputed[0]
+    return filled,imputed
+
+def fill_frame_gaps(df:pd.DataFrame,columns:list=None,**kwargs):
+    '''
+    Fills the missing values of the float columns (or the given columns) of a dataframe
+    with fill_gaps along its rows (in their current order). The rest of columns are returned unchanged.
+    Returns the filled dataframe and a dataframe with the same index and the bitmask of the imputed cells of those columns.
+    e.g: fill_frame_gaps(df.set_index("time"),limit=6) fills the same values as df.set_index("time").interpolate(limit=6)
+    '''
+    if columns is None:
+        columns = [col for col in df.columns if pd.api.types.is_float_dtype(df[col].dtype)]
+    filled,imputed = fill_gaps(df[columns].to_numpy(dtype=float),**kwargs)
+    df = df.copy()
+    for i,col in enumerate(columns):
+        df[col] = filled[:,i]
+    return df,pd.DataFrame(imputed,index=df.index,columns=columns)
+
+def fill_panel_gaps(
+    df:pd.DataFrame,
+    columns:list=None,
+    location_by:str="estacion",
+    freq:str="60min",
+    **kwargs
+    ):
+    '''
+    Reshapes the data of all the locations (e.g: of src.get_data.get_air_quality_df) into a dense
+    location x time x variable array on a regular time grid of frequency freq, fills its gaps with fill_gaps
+    (e.g: fill_panel_gaps(aq_df,limit=6,season=24,ffill_limit=3)) and returns it back as dataframes.
+
+    Returns
+    -------
+    filled_df : pandas.DataFrame
+        Dataframe with the columns "time", location_by and columns with a row for every location and time of the grid.
+    imputed_df : pandas.DataFrame
+        Dataframe with the same rows and the bitmask of the imputed cells of each variable.
+    '''
+    if columns is None:
+        columns = [col for col in df.columns if pd.api.types.is_float_dtype(df[col].dtype)]
+    values,locations,times = to_dense_panel(df,columns,location_by=location_by,freq=freq)
+    filled,imputed = fill_gaps(values,**kwargs)
+    index_df = pd.DataFrame({
+        "time": np.tile(times,len(locations)),
+        location_by: np.repeat(locations,len(times)),
+    })
+    filled_df = pd.concat([index_df,pd.DataFrame(filled.reshape(-1,len(columns)),columns=columns)],axis=1)
+    imputed_df = pd.concat([index_df,pd.DataFrame(imputed.reshape(-1,len(columns)),columns=columns)],axis=1)
+    return filled_df,imputed_df
+
+def to_dense_panel(df:pd.DataFrame,columns:list,location_by:str="estacion",freq:str="60min"):
+    '''
+    Returns the values of columns of df as a dense array of shape (locations,times,variables)
+    on a regular time grid of frequency freq from the first to the last time of df (NaN where there is no data),
+    together with the locations and times of its first two axes. Duplicated (location,time) rows keep the last value.
+    '''
+    locations = np.sort(df[location_by].dropna().unique())
+    times = pd.date_range(df.time.min(),df.time.max(),freq=freq)
+    values = np.full((len(locations),len(times),len(columns)),np.nan)
+    location_idx = pd.Index(locations).get_indexer(df[location_by])
+    time_idx = times.get_indexer(df.time)
+    known = (location_idx>=0) & (time_idx>=0)
+    values[location_idx[known],time_idx[known]] = df.loc[known,columns].to_numpy(dtype=float)
+    return values,locations,times
+
+def _prev_valid_index(valid):
+    # Index along axis 1 of the last valid cell up to each cell (-1 if there is none)
+    steps = np.arange(valid.shape[1]).reshape(1,-1,1)
+    return np.maximum.accumulate(np.where(valid,steps,-1),axis=1)
+
+def _next_valid_index(valid):
+    # Index along axis 1 of the next valid cell from each cell (the length of the axis if there is none)
+    n_times = valid.shape[1]
+    steps = np.arange(n_times).reshape(1,-1,1)
+    return np.minimum.accumulate(np.where(valid,steps,n_times)[:,::-1],axis=1)[:,::-1]
+
+def _seasonal_profile(values,season):
+    # Mean of the values at each position of the period of season steps, shape (locations,season,variables)
+    n_locations,n_times,n_vars = values.shape
+    n_periods = -(-n_times//season)
+    padded = np.full((n_locations,n_periods*season,n_vars),np.nan)
+    padded[:,:n_times] = values
+    periods = padded.reshape(n_locations,n_periods,season,n_vars)
+    counts = (~np.isnan(periods)).sum(axis=1)
+    with np.errstate(invalid="ignore",divide="ignore"):
+        return np.nansum(periods,axis=1)/np.where(counts>0,counts,np.nan)
@@ -2,64 +2,282 @@ import pandas as pd
 import numpy as np
 
 from datetime import datetime as dt
-import os
+from concurrent.futures import ProcessPoolExecutor
+import os, glob, warnings
 
 # To handle netcdf files
 import netCDF4
 from netCDF4 import num2date
 
+# (lat_min,lat_max,lon_min,lon_max) of the area around the city of Madrid covered by the ERA5 grid (0.25º)
+MADRID_BBOX = (40.25,40.75,-4.0,-3.5)
 
-def netcdf_to_pandas(fsource):
-    # print("Processing netcdf file...")
+def netcdf_to_pandas(fsource,variables=None,bbox=None,time_chunksize=24*31):
+    '''
+    Reads a netCDF file of ERA5 data (e.g: downloaded from Copernicus) into a pandas.DataFrame
+    with one row per time and grid cell (and a column per variable), dropping the rows without data.
+
+    Only the requested variables and the grid cells inside bbox are read from the file, and the time axis
+    is read in chunks of time_chunksize steps, so the memory used depends on the size of the result
+    and not on the size of the file.
+
+    Parameters
+    ----------
+    fsource : str
+        Path to the netCDF file.
+    variables : list, optional
+        Variables to read (by their name in the file or their short name, e.g: "t2m"). Defaults to all.
+    bbox : tuple, optional
+        (lat_min,lat_max,lon_min,lon_max) of the grid cells to read (longitudes in [-180,180]).
+        e.g: MADRID_BBOX. Defaults to the whole grid.
+    time_chunksize : int, optional
+        Number of time steps read at once.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The index of each row is its position in the full (time x ... x latitude x longitude) grid of the file.
+    '''
     data = netCDF4.Dataset(fsource)
-    data_vars = data.variables
+    try:
+        data_vars = data.variables
+        # Extract measurement variable
+        var_names = [name for name in data_vars]
+        var1 = data_vars[var_names[5]]
+        dim_names = list(var1.dimensions)
+        value_names = [
+            name for name in var_names
+            if name not in dim_names and (variables is None or name in variables or name.split("_")[0] in variables)
+        ]
+        # Coordinates of each dimension (longitudes converted to [-180,180] once) and the indices to read of each one
+        coords,indices = {},{}
+        for name in dim_names:
+            if "time" in name:
+                coords[name] = None
+                indices[name] = np.arange(len(data.dimensions[name]))
+                continue
+            values = np.asarray(data_vars[name][:])
+            if "lon" in name:
+                values = np.where(values>180,values-360,values)
+            coords[name] = values
+            indices[name] = np.arange(len(values))
+            if bbox is not None and ("lat" in name or "lon" in name):
+                vmin,vmax = bbox[:2] if "lat" in name else bbox[2:]
+                indices[name] = np.flatnonzero((values>=vmin) & (values<=vmax))
+        shape = [len(data.dimensions[name]) for name in dim_names]
+        columns = [name for name in dim_names if name!="level"] + [name.split("_")[0] for name in value_names]
+        if any(len(idx)==0 for idx in indices.values()):
+            return pd.DataFrame(columns=columns)
+        time_name = next((name for name in dim_names if "time" in name),None)
+        time_indices = indices[time_name] if time_name is not None else [None]
+        chunks = []
+        for start in range(0,len(time_indices),time_chunksize if time_name is not None else 1):
+            chunk_indices = dict(indices)
+            if time_name is not None:
+                chunk_indices[time_name] = time_indices[start:start+time_chunksize]
+            chunks.append(_read_chunk(data_vars,dim_names,value_names,coords,chunk_indices,shape))
+        df = pd.concat(chunks) if len(chunks)>1 else chunks[0]
+    finally:
+        data.close()
+    return df
+
+def netcdf_dir_to_pandas(dir_path,pattern="*.nc",n_jobs=None,locations_df=None,**kwargs):
+    '''
+    Reads all the netCDF files of a directory (e.g: one per month) with netcdf_to_pandas in a pool of n_jobs processes
+    and returns them concatenated in the order of their file names.
+    If locations_df is given, the time series of each station are extracted with netcdf_to_stations instead.
+    kwargs are passed to netcdf_to_pandas. e.g: netcdf_dir_to_pandas('../01-data/raw/copernicus',bbox=MADRID_BBOX,variables=["t2m","tp"])
+    '''
+    fpaths = sorted(glob.glob(os.path.join(dir_path,pattern)))
+    if not fpaths:
+        raise AttributeError(f"No files matching {pattern} in {dir_path}")
+    if locations_df is not None:
+        kwargs = {**kwargs,"locations_df":locations_df}
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        dfs = list(pool.map(_netcdf_to_pandas_kwargs,fpaths,[kwargs]*len(fpaths)))
+    return pd.concat(dfs,ignore_index=True)
 
-    # Extract measurement variable
-    var_names = [name for name in data_vars]
+def netcdf_to_stations(
+    fsource,
+    locations_df,
+    variables=None,
+    method="bilinear",
+    location_by="estacion",
+    time_chunksize=24*31,
+    weights=None,
+    ):
+    '''
+    Extracts the time series of the variables of a netCDF file of ERA5 data at the location of each station
+    (e.g: of src.get_data.get_air_locations_df) instead of the whole grid.
 
-    var1 = data_vars[var_names[5]]
+    The grid cells and weights of every station are computed once (see grid_point_weights) and the time series
+    of all the stations are taken from each chunk of time_chunksize steps of the netCDF arrays with them,
+    reading only the block of the grid that contains those cells.
+    Other dimensions besides time, latitude, and longitude (e.g: expver) are averaged ignoring missing values.
 
-    dims = []
-    for dim in var1.get_dims():
-        if "time" in dim.name:
-            time_var = data_vars[dim.name]
-            tstart = dt.strptime(time_var.units.split(" ")[-2], "%Y-%m-%d").strftime(
-                "%Y-%m-%d"
+    Parameters
+    ----------
+    fsource : str
+        Path to the netCDF file.
+    locations_df : pandas.DataFrame
+        Locations of the stations with the columns location_by, "latitud", and "longitud".
+    variables : list, optional
+        Variables to read (by their name in the file or their short name, e.g: "t2m"). Defaults to all.
+    method : str, optional
+        "bilinear" to interpolate the 4 cells around each station or "nearest" to use the closest one.
+    weights : tuple, optional
+        (lat_idx,lon_idx,weights) already computed with grid_point_weights for the grid of the file and the
+        stations of locations_df (e.g: to reuse them for many files with the same grid).
+
+    Returns
+    -------
+    pandas.DataFrame
+        Dataframe with the columns "time", location_by and one per variable (by short name).
+    '''
+    data = netCDF4.Dataset(fsource)
+    try:
+        data_vars = data.variables
+        var_names = [name for name in data_vars]
+        var1 = data_vars[var_names[5]]
+        dim_names = list(var1.dimensions)
+        value_names = [
+            name for name in var_names
+            if name not in dim_names and (variables is None or name in variables or name.split("_")[0] in variables)
+        ]
+        time_name = next(name for name in dim_names if "time" in name)
+        lat_name = next(name for name in dim_names if "lat" in name)
+        lon_name = next(name for name in dim_names if "lon" in name)
+        if weights is None:
+            grid_lons = np.asarray(data_vars[lon_name][:])
+            weights = grid_point_weights(
+                locations_df.latitud.values,
+                locations_df.longitud.values,
+                np.asarray(data_vars[lat_name][:]),
+                np.where(grid_lons>180,grid_lons-360,grid_lons),
+                method=method,
             )
-            time_unit = time_var.units + " since " + tstart
-            times = num2date(
-                time_var[:],
-                time_unit,
-                only_use_cftime_datetimes=False,
-                only_use_python_datetimes=True,
+        lat_idx,lon_idx,point_weights = weights
+        # Block of the grid that contains the cells of all the stations
+        lat_slice = slice(int(lat_idx.min()),int(lat_idx.max())+1)
+        lon_slice = slice(int(lon_idx.min()),int(lon_idx.max())+1)
+        lat_idx,lon_idx = lat_idx-lat_slice.start,lon_idx-lon_slice.start
+        other_axes = tuple(i for i,name in enumerate(dim_names) if name not in (time_name,lat_name,lon_name))
+        axes_order = [dim_names.index(name) for name in (time_name,lat_name,lon_name)]
+        stations = locations_df[location_by].values
+        n_times = len(data.dimensions[time_name])
+        chunks = []
+        for start in range(0,n_times,time_chunksize):
+            time_slice = slice(start,min(start+time_chunksize,n_times))
+            key = tuple(
+                time_slice if name==time_name else lat_slice if name==lat_name else lon_slice if name==lon_name else slice(None)
+                for name in dim_names
             )
-            dims.append(times)
-        elif "lon" in dim.name:
-            longitudes = data_vars[dim.name][:]
-            longitudes[longitudes > 180] = -360 + longitudes[longitudes > 180]
-            dims.append(longitudes)
-        else:
-            dims.append(data_vars[dim.name][:])
+            times = _read_times(data_vars[time_name],np.arange(time_slice.start,time_slice.stop))
+            data_dict = {
+                "time": np.repeat(np.asarray(times),len(stations)),
+                location_by: np.tile(stations,len(times)),
+            }
+            for name in value_names:
+                values = np.ma.filled(data_vars[name][key].astype(float),np.nan)
+                if other_axes:
+                    with warnings.catch_warnings():
+                        # Mean of cells without data in any of the other dimensions
+                        warnings.simplefilter("ignore",category=RuntimeWarning)
+                        values = np.nanmean(values,axis=other_axes,keepdims=True)
+                values = np.moveaxis(values,axes_order,[0,1,2]).reshape(
+                    len(times),lat_slice.stop-lat_slice.start,lon_slice.stop-lon_slice.start
+                )
+                data_dict[name.split("_")[0]] = _weighted_points(values,lat_idx,lon_idx,point_weights).ravel()
+            df = pd.DataFrame(data_dict)
+            nullrows = df[df.columns[2:]].isnull().all(axis=1)
+            chunks.append(df[~nullrows])
+    finally:
+        data.close()
+    return pd.concat(chunks,ignore_index=True)
 
-    grids = [x.flatten() for x in np.meshgrid(*dims, indexing="ij")]
+def grid_point_weights(lats,lons,grid_lats,grid_lons,method="bilinear"):
+    '''
+    Returns the (lat_idx,lon_idx,weights) arrays of shape (len(lats),k) with the indices in a regular grid of the k cells
+    used to get the value at each (lats,lons) point and their weights:
+    k=4 for bilinear interpolation (method="bilinear") and k=1 for the nearest cell (method="nearest").
+    '''
+    if method not in ("bilinear","nearest"):
+        raise ValueError(f"Unknown method {method}. Must be 'bilinear' or 'nearest'")
+    lat_idx,lat_weights = _axis_weights(np.asarray(lats,dtype=float),np.asarray(grid_lats,dtype=float),method)
+    lon_idx,lon_weights = _axis_weights(np.asarray(lons,dtype=float),np.asarray(grid_lons,dtype=float),method)
+    k = lon_idx.shape[1]
+    return (
+        np.repeat(lat_idx,k,axis=1),
+        np.tile(lon_idx,(1,lat_idx.shape[1])),
+        np.repeat(lat_weights,k,axis=1)*np.tile(lon_weights,(1,lat_weights.shape[1])),
+    )
 
-    dims_dict = {var1.dimensions[i]: grid for i, grid in enumerate(grids)}
+def _axis_weights(values,grid,method):
+    # Indices and weights along one axis of the grid (which can be in descending order)
+    order = np.argsort(grid)
+    sorted_grid = grid[order]
+    if len(grid)==1:
+        return np.zeros((len(values),1),dtype=np.int64),np.ones((len(values),1))
+    pos = np.clip(np.searchsorted(sorted_grid,values),1,len(grid)-1)
+    lower,upper = pos-1,pos
+    frac = np.clip((values-sorted_grid[lower])/(sorted_grid[upper]-sorted_grid[lower]),0,1)
+    if method=="nearest":
+        nearest = np.where(frac<0.5,lower,upper)
+        return order[nearest][:,None],np.ones((len(values),1))
+    return np.stack([order[lower],order[upper]],axis=1),np.stack([1-frac,frac],axis=1)
 
-    vars_dict = {
-        var_name.split("_")[0]: data_vars[var_name][:].flatten()
-        for var_name in var_names
-        if var_name not in dims_dict
-    }
+def _weighted_points(values,lat_idx,lon_idx,weights):
+    # Weighted average of the cells of each point in every time step (values has shape (time,lat,lon)) ignoring missing cells
+    cells = values[:,lat_idx,lon_idx]
+    available = ~np.isnan(cells)
+    total = (weights*available).sum(axis=-1)
+    with np.errstate(invalid="ignore",divide="ignore"):
+        return (np.where(available,cells,0)*weights).sum(axis=-1)/np.where(total>0,total,np.nan)
 
-    data_dict = {**dims_dict, **vars_dict}
+def _netcdf_to_pandas_kwargs(fsource,kwargs):
+    if "locations_df" in kwargs:
+        return netcdf_to_stations(fsource,**kwargs)
+    return netcdf_to_pandas(fsource,**kwargs)
 
-    if "level" in data_dict:
-        data_dict.pop("level")
+def _read_chunk(data_vars,dim_names,value_names,coords,indices,shape):
+    # Reads the values of the given indices of each dimension (slices where they are contiguous)
+    key = tuple(_as_slice(indices[name]) for name in dim_names)
+    # Position of each row in the indices read of each dimension
+    positions = [
+        grid.ravel() for grid in np.meshgrid(*[np.arange(len(indices[name])) for name in dim_names],indexing="ij")
+    ]
+    data_dict = {}
+    for i,name in enumerate(dim_names):
+        if name=="level":
+            continue
+        if coords[name] is None:
+            values = _read_times(data_vars[name],indices[name])
+        else:
+            values = coords[name][indices[name]]
+        data_dict[name] = np.asarray(values)[positions[i]]
+    for name in value_names:
+        data_dict[name.split("_")[0]] = data_vars[name][key].flatten()
+    index = np.ravel_multi_index([indices[name][positions[i]] for i,name in enumerate(dim_names)],shape)
+    df = pd.DataFrame(data_dict,index=index)
+    if "latitude" in df.columns and "longitude" in df.columns:
+        df[["latitude", "longitude"]] = df[["latitude", "longitude"]].astype(float).round(4)
+    value_cols = df.columns[~df.columns.isin(dim_names)]
+    nullrows = df[value_cols].isnull().all(axis=1)
+    return df[~nullrows]
 
-    df = pd.DataFrame(data_dict)
-    df[["latitude", "longitude"]] = df[["latitude", "longitude"]].astype(float).round(4)
-    nullrows = df[df.columns[~df.columns.isin(var1.dimensions)]].isnull().all(axis=1)
-    df = df[~nullrows]
+def _read_times(time_var,indices):
+    tstart = dt.strptime(time_var.units.split(" ")[-2], "%Y-%m-%d").strftime(
+        "%Y-%m-%d"
+    )
+    time_unit = time_var.units + " since " + tstart
+    return num2date(
+        time_var[_as_slice(indices)],
+        time_unit,
+        only_use_cftime_datetimes=False,
+        only_use_python_datetimes=True,
+    )
 
-    # print("Process done.")
-    return df
+def _as_slice(indices):
+    if len(indices) and indices[-1]-indices[0]==len(indices)-1:
+        return slice(int(indices[0]),int(indices[-1])+1)
+    return indices
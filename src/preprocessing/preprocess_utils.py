@@ -5,42 +5,67 @@ import pandas as pd
 def preprocess_madrid_aq_data(df_raw,parameters_dict):
     '''
     Para realizar el preprocesado de datos de calidad de aire y meteorologicos de Madrid
+
+    Transforma los datos horarios en bruto (una fila por estacion, punto de muestreo y dia con las
+    columnas H01..H24 y V01..V24) a una fila por fecha (hora) y estacion con una columna por parametro.
+    Todo el proceso esta vectorizado: los parametros se obtienen una vez por punto de muestreo,
+    las fechas se calculan aritmeticamente y los valores se reordenan con numpy en un solo paso.
     '''
-    df = df_raw.copy()
     #Eliminar valores nulos de punto muestreo
-    df.dropna(how='any',subset=['PUNTO_MUESTREO'],inplace=True)
-    #Definir parametros leibles de acuerdo a la tabla de indicadores
-    df['PARAMETRO'] = df.PUNTO_MUESTREO.apply(lambda x: parameters_dict[int(x.split('_')[1])]['parametro'])
-    df['UNIDAD'] = df.PUNTO_MUESTREO.apply(lambda x: parameters_dict[int(x.split('_')[1])]['unidad'])
-    #Obtener columna de fecha
-    df['FECHA'] = df.ANO.astype(int).astype(str) + '-' + df.MES.astype(int).astype(str).str.zfill(2) + '-' + df.DIA.astype(int).astype(str).str.zfill(2)
-    #Hacer un melt
+    df = df_raw.dropna(how='any',subset=['PUNTO_MUESTREO'])
+    #Definir parametros leibles de acuerdo a la tabla de indicadores (una vez por punto de muestreo)
+    puntos_codes,puntos = pd.factorize(df.PUNTO_MUESTREO)
+    puntos_parametros = []
+    for punto in puntos:
+        indicator = parameters_dict[int(punto.split('_')[1])]
+        puntos_parametros.append((indicator['parametro']+' ('+indicator['unidad']+')').lower())
+    parametros = np.unique(puntos_parametros)
+    parametro_codes = np.searchsorted(parametros,puntos_parametros)[puntos_codes]
+    #Remover duplicados (mismo dia, estacion y parametro)
+    id_cols = ['PROVINCIA','MUNICIPIO','ESTACION']
+    dates = pd.to_datetime(pd.DataFrame({
+        'year': df.ANO.astype(int).values,
+        'month': df.MES.astype(int).values,
+        'day': df.DIA.astype(int).values,
+    })).values
+    keys = df[id_cols].assign(fecha=dates,parametro=parametro_codes)
+    first_rows = ~keys.duplicated(keep='first').values
+    df,dates,parametro_codes = df[first_rows],dates[first_rows],parametro_codes[first_rows]
+    #Valores de cada hora (las columnas de validacion no modifican el resultado)
     measurement_cols = df.columns[(df.columns.str.startswith('H'))]
-    validation_cols = df.columns[(df.columns.str.startswith('V'))] 
-    df = (
-      df[['FECHA','PROVINCIA', 'MUNICIPIO', 'ESTACION', 'MAGNITUD','PARAMETRO','UNIDAD']+measurement_cols.tolist()+validation_cols.tolist()]
-      .melt(['FECHA','PROVINCIA', 'MUNICIPIO', 'ESTACION', 'MAGNITUD','PARAMETRO','UNIDAD'])
-    )
-    #remover no validadas
-    df = df[~((df.variable.str.startswith('V'))&(df.value!='V'))]
-    df = df[df.variable.str.startswith('H')].rename(columns={'variable':'TIME'})
-    #Unir Fecha y horas
-    df['value'] = df['value'].astype(float)
+    values = df[measurement_cols].to_numpy(dtype=float)
     #Valores negativos deberian ser nans
-    df['value'] = np.where(df['value']<0,0,df['value'])
-    df['TIME'] = ''+df['TIME'].str.replace('H','').str.replace('24','00')+':00:00'
-    df['FECHA'] = pd.to_datetime(df['FECHA'] + ' ' + df['TIME'])
-    df = df.drop(columns='TIME')
-    #Unir parametro y unidad
-    df.columns=df.columns.str.lower().tolist()
-    df['parametro'] = (df['parametro']+' ('+df['unidad']+')').str.lower()
-    #Remover duplicados y unmelt
-    df = (df
-        .drop_duplicates(subset=['fecha','provincia','municipio','estacion','parametro','unidad'])
-        .set_index(['fecha','provincia','municipio','estacion','parametro'])['value']
-        .unstack()
-        .reset_index().sort_values('fecha')
-    )
+    values = np.where(values<0,0,values)
+    #Unir Fecha y horas (H24 corresponde a las 00:00 del mismo dia) como horas desde la primera fecha
+    hours = np.array([int(col.replace('H','').replace('24','00')) for col in measurement_cols])
+    dates = dates.astype('datetime64[h]')
+    first_date = dates.min() if len(dates) else np.datetime64(0,'h')
+    time_codes = (dates-first_date).astype(np.int64)[:,None] + hours[None,:]
+    #Una fila por fecha y estacion (ordenadas como en un unstack) y una columna por parametro
+    station_codes = df.groupby(id_cols,sort=True).ngroup().values
+    n_stations = station_codes.max()+1 if len(station_codes) else 1
+    row_ids = (time_codes*n_stations + station_codes[:,None]).ravel()
+    present_rows = np.zeros(row_ids.max()+1 if len(row_ids) else 0,dtype=bool)
+    present_rows[row_ids] = True
+    unique_rows = np.flatnonzero(present_rows)
+    row_codes = (np.cumsum(present_rows)-1)[row_ids]
+    present = np.flatnonzero(np.bincount(parametro_codes,minlength=len(parametros)))
+    col_codes = np.zeros(len(parametros),dtype=np.int64)
+    col_codes[present] = np.arange(len(present))
+    col_codes = np.repeat(col_codes[parametro_codes],len(hours))
+    table = np.full((len(unique_rows),len(present)),np.nan)
+    table[row_codes,col_codes] = values.ravel()
+    # Identificadores de cada estacion con sus tipos originales
+    station_rows = np.zeros(n_stations,dtype=np.int64)
+    station_rows[station_codes[::-1]] = np.arange(len(station_codes))[::-1]
+    row_stations = station_rows[unique_rows%n_stations] if len(station_codes) else station_rows[:0]
+    df = pd.concat([
+        pd.DataFrame({
+            'fecha': (first_date + unique_rows//n_stations).astype('datetime64[ns]'),
+            **{col.lower():df[col].values[row_stations] for col in id_cols},
+        }),
+        pd.DataFrame(table,columns=parametros[present]),
+    ],axis=1).sort_values('fecha')
     df.columns = df.columns.str.lower().tolist()
     return df
 
@@ -0,0 +1,238 @@
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from scipy import sparse
+from sklearn.neighbors import BallTree
+
+from ._weight_nearby_traffic import haversine_dist
+
+EARTH_RADIUS_KM = 6371
+
+def logistic_kernel(km_dist,center=0.38,steepness=15):
+    '''
+    Sigmoid weight of a traffic measurement point at km_dist km from a location (~1 nearby, 0.5 at center km, ~0 far away).
+    '''
+    return np.exp(-np.logaddexp(0, (km_dist-center)*steepness))
+
+def gaussian_kernel(km_dist,bandwidth=0.38):
+    '''
+    Gaussian weight of a traffic measurement point at km_dist km from a location (1 at the location, ~0.6 at bandwidth km).
+    '''
+    return np.exp(-0.5*(km_dist/bandwidth)**2)
+
+def inverse_distance_kernel(km_dist,min_dist=0.05):
+    '''
+    Inverse-distance weight of a traffic measurement point at km_dist km from a location (1 up to min_dist km).
+    '''
+    return min_dist/np.maximum(km_dist,min_dist)
+
+# Distance kernels that can be used to weight the traffic intensity by name
+DISTANCE_KERNELS = {
+    "logistic": logistic_kernel,
+    "gaussian": gaussian_kernel,
+    "inverse_distance": inverse_distance_kernel,
+}
+
+class TrafficSensorIndex:
+    '''
+    Spatial index (BallTree) over the traffic measurement points of the city of Madrid
+    to find the points nearby any location without computing the distances to all of them.
+
+    The sparse location x sensor weight matrices computed with it are cached, so that the
+    traffic features of many locations and hours can be computed as a single sparse product
+    (see nearby_traffic_matrices). Scans of the tree are cached too, so weights for other kernels
+    or smaller radii over the same locations are derived from the same scan. Only the max_cached
+    most recently used scans and matrices are kept.
+
+    The distances are great-circle distances between the (lat,long) coordinates. Note that they are not the
+    distances of weight_nearby_traffic without an index, which (as in the original code of this project) passes
+    the latitude and longitude to haversine_dist in swapped order and so overestimates east-west distances
+    in Madrid by ~30%: the neighbourhoods found with the index are slightly wider in that direction.
+
+    Parameters
+    ----------
+    traffic_locations_df : pandas.DataFrame
+        Traffic measurement points locations. E.g: Obtained from src.get_data.get_traffic_locations_df().
+    max_cached : int, optional
+        Maximum number of scans and of weight matrices kept in memory.
+    '''
+    def __init__(self,traffic_locations_df:pd.DataFrame,max_cached:int=32):
+        locations_df = traffic_locations_df\
+            .dropna(subset=["latitud","longitud"])\
+                .drop_duplicates(subset=["cod_cent"])
+        self.cod_cent = pd.Index(locations_df.cod_cent.values)
+        self.latitud = locations_df.latitud.values.astype(float)
+        self.longitud = locations_df.longitud.values.astype(float)
+        self.tree = BallTree(np.radians(np.c_[self.latitud,self.longitud]),metric="haversine")
+        self.max_cached = max_cached
+        self._scans = OrderedDict()
+        self._weights = OrderedDict()
+
+    def __len__(self):
+        return len(self.cod_cent)
+
+    def query_radius(self,coords,km_dist:float):
+        '''
+        Returns the positions (in self.cod_cent) and distances in km of the traffic measurement points within km_dist of each coordinate.
+
+        Parameters
+        ----------
+        coords : array-like
+            (lat,long) coordinates of the points of interest with shape (n,2).
+        km_dist : float
+            Maximum distance in km.
+
+        Returns
+        -------
+        list of (numpy.array,numpy.array)
+            Positions and distances of the points nearby each coordinate.
+        '''
+        coords = np.atleast_2d(np.asarray(coords,dtype=float))
+        # Slightly larger radius to find the candidates, the exact distances are computed with haversine_dist
+        candidates = self.tree.query_radius(
+            np.radians(coords),
+            r=km_dist/EARTH_RADIUS_KM*(1+1e-6)
+        )
+        neighbours = []
+        for (lat,long),positions in zip(coords,candidates):
+            positions = np.sort(positions)
+            km_distances = haversine_dist(long,lat,self.longitud[positions],self.latitud[positions])
+            nearby = km_distances<=km_dist
+            neighbours.append((positions[nearby],km_distances[nearby]))
+        return neighbours
+
+    def neighbours(self,coords,km_dist:float):
+        '''
+        Returns the (row,position,km_distance) arrays of the traffic measurement points within km_dist of each coordinate,
+        where row is the position of the coordinate in coords.
+        The scans are cached: a scan with a larger radius over the same coordinates is filtered instead of querying the tree again.
+        '''
+        coords = np.atleast_2d(np.asarray(coords,dtype=float))
+        coords_key = coords.tobytes()
+        radii = [radius for key,radius in self._scans if key==coords_key and radius>=km_dist]
+        if not radii:
+            neighbours = self.query_radius(coords,km_dist)
+            self._cache(self._scans,(coords_key,km_dist),(
+                np.concatenate([np.full(len(positions),i) for i,(positions,_) in enumerate(neighbours)]),
+                np.concatenate([positions for positions,_ in neighbours]),
+                np.concatenate([km_distances for _,km_distances in neighbours]),
+            ))
+            radii = [km_dist]
+        self._scans.move_to_end((coords_key,min(radii)))
+        rows,positions,km_distances = self._scans[(coords_key,min(radii))]
+        nearby = km_distances<=km_dist
+        return rows[nearby],positions[nearby],km_distances[nearby]
+
+    def weight_matrix(self,coords,km_dist:float=0.75,kernel:str="logistic") -> sparse.csr_matrix:
+        '''
+        Returns the sparse matrix of shape (len(coords),len(self)) with the kernel weight (one of DISTANCE_KERNELS)
+        of each traffic measurement point within km_dist of each coordinate (and zeros elsewhere).
+        The matrices are cached by coordinates, distance, and kernel.
+        '''
+        coords = np.atleast_2d(np.asarray(coords,dtype=float))
+        key = (coords.tobytes(),km_dist,kernel)
+        if key not in self._weights:
+            if kernel is None:
+                kernel_func = np.ones_like
+            elif kernel in DISTANCE_KERNELS:
+                kernel_func = DISTANCE_KERNELS[kernel]
+            else:
+                raise ValueError(f"Unknown kernel {kernel}. Must be one of {list(DISTANCE_KERNELS)}")
+            rows,positions,km_distances = self.neighbours(coords,km_dist)
+            self._cache(self._weights,key,sparse.csr_matrix(
+                (kernel_func(km_distances),(rows,positions)),
+                shape=(len(coords),len(self))
+            ))
+        self._weights.move_to_end(key)
+        return self._weights[key]
+
+    def neighbours_matrix(self,coords,km_dist:float=0.75) -> sparse.csr_matrix:
+        '''
+        Returns the sparse matrix of shape (len(coords),len(self)) with ones for the traffic measurement points within km_dist of each coordinate.
+        '''
+        return self.weight_matrix(coords,km_dist,kernel=None)
+
+    def _cache(self,cache,key,value):
+        # Least recently used cache of at most max_cached items
+        cache[key] = value
+        while len(cache)>self.max_cached:
+            cache.popitem(last=False)
+
+def sensor_time_matrices(traffic_df:pd.DataFrame,cod_cent:pd.Index):
+    '''
+    Aggregates the traffic data into sparse time x sensor matrices (columns in the order of cod_cent).
+
+    Returns
+    -------
+    times : numpy.array
+        Sorted unique times of traffic_df (rows of the matrices).
+    matrices : dict
+        Sparse matrices with the number of rows ("rows"), the sum and the count of non-null
+        values of intensidad ("intensidad_sum","intensidad_count") and carga ("carga_sum","carga_count")
+        of each sensor at each time.
+    '''
+    sensors = cod_cent.get_indexer(traffic_df.cod_cent)
+    known = (sensors>=0) & traffic_df.time.notna().values
+    traffic_df = traffic_df.loc[known,["time","intensidad","carga"]]
+    sensors = sensors[known]
+    times,time_codes = np.unique(traffic_df.time.values,return_inverse=True)
+    shape = (len(times),len(cod_cent))
+    def to_matrix(values):
+        return sparse.csr_matrix((values,(time_codes,sensors)),shape=shape)
+    matrices = {"rows": to_matrix(np.ones(len(traffic_df)))}
+    for col in ["intensidad","carga"]:
+        values = traffic_df[col].values.astype(float)
+        notnull = ~np.isnan(values)
+        matrices[f"{col}_sum"] = to_matrix(np.where(notnull,values,0))
+        matrices[f"{col}_count"] = to_matrix(notnull.astype(float))
+    return times,matrices
+
+def nearby_traffic_matrices(sensor_index:TrafficSensorIndex,coords,traffic_df:pd.DataFrame,km_dist=0.75,kernels="logistic"):
+    '''
+    Computes the weighted traffic intensity and average load of the traffic measurement points nearby
+    each coordinate at every time as sparse matrix products (same values as weight_nearby_traffic(...,sensor_index=sensor_index)
+    for each coordinate, except for the distances, see TrafficSensorIndex).
+
+    Several radii and kernels can be given: the neighbours are scanned once with the largest radius
+    and the traffic data is aggregated once for all of them.
+
+    Parameters
+    ----------
+    sensor_index : TrafficSensorIndex
+        Spatial index over the traffic measurement points.
+    coords : array-like
+        (lat,long) coordinates of the points of interest with shape (n,2).
+    traffic_df : pandas.DataFrame
+        Traffic data. E.g: Obtained from src.get_data.get_traffic_df().
+    km_dist : float or list, optional
+        Maximum distance(s) in km to consider traffic measurement points.
+    kernels : str or list, optional
+        Distance kernel(s) used to weight the traffic intensity (see DISTANCE_KERNELS).
+
+    Returns
+    -------
+    times : numpy.array
+        Sorted unique times of traffic_df.
+    traffic_intensity : dict
+        Arrays of shape (len(times),len(coords)) by (kernel,km_dist).
+    traffic_load,has_data : dict
+        Arrays of shape (len(times),len(coords)) by km_dist. has_data is True where there
+        is traffic data within km_dist of the coordinate at that time.
+    '''
+    radii = [km_dist] if np.isscalar(km_dist) else list(km_dist)
+    kernels = [kernels] if isinstance(kernels,str) else list(kernels)
+    max_neighbours = sensor_index.neighbours_matrix(coords,max(radii))
+    # Only the sensors nearby some coordinate are aggregated
+    used = np.flatnonzero(max_neighbours.getnnz(axis=0))
+    times,matrices = sensor_time_matrices(traffic_df,sensor_index.cod_cent[used])
+    traffic_intensity,traffic_load,has_data = {},{},{}
+    with np.errstate(invalid="ignore",divide="ignore"):
+        for radius in radii:
+            neighbours = sensor_index.neighbours_matrix(coords,radius)[:,used].T.tocsr()
+            intensity_count = (matrices["intensidad_count"]@neighbours).toarray()
+            for kernel in kernels:
+                weights = sensor_index.weight_matrix(coords,radius,kernel)[:,used].T.tocsr()
+                traffic_intensity[(kernel,radius)] = (matrices["intensidad_sum"]@weights).toarray()/intensity_count
+            traffic_load[radius] = (matrices["carga_sum"]@neighbours).toarray()/(matrices["carga_count"]@neighbours).toarray()
+            has_data[radius] = (matrices["rows"]@neighbours).toarray()>0
+    return times,traffic_intensity,traffic_load,has_data
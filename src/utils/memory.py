@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import logging
+
+__all__ = ["CATEGORICAL_COLUMNS","compact_dtypes","decode_int_time","memory_report"]
+
+# Columns of the Madrid datasets with few distinct values (stations, zones and traffic sensors)
+CATEGORICAL_COLUMNS = ["estacion","zone","zona","location","nombre","cod_cent"]
+
+def compact_dtypes(df:pd.DataFrame,int_time:bool=False,categorical_cols:list=None,time_col:str="time",copy:bool=True) -> pd.DataFrame:
+    '''
+    Returns a copy of the dataframe using memory-compact dtypes:
+    categoricals for the station, zone and sensor columns, float32 for the measurements,
+    and the smallest integer type that fits each integer column.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Dataframe of air quality, weather, or traffic data (e.g: obtained with src.get_data.get_traffic_df).
+    int_time : bool, optional
+        If True, the time column is also encoded as int32 hours since 1970-01-01.
+        Use decode_int_time to convert it back to datetimes.
+    categorical_cols : list, optional
+        Columns to convert to categoricals. Defaults to CATEGORICAL_COLUMNS.
+    time_col : str, optional
+        Name of the time column encoded if int_time is True.
+    copy : bool, optional
+        If False, the columns are converted in df itself instead of a copy
+        (only the columns that are not compact yet are replaced).
+
+    Returns
+    -------
+    pandas.DataFrame
+    '''
+    categorical_cols = CATEGORICAL_COLUMNS if categorical_cols is None else categorical_cols
+    if copy:
+        df = df.copy()
+    for col in df.columns:
+        dtype = df[col].dtype
+        if col in categorical_cols:
+            if not isinstance(dtype,pd.CategoricalDtype):
+                df[col] = df[col].astype("category")
+        elif pd.api.types.is_float_dtype(dtype) and dtype.itemsize>4:
+            df[col] = df[col].astype(np.float32)
+        elif pd.api.types.is_integer_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+            df[col] = pd.to_numeric(df[col],downcast="integer")
+    if int_time and time_col in df.columns and pd.api.types.is_datetime64_any_dtype(df[time_col]):
+        if df[time_col].isnull().any():
+            logging.warning("The time column has null values. It will not be encoded as integers")
+        else:
+            df[time_col] = df[time_col].values.astype("datetime64[h]").astype(np.int64).astype(np.int32)
+    return df
+
+def decode_int_time(int_time) -> pd.Series:
+    '''
+    Converts times encoded as hours since 1970-01-01 (e.g: with compact_dtypes(df,int_time=True)) back to datetimes.
+    '''
+    return pd.to_datetime(pd.Series(int_time).astype(np.int64),unit="h")
+
+def memory_report(datasets:dict,compare_compact:bool=False) -> pd.DataFrame:
+    '''
+    Returns a pandas.DataFrame with the number of rows, columns and memory usage (in MB) of each dataset.
+
+    Parameters
+    ----------
+    datasets : dict
+        Dictionary of name -> pandas.DataFrame of the datasets to report.
+        e.g: memory_report({"traffic":get_traffic_df("../01-data"),"air_quality":get_air_quality_df("../01-data")})
+    compare_compact : bool, optional
+        If True, the report also includes the memory the datasets would use with compact_dtypes
+        and the ratio between both. Each dataset is temporarily copied to compute it.
+    '''
+    report = []
+    for name,df in datasets.items():
+        row = {
+            "dataset": name,
+            "rows": len(df),
+            "columns": df.shape[1],
+            "memory_mb": df.memory_usage(deep=True).sum()/2**20,
+        }
+        if compare_compact:
+            row["compact_memory_mb"] = compact_dtypes(df).memory_usage(deep=True).sum()/2**20
+            row["reduction"] = row["memory_mb"]/row["compact_memory_mb"] if row["compact_memory_mb"] else np.nan
+        report.append(row)
+    return pd.DataFrame(report).set_index("dataset")
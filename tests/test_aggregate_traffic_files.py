@@ -0,0 +1,63 @@
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from src.data_store import read_dataset
+from src.extraction import aggregate_traffic_files
+
+def _raw_traffic(n_points=3,n_hours=4):
+    times = pd.date_range("2019-12-31 22:00",periods=n_hours*4,freq="15min")
+    raw = pd.DataFrame({
+        "idelem":np.repeat(np.arange(1001,1001+n_points),len(times)),
+        "fecha":np.tile(times.strftime("%Y-%m-%d %H:%M:%S"),n_points),
+        "tipo_elem":"URB",
+        "intensidad":np.arange(n_points*len(times))*10.0,
+        "ocupacion":np.arange(n_points*len(times))%7*1.0,
+        "carga":np.arange(n_points*len(times))%11*1.5,
+    })
+    # Errors of the sensors are negative and not aggregated
+    raw.loc[[3,9],"intensidad"] = -1
+    raw.loc[5,"carga"] = np.nan
+    return raw
+
+def _expected_hourly(raw):
+    raw = raw.assign(fecha=pd.to_datetime(raw.fecha).dt.floor("60min"))
+    raw = raw[(raw.intensidad+raw.ocupacion)>=0]
+    return (
+        raw.groupby(["fecha","idelem"])[["intensidad","ocupacion","carga"]].mean()
+        .reset_index().rename(columns={"idelem":"id"})
+        .sort_values(["fecha","id"]).reset_index(drop=True)
+    )
+
+def test_aggregate_traffic_zip_with_points_spanning_chunks(tmp_path):
+    raw = _raw_traffic()
+    with zipfile.ZipFile(tmp_path/"12-2019.zip","w") as z:
+        z.writestr("12-2019.csv",raw.to_csv(sep=";",decimal=",",index=False))
+    locations = pd.DataFrame({"id":[1001,1002],"cod_cent":["01001",None],"nombre":["Castellana","Atocha"]})
+    root = str(tmp_path/"traffic_hourly.parquet")
+
+    # Every point is split between several chunks and the running sums are merged several times
+    aggregate_traffic_files(str(tmp_path),root,pattern="*.zip",chunksize=5,max_partial_rows=4,locations_df=locations)
+
+    df = read_dataset(root,time_col="fecha",station_col="id").sort_values(["fecha","id"]).reset_index(drop=True)
+    expected = _expected_hourly(raw)
+    assert list(df.columns)==["fecha","nombre","cod_cent","id","intensidad","ocupacion","carga"]
+    pd.testing.assert_frame_equal(df[expected.columns],expected,check_dtype=False)
+    names = df.drop_duplicates("id").set_index("id")
+    assert names.loc[1001,"cod_cent"]=="01001" and names.loc[1001,"nombre"]=="Castellana"
+    # A point without cod_cent is identified by its nombre and points not in locations_df are kept without them
+    assert names.loc[1002,"cod_cent"]=="Atocha"
+    assert pd.isna(names.loc[1003,"cod_cent"])
+
+def test_aggregate_traffic_comma_separated_csv(tmp_path):
+    raw = _raw_traffic(n_points=2,n_hours=2).rename(columns={"idelem":"id"})
+    raw.to_csv(tmp_path/"01-2020.csv",index=False)
+    root = str(tmp_path/"traffic_hourly.parquet")
+
+    aggregate_traffic_files(str(tmp_path),root,chunksize=3)
+
+    df = read_dataset(root,time_col="fecha",station_col="id").sort_values(["fecha","id"]).reset_index(drop=True)
+    expected = _expected_hourly(raw.rename(columns={"id":"idelem"}))
+    pd.testing.assert_frame_equal(df[expected.columns],expected,check_dtype=False)
+    assert df[["nombre","cod_cent"]].isna().all().all()
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data_matching import match_data_by_station
+
+def _legacy_match_data_by_station(aq_df,weather_df=None,traffic_df=None):
+    # Station by station implementation of match_data_by_station before the single-pass engine
+    aq_air_dfs = {}
+    for estacion in aq_df.estacion.unique():
+        estacion_df = aq_df[aq_df.estacion==estacion].dropna(how="all",axis=1).set_index("time")
+        # Non-numeric columns were left as they are by interpolate in pandas<2
+        numeric_cols = estacion_df.select_dtypes("number").columns
+        estacion_df[numeric_cols] = estacion_df[numeric_cols].interpolate(limit=6)
+        estacion_df.columns = estacion_df.columns.str.replace("µ","u")
+        if weather_df is not None:
+            weather_estacion_df = weather_df.set_index("time")
+            weather_estacion_df = weather_estacion_df.loc[weather_estacion_df.index.intersection(estacion_df.index)]
+            estacion_df = estacion_df.loc[weather_estacion_df.index]
+            weather_estacion_df = weather_estacion_df.loc[estacion_df.index]
+            estacion_df = pd.concat(
+                [estacion_df,weather_estacion_df],axis=1
+            ).rename_axis("time").reset_index().dropna(how='all',axis=1)
+        if traffic_df is not None:
+            traffic_estacion_df = traffic_df.set_index("time")
+            traffic_estacion_df = traffic_estacion_df.loc[traffic_estacion_df.index.intersection(estacion_df.index)]
+            estacion_df = estacion_df.loc[traffic_estacion_df.index]
+            traffic_estacion_df = traffic_estacion_df.loc[estacion_df.index]
+            estacion_df = pd.concat([estacion_df,traffic_estacion_df],axis=1).rename_axis("time").reset_index()
+        aq_air_dfs[estacion] = estacion_df
+    return aq_air_dfs
+
+@pytest.fixture
+def madrid_data():
+    rng = np.random.default_rng(0)
+    times = pd.date_range("2020-01-01",periods=24*10,freq="60min")
+    stations = ["Castellana","Retiro","Plaza Elíptica"]
+    aq_df = pd.DataFrame({
+        "time":np.repeat(times,len(stations)),
+        "estacion":np.tile(stations,len(times)),
+        "no2_µg_m3":rng.random(len(times)*len(stations))*50,
+        "o3_ug_m3":rng.random(len(times)*len(stations)),
+    })
+    # Gaps shorter and longer than the interpolation limit, a station without o3 and missing hours
+    aq_df.loc[rng.random(len(aq_df))<0.1,"no2_µg_m3"] = np.nan
+    aq_df.loc[(aq_df.estacion=="Retiro")&(aq_df.time.between("2020-01-03","2020-01-04")),"no2_µg_m3"] = np.nan
+    aq_df.loc[aq_df.estacion=="Plaza Elíptica","o3_ug_m3"] = np.nan
+    aq_df = aq_df.sample(frac=0.9,random_state=1).sort_values("time",kind="stable").reset_index(drop=True)
+    weather_df = pd.DataFrame({"time":times[5:-5],"temperature":rng.random(len(times)-10),"tp":rng.random(len(times)-10)})
+    traffic_df = pd.DataFrame({"time":times[::2],"intensidad":rng.random(len(times[::2]))*500})
+    return aq_df,weather_df,traffic_df
+
+@pytest.mark.parametrize("with_weather,with_traffic",[(True,False),(False,True),(False,False)])
+def test_match_data_by_station_matches_legacy_output(madrid_data,with_weather,with_traffic):
+    aq_df,weather_df,traffic_df = madrid_data
+    weather_df = weather_df if with_weather else None
+    traffic_df = traffic_df if with_traffic else None
+
+    expected = _legacy_match_data_by_station(aq_df.copy(),weather_df,traffic_df)
+    matched = match_data_by_station(aq_df.copy(),weather_df,traffic_df)
+
+    assert list(matched.keys())==list(expected.keys())
+    for estacion,expected_df in expected.items():
+        pd.testing.assert_frame_equal(matched[estacion],expected_df)
+
+def test_match_data_by_station_in_a_pool(madrid_data):
+    aq_df,weather_df,_ = madrid_data
+    expected = _legacy_match_data_by_station(aq_df.copy(),weather_df)
+    matched = match_data_by_station(aq_df.copy(),weather_df,n_jobs=2)
+    for estacion,expected_df in expected.items():
+        pd.testing.assert_frame_equal(matched[estacion],expected_df)
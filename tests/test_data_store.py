@@ -0,0 +1,71 @@
+import glob, os
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import pytest
+
+from src.data_store import read_dataset, write_partitioned_dataset
+
+@pytest.fixture
+def aq_dataset(tmp_path):
+    times = pd.date_range("2019-12-30",periods=24*5,freq="60min")
+    stations = ["Castellana","Retiro"]
+    df = pd.DataFrame({
+        "time":np.repeat(times,len(stations)),
+        "estacion":np.tile(stations,len(times)),
+        "no2_ug_m3":np.arange(len(times)*len(stations))*1.0,
+        "o3_ug_m3":np.arange(len(times)*len(stations))%13*1.0,
+        "zone":np.tile([1,2],len(times)),
+    })
+    root = write_partitioned_dataset(df,str(tmp_path/"air_quality_data.parquet"))
+    return df,root
+
+def _corrupt_partition(root,partition):
+    # Any read of these files fails, so a read that succeeds did not open them
+    # (the schema is discovered from the first file, so only the last partitions can be corrupted)
+    for fpath in glob.glob(os.path.join(root,partition,"**","*.parquet"),recursive=True):
+        with open(fpath,"wb") as f:
+            f.write(b"not parquet")
+
+def test_read_dataset_roundtrip_keeps_column_order(aq_dataset):
+    df,root = aq_dataset
+    read_df = read_dataset(root)
+    assert list(read_df.columns)==list(df.columns)
+    pd.testing.assert_frame_equal(read_df,df.sort_values(["time","estacion"]).reset_index(drop=True),check_dtype=False)
+
+def test_read_dataset_columns_order(aq_dataset):
+    _,root = aq_dataset
+    read_df = read_dataset(root,columns=["o3_ug_m3","zone"])
+    # The time and station columns are always returned first
+    assert list(read_df.columns)==["time","estacion","o3_ug_m3","zone"]
+
+def test_read_dataset_prunes_year_partitions(aq_dataset):
+    df,root = aq_dataset
+    _corrupt_partition(root,"year=2020")
+    read_df = read_dataset(root,start="2019-12-30 12:00",end="2019-12-31")
+    expected = df[df.time.between("2019-12-30 12:00","2019-12-31")].sort_values(["time","estacion"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(read_df,expected,check_dtype=False)
+    with pytest.raises(Exception):
+        read_dataset(root,end="2020-01-01")
+
+def test_read_dataset_prunes_station_partitions(aq_dataset):
+    df,root = aq_dataset
+    _corrupt_partition(root,os.path.join("*","estacion=Retiro"))
+    read_df = read_dataset(root,stations="Castellana",columns=["no2_ug_m3"])
+    expected = df.loc[df.estacion=="Castellana",["time","estacion","no2_ug_m3"]].reset_index(drop=True)
+    pd.testing.assert_frame_equal(read_df,expected,check_dtype=False)
+
+def test_read_dataset_row_filter_on_columns_not_read(aq_dataset):
+    df,root = aq_dataset
+    read_df = read_dataset(root,columns=["no2_ug_m3"],row_filter=ds.field("o3_ug_m3")>6,batch_size=16)
+    expected = df.loc[df.o3_ug_m3>6,["time","estacion","no2_ug_m3"]].sort_values(["time","estacion"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(read_df,expected,check_dtype=False)
+
+def test_read_dataset_feather_file(aq_dataset,tmp_path):
+    df,_ = aq_dataset
+    fpath = str(tmp_path/"air_quality_data.feather")
+    df.to_feather(fpath)
+    read_df = read_dataset(fpath,start="2020-01-01",stations=["Retiro"],columns=["o3_ug_m3"])
+    expected = df.loc[(df.time>="2020-01-01")&(df.estacion=="Retiro"),["time","estacion","o3_ug_m3"]].reset_index(drop=True)
+    pd.testing.assert_frame_equal(read_df,expected,check_dtype=False)
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.preprocessing.gap_filling import fill_gaps, fill_frame_gaps, fill_panel_gaps, INTERPOLATED, SEASONAL, FORWARD_FILLED
+
+def _gappy_values(n_times=500,n_variables=4,seed=0):
+    # Gaps of every length from 1 to 12, at the start and at the end of the series
+    rng = np.random.default_rng(seed)
+    values = rng.random((n_times,n_variables))*100
+    for j in range(n_variables):
+        for start in rng.choice(n_times,40,replace=False):
+            values[start:start+rng.integers(1,13),j] = np.nan
+    values[:3,0] = np.nan
+    values[-8:,1] = np.nan
+    return values
+
+@pytest.mark.parametrize("limit",[1,6,20])
+def test_fill_gaps_is_interpolate_with_limit(limit):
+    values = _gappy_values()
+    filled,imputed = fill_gaps(values,limit=limit)
+    expected = pd.DataFrame(values).interpolate(limit=limit).to_numpy()
+    np.testing.assert_allclose(filled,expected,rtol=1e-12)
+    assert ((imputed==INTERPOLATED)==(np.isnan(values)&~np.isnan(expected))).all()
+
+def test_fill_gaps_of_all_locations_at_once():
+    values = np.stack([_gappy_values(seed=seed) for seed in range(3)])
+    filled,imputed = fill_gaps(values,limit=6)
+    for i in range(len(values)):
+        expected = pd.DataFrame(values[i]).interpolate(limit=6).to_numpy()
+        np.testing.assert_allclose(filled[i],expected,rtol=1e-12)
+
+def test_fill_gaps_seasonal_and_forward_fill():
+    values = np.tile(np.arange(24.0),5)[:,None]
+    values[30:40] = np.nan
+    values[:2] = np.nan
+    filled,imputed = fill_gaps(values,limit=2,season=24)
+    # Interpolated first, then filled with the mean of the same hour of the day
+    np.testing.assert_array_equal(filled[:,0],np.tile(np.arange(24.0),5))
+    assert (imputed[30:32]==INTERPOLATED).all() and (imputed[32:40]==SEASONAL).all() and (imputed[:2]==SEASONAL).all()
+
+    values = np.array([[1.0],[np.nan],[np.nan],[np.nan],[2.0],[np.nan],[np.nan]])
+    filled,imputed = fill_gaps(values,limit=0,ffill_limit=2)
+    np.testing.assert_array_equal(filled[:,0],[1,1,1,np.nan,2,2,2])
+    assert imputed[:,0].tolist()==[0,FORWARD_FILLED,FORWARD_FILLED,0,0,FORWARD_FILLED,FORWARD_FILLED]
+
+def test_fill_frame_gaps_keeps_other_columns():
+    times = pd.date_range("2020-01-01",periods=500,freq="60min")
+    df = pd.DataFrame(_gappy_values(),index=times,columns=["no2","o3","pm10","pm25"]).assign(estacion="Retiro")
+    filled_df,imputed_df = fill_frame_gaps(df,limit=6)
+    pd.testing.assert_frame_equal(filled_df,df.assign(**df[["no2","o3","pm10","pm25"]].interpolate(limit=6)))
+    assert list(imputed_df.columns)==["no2","o3","pm10","pm25"]
+
+def test_fill_panel_gaps_by_station():
+    times = pd.date_range("2020-01-01",periods=500,freq="60min")
+    df = pd.concat([
+        pd.DataFrame(_gappy_values(seed=seed),columns=["no2","o3","pm10","pm25"]).assign(time=times,estacion=estacion)
+        for seed,estacion in enumerate(["Castellana","Retiro"])
+    ])
+    # Missing rows are missing hours of the grid
+    df = df.drop(index=df.index[::17]).reset_index(drop=True)
+    filled_df,_ = fill_panel_gaps(df,limit=6)
+    for estacion,station_df in filled_df.groupby("estacion"):
+        expected = df[df.estacion==estacion].set_index("time")[["no2","o3","pm10","pm25"]].reindex(station_df.time).interpolate(limit=6)
+        np.testing.assert_allclose(station_df[["no2","o3","pm10","pm25"]].to_numpy(),expected.to_numpy(),rtol=1e-12)
@@ -0,0 +1,87 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.extraction.http_cache import download_cached, download_all
+
+class _Handler(BaseHTTPRequestHandler):
+    # Serves the content of server.files, with an ETag only for the paths starting with /etag
+    def do_GET(self):
+        self.server.requests.append((self.path,self.headers.get("If-None-Match")))
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = f'"{hash(content)}"'
+        if self.path.startswith("/etag") and self.headers.get("If-None-Match")==etag:
+            self.server.not_modified += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if self.path.startswith("/etag"):
+            self.send_header("ETag",etag)
+        self.send_header("Content-Length",str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self,*args):
+        pass
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1",0),_Handler)
+    server.files,server.requests,server.not_modified = {},[],0
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever,daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_download_cached_revalidates_with_etag(server,tmp_path):
+    server.files["/etag/a.zip"] = b"zip content"
+    url = server.url+"/etag/a.zip"
+
+    assert download_cached(url,cache_dir=str(tmp_path))==b"zip content"
+    assert download_cached(url,cache_dir=str(tmp_path))==b"zip content"
+
+    assert server.not_modified==1
+    assert server.requests[0][1] is None and server.requests[1][1] is not None
+
+    server.files["/etag/a.zip"] = b"new zip content"
+    assert download_cached(url,cache_dir=str(tmp_path))==b"new zip content"
+    assert server.not_modified==1
+
+def test_download_cached_without_validators_uses_max_age(server,tmp_path):
+    server.files["/a.zip"] = b"zip content"
+    url = server.url+"/a.zip"
+
+    assert download_cached(url,cache_dir=str(tmp_path))==b"zip content"
+    server.files["/a.zip"] = b"new zip content"
+    # Without ETag or Last-Modified the cached content is used without any request until it is max_age seconds old
+    assert download_cached(url,cache_dir=str(tmp_path))==b"zip content"
+    assert len(server.requests)==1
+    assert download_cached(url,cache_dir=str(tmp_path),max_age=0)==b"new zip content"
+    assert len(server.requests)==2
+
+def test_download_cached_falls_back_to_the_cache(server,tmp_path):
+    server.files["/etag/a.zip"] = b"zip content"
+    url = server.url+"/etag/a.zip"
+    download_cached(url,cache_dir=str(tmp_path))
+
+    del server.files["/etag/a.zip"]
+    assert download_cached(url,cache_dir=str(tmp_path))==b"zip content"
+    assert download_cached(server.url+"/etag/b.zip",cache_dir=str(tmp_path)) is None
+
+def test_download_all_keeps_the_order_of_urls(server,tmp_path):
+    urls = []
+    for i in range(10):
+        server.files[f"/etag/{i}.zip"] = f"zip {i}".encode()
+        urls.append(f"{server.url}/etag/{i}.zip")
+
+    assert list(download_all(urls,cache_dir=str(tmp_path),n_jobs=4))==[(url,f"zip {i}".encode()) for i,url in enumerate(urls)]
+    assert list(download_all(urls,cache_dir=str(tmp_path),n_jobs=4))==[(url,f"zip {i}".encode()) for i,url in enumerate(urls)]
+    assert server.not_modified==len(urls)
@@ -0,0 +1,62 @@
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from src.constants import indicators_code_dict
+from src.data_store import read_dataset
+from src.extraction import ingest_air_quality_zips
+from src.preprocessing.preprocess_utils import preprocess_madrid_aq_data
+
+def _raw_aq_data(year,stations=(4,8,35),magnitudes=(1,8),days=4,seed=0):
+    # One row per station, magnitude and day, listed station by station as in the raw csv files
+    rng = np.random.default_rng(seed)
+    index = pd.MultiIndex.from_product([stations,magnitudes,range(1,days+1)],names=["ESTACION","MAGNITUD","DIA"])
+    df = index.to_frame(index=False)
+    df.insert(0,"PROVINCIA",28)
+    df.insert(1,"MUNICIPIO",79)
+    df["PUNTO_MUESTREO"] = [f"28079{e:03d}_{m}_38" for e,m in zip(df.ESTACION,df.MAGNITUD)]
+    df["ANO"] = year
+    df["MES"] = 1
+    df = df[["PROVINCIA","MUNICIPIO","ESTACION","MAGNITUD","PUNTO_MUESTREO","ANO","MES","DIA"]]
+    for h in range(1,25):
+        values = rng.gamma(2,10,len(df)).round(1)
+        values[rng.random(len(df))<0.1] = np.nan
+        df[f"H{h:02d}"] = values
+        df[f"V{h:02d}"] = np.where(rng.random(len(df))<0.1,"N","V")
+    return df
+
+def _write_zip(path,*raw_dfs):
+    with zipfile.ZipFile(path,"w") as z:
+        for i,raw_df in enumerate(raw_dfs):
+            z.writestr(f"ene_mo{i}.csv",raw_df.to_csv(sep=";",decimal=",",index=False))
+
+def test_ingest_air_quality_zips_with_stations_spanning_chunks(tmp_path):
+    raw_2019,raw_2020 = _raw_aq_data(2019),_raw_aq_data(2020,seed=1)
+    _write_zip(tmp_path/"Anio2019.zip",raw_2019)
+    _write_zip(tmp_path/"Anio2020.zip",raw_2020.iloc[:8],raw_2020.iloc[8:])
+    root = str(tmp_path/"aq_ayto_madrid.parquet")
+
+    # Every station has 8 rows, so most of them are split between two chunks of 5 rows
+    ingest_air_quality_zips(str(tmp_path),root,chunksize=5)
+
+    df = read_dataset(root,time_col="fecha").sort_values(["fecha","estacion"]).reset_index(drop=True)
+    expected = pd.concat([
+        preprocess_madrid_aq_data(raw_2019,indicators_code_dict),
+        preprocess_madrid_aq_data(raw_2020.iloc[:8],indicators_code_dict),
+        preprocess_madrid_aq_data(raw_2020.iloc[8:],indicators_code_dict),
+    ]).sort_values(["fecha","estacion"]).reset_index(drop=True)
+    assert not df.duplicated(["fecha","estacion"]).any()
+    pd.testing.assert_frame_equal(df[expected.columns],expected,check_dtype=False)
+    # Parameters not measured in the zips are empty columns
+    assert df.drop(columns=expected.columns).isna().all().all()
+
+def test_ingest_air_quality_zips_again_overwrites(tmp_path):
+    _write_zip(tmp_path/"Anio2019.zip",_raw_aq_data(2019))
+    root = str(tmp_path/"aq_ayto_madrid.parquet")
+    ingest_air_quality_zips(str(tmp_path),root,chunksize=5)
+    num_rows = len(read_dataset(root,time_col="fecha"))
+
+    ingest_air_quality_zips(str(tmp_path),root,chunksize=5)
+
+    assert len(read_dataset(root,time_col="fecha"))==num_rows